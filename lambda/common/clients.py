@@ -0,0 +1,59 @@
+import os
+import threading
+from functools import lru_cache
+
+# 各Lambdaで共通のクライアント。コンテナ内で一度だけ生成し、ウォームスタート時は使い回す
+# boto3 / openai / requests の import は初回利用時まで遅らせ、コールドスタートを短くする
+
+# 同時に使う接続数（スレッドプールから並列に呼ぶ場合を想定）
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', '20'))
+
+# boto3 のデフォルトセッションはスレッドセーフではないため、生成時はロックを取る
+_lock = threading.Lock()
+
+def _boto_config():
+    from botocore.config import Config
+    return Config(
+        tcp_keepalive=True,
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={"mode": "standard"}
+    )
+
+@lru_cache(maxsize=None)
+def get_client(service_name):
+    with _lock:
+        import boto3
+        return boto3.client(service_name, config=_boto_config())
+
+@lru_cache(maxsize=None)
+def get_dynamodb_resource():
+    with _lock:
+        import boto3
+        return boto3.resource('dynamodb', config=_boto_config())
+
+@lru_cache(maxsize=None)
+def get_table(table_name):
+    return get_dynamodb_resource().Table(table_name)
+
+@lru_cache(maxsize=None)
+def get_openai_client():
+    from openai import OpenAI
+    return OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+
+# 非同期版（接続はイベントループに紐づくため、同じイベントループから使うこと）
+# 429 などの再試行は呼び出し側のレート制御で行うため、SDKの自動再試行は無効にする
+@lru_cache(maxsize=None)
+def get_async_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.environ['OPENAI_API_KEY'], max_retries=0)
+
+# Keep-Alive で接続を使い回す HTTP セッション
+@lru_cache(maxsize=None)
+def get_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_POOL_CONNECTIONS, pool_maxsize=MAX_POOL_CONNECTIONS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,64 @@
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from tracing import current_trace_id
+
+# CloudWatch Embedded Metric Format (EMF) で処理時間・件数などを出力する
+# 標準出力に1行のJSONを書くと、CloudWatch Logs がメトリクスとして取り込む
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "FpUploadTool")
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+# イベント全体のデバッグ出力を行う割合（0〜1。既定は出力しない）
+DEBUG_EVENT_SAMPLE_RATE = float(os.environ.get("DEBUG_EVENT_SAMPLE_RATE", "0"))
+
+# メトリクス名 -> 単位
+METRIC_UNITS = {
+    "Duration": "Milliseconds",
+    "Rows": "Count",
+    "Items": "Count",
+    "Requests": "Count",
+    "Errors": "Count",
+    "Bytes": "Bytes",
+    "PromptTokens": "Count",
+    "CompletionTokens": "Count",
+}
+
+def emit_metrics(metrics, dimensions=None, properties=None):
+    dimensions = {"Function": FUNCTION_NAME, **(dimensions or {})}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": METRIC_UNITS.get(name, "None")} for name in metrics]
+            }]
+        },
+        **dimensions,
+        **metrics,
+        "trace_id": current_trace_id(),
+        **(properties or {})
+    }
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+# 処理段階（S3 GET、集計、OpenAI 呼び出しなど）の所要時間を計測する
+# with timed("S3Get") as m: m["Bytes"] = ... のように件数・サイズも一緒に出力できる
+@contextmanager
+def timed(stage, **properties):
+    metrics = {}
+    start = time.perf_counter()
+    try:
+        yield metrics
+    except Exception:
+        metrics["Errors"] = 1
+        raise
+    finally:
+        metrics["Duration"] = round((time.perf_counter() - start) * 1000, 2)
+        emit_metrics(metrics, dimensions={"Stage": stage}, properties=properties)
+
+# 受信イベントのデバッグ出力（DEBUG_EVENT_SAMPLE_RATE の割合だけ出す）
+def log_event(event):
+    if DEBUG_EVENT_SAMPLE_RATE > 0 and random.random() < DEBUG_EVENT_SAMPLE_RATE:
+        print("[DEBUG] event:", json.dumps(event, ensure_ascii=False, default=str))
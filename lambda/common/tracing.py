@@ -0,0 +1,54 @@
+import contextvars
+import functools
+import json
+import time
+import uuid
+
+# Lambda間の呼び出しを追跡するため、ペイロードに載せるキー
+TRACE_ID_KEY = "trace_id"
+TRACE_SENT_AT_KEY = "trace_sent_at"
+
+_current_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def current_trace_id():
+    return _current_trace_id.get()
+
+# ハンドラの途中で分かったトレースID（S3メタデータなど）に切り替える
+def bind_trace_id(trace_id):
+    _current_trace_id.set(trace_id)
+
+# 呼び出し先に渡すペイロードにトレースIDと送信時刻を付ける
+def traced_payload(payload, trace_id=None):
+    return {
+        **payload,
+        TRACE_ID_KEY: trace_id or current_trace_id() or new_trace_id(),
+        TRACE_SENT_AT_KEY: time.time()
+    }
+
+# ハンドラのデコレータ。受け取ったトレースIDを引き継ぎ、待ち時間と実行時間を出力する
+def traced(function_name):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            trace_id = event.get(TRACE_ID_KEY) or new_trace_id()
+            sent_at = event.get(TRACE_SENT_AT_KEY)
+            token = _current_trace_id.set(trace_id)
+            start = time.time()
+            try:
+                return handler(event, context)
+            finally:
+                trace_id = _current_trace_id.get()
+                _current_trace_id.reset(token)
+                print(json.dumps({
+                    "trace": {
+                        "trace_id": trace_id,
+                        "function": function_name,
+                        "queue_ms": round((start - sent_at) * 1000, 1) if sent_at else None,
+                        "exec_ms": round((time.time() - start) * 1000, 1)
+                    }
+                }))
+        return wrapper
+    return decorator
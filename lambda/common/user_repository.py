@@ -0,0 +1,141 @@
+import os
+import time
+from clients import get_dynamodb_resource, get_table
+from metrics import timed
+
+# ユーザーテーブル（パーティションキー userId）の読み書き
+# 読み込みは必要な属性だけを ProjectionExpression で取得し、書き込みは update_item で指定した属性だけを書き換える
+# （put_item で項目ごと置き換えると、他の関数が書いた json_path などが消える）
+
+# csv_path をキーにしたグローバルセカンダリインデックス
+CSV_PATH_INDEX_NAME = os.environ.get('CSV_PATH_INDEX_NAME', 'csv_path-index')
+# BatchGetItem の1回あたりのキー数の上限（BatchWriteItem は25件で、batch_writer が分割する）
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = 5
+
+def user_table():
+    return get_table(os.environ['DYNAMODB_TABLE_NAME'])
+
+def _conditional_check_failed(table):
+    return table.meta.client.exceptions.ConditionalCheckFailedException
+
+# 属性名 -> プレースホルダー（予約語と衝突しないよう #a0, #a1, ... に置き換える）
+def _projection(attributes):
+    names = {f"#a{i}": name for i, name in enumerate(attributes)}
+    return ", ".join(names), names
+
+# 1ユーザーの項目。attributes を指定するとその属性だけを読む（未登録なら None）
+def get_user(user_id, attributes=None):
+    table = user_table()
+    params = {"Key": {"userId": user_id}}
+    if attributes:
+        params["ProjectionExpression"], params["ExpressionAttributeNames"] = _projection(attributes)
+    with timed("DynamoDBGet"):
+        response = table.get_item(**params)
+    return response.get("Item")
+
+# 複数ユーザーの項目をまとめて読む。戻り値は userId -> 項目（未登録のユーザーは含まない）
+def batch_get_users(user_ids, attributes=None):
+    table_name = os.environ['DYNAMODB_TABLE_NAME']
+    user_ids = list(dict.fromkeys(user_ids))
+    request = {}
+    if attributes:
+        # 結果をユーザーに対応づけるため userId も読む
+        request["ProjectionExpression"], request["ExpressionAttributeNames"] = _projection(["userId", *attributes])
+
+    items = {}
+    dynamodb = get_dynamodb_resource()
+    for start in range(0, len(user_ids), BATCH_GET_MAX_KEYS):
+        keys = [{"userId": user_id} for user_id in user_ids[start:start + BATCH_GET_MAX_KEYS]]
+        for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+            with timed("DynamoDBBatchGet") as m:
+                m["Items"] = len(keys)
+                response = dynamodb.batch_get_item(RequestItems={table_name: {**request, "Keys": keys}})
+            for item in response.get("Responses", {}).get(table_name, []):
+                items[item["userId"]] = item
+            # スロットリングなどで読めなかったキーは少し待って読み直す
+            keys = response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+            if not keys:
+                break
+            if attempt == BATCH_GET_MAX_RETRIES:
+                raise RuntimeError(f"{len(keys)} 件のユーザーを読み込めませんでした")
+            time.sleep(min(0.05 * 2 ** attempt, 1.0))
+    return items
+
+# 未登録なら項目を作る（すでにあれば何もしないで False）
+def create_user(user_id, attributes=None):
+    table = user_table()
+    try:
+        with timed("DynamoDBPut"):
+            table.put_item(
+                Item={**(attributes or {}), "userId": user_id},
+                ConditionExpression="attribute_not_exists(userId)"
+            )
+    except _conditional_check_failed(table):
+        return False
+    return True
+
+# 指定した属性だけを書き換える（項目がなければ作る）
+#   values: SET する属性名 -> 値、remove: REMOVE する属性名
+#   condition: 条件式（値は condition_values の :name で渡す）
+# 戻り値は ReturnValues で指定した属性（条件を満たさなければ None）
+def update_user(user_id, values=None, remove=(), condition=None, condition_values=None, return_values="NONE"):
+    # 空の UpdateExpression は DynamoDB が ValidationException で拒否するので、呼び出す前に弾く
+    if not values and not remove:
+        raise ValueError("更新する属性がありません")
+    table = user_table()
+    names = {}
+    attribute_values = dict(condition_values or {})
+    clauses = []
+    if values:
+        assignments = []
+        for i, (name, value) in enumerate(values.items()):
+            names[f"#s{i}"] = name
+            attribute_values[f":s{i}"] = value
+            assignments.append(f"#s{i} = :s{i}")
+        clauses.append("SET " + ", ".join(assignments))
+    if remove:
+        for i, name in enumerate(remove):
+            names[f"#r{i}"] = name
+        clauses.append("REMOVE " + ", ".join(f"#r{i}" for i in range(len(remove))))
+
+    params = {
+        "Key": {"userId": user_id},
+        "UpdateExpression": " ".join(clauses),
+        "ReturnValues": return_values
+    }
+    if names:
+        params["ExpressionAttributeNames"] = names
+    if attribute_values:
+        params["ExpressionAttributeValues"] = attribute_values
+    if condition:
+        params["ConditionExpression"] = condition
+    try:
+        with timed("DynamoDBUpdate"):
+            response = table.update_item(**params)
+    except _conditional_check_failed(table):
+        return None
+    return response.get("Attributes", {})
+
+# 複数の項目をまとめて書き込む（同じ userId の項目は置き換える。25件ずつの BatchWriteItem）
+def batch_put_users(items):
+    table = user_table()
+    with timed("DynamoDBBatchWrite") as m:
+        m["Items"] = len(items)
+        with table.batch_writer(overwrite_by_pkeys=["userId"]) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+# csv_path から userId を引く（メタデータを持たない古いアップロード向け）
+def find_user_id_by_csv_path(csv_path):
+    table = user_table()
+    with timed("DynamoDBQuery"):
+        response = table.query(
+            IndexName=CSV_PATH_INDEX_NAME,
+            KeyConditionExpression="csv_path = :csv_path",
+            ExpressionAttributeValues={":csv_path": csv_path},
+            ProjectionExpression="userId",
+            Limit=1
+        )
+    items = response.get('Items', [])
+    return items[0]['userId'] if items else None
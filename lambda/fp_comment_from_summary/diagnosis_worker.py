@@ -0,0 +1,268 @@
+import asyncio
+import json
+import os
+import random
+import time
+from clients import get_async_openai_client, get_client
+from lambda_function import (
+    FP_MODEL, acquire_or_join_inflight, build_fp_prompt, fp_comment_cache_key, get_cached_fp_comment, load_summary_json,
+    put_cached_fp_comment, release_inflight
+)
+from metrics import log_event, timed
+from tracing import bind_trace_id, new_trace_id, traced, traced_payload
+from user_repository import batch_get_users
+
+# SQS（FP_REQUEST_QUEUE_URL）に積まれた家計診断の依頼をまとめて処理するワーカー
+# OpenAI の呼び出しを並列に行い、RPM/TPM の上限に合わせてトークンバケットで流量を抑える
+# ハンドラ: diagnosis_worker.lambda_handler（SQSトリガー、ReportBatchItemFailures を有効にする）
+
+# 同時に処理する依頼の数
+FP_MAX_CONCURRENCY = int(os.environ.get("FP_MAX_CONCURRENCY", "8"))
+# このワーカーに割り当てる OpenAI の上限（1分あたりのリクエスト数・トークン数）
+FP_OPENAI_RPM = int(os.environ.get("FP_OPENAI_RPM", "60"))
+FP_OPENAI_TPM = int(os.environ.get("FP_OPENAI_TPM", "150000"))
+# 応答のトークン数の見込み（実際の使用量で後から精算する）
+FP_COMPLETION_TOKENS_ESTIMATE = int(os.environ.get("FP_COMPLETION_TOKENS_ESTIMATE", "1000"))
+# 429・5xx・接続エラーの再試行
+FP_MAX_RETRIES = int(os.environ.get("FP_MAX_RETRIES", "5"))
+FP_RETRY_BASE_SECONDS = float(os.environ.get("FP_RETRY_BASE_SECONDS", "1"))
+FP_RETRY_MAX_SECONDS = float(os.environ.get("FP_RETRY_MAX_SECONDS", "10"))
+# 1回の実行で再試行・レート制御の待ちに使える秒数。超えて待つ依頼は SQS に戻し、
+# 可視性タイムアウト後の再配信に任せる（関数のタイムアウトより十分短くする）
+FP_WAIT_BUDGET_SECONDS = float(os.environ.get("FP_WAIT_BUDGET_SECONDS", "30"))
+# 関数の残り時間のうち、生成後のLINE送信などのために残しておく秒数
+FP_DEADLINE_MARGIN_SECONDS = 10
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """1分あたり rate_per_minute ずつ補充されるバケット"""
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = float(rate_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # amount を取り出せるまでの待ち時間（秒）
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    # 実際の使用量との差の精算でマイナスになることもある
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+class RateLimiter:
+    """リクエスト数（RPM）とトークン数（TPM）の2つのバケットで OpenAI の呼び出しを制限する"""
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    # 1リクエスト分（見込みトークン数）を確保できるまで待つ。待っている間は後続も順番待ちになる
+    # deadline（time.monotonic() の値）までに確保できなければ RuntimeError
+    async def acquire(self, tokens, deadline=None):
+        async with self._lock:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(tokens)
+                )
+                if wait <= 0:
+                    break
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    raise RuntimeError(f"OpenAI のレート制限の待ち（{wait:.1f} 秒）がこの実行の残り時間を超えます")
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def settle(self, estimated, actual):
+        self.tokens.take(actual - estimated)
+
+    # 429 を受けたら全体の呼び出しを止める
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def _status_code(error):
+    return getattr(error, "status_code", None)
+
+def is_retryable(error):
+    if _status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    from openai import APIConnectionError
+    return isinstance(error, APIConnectionError)
+
+# Retry-After ヘッダー（秒）。なければ指数バックオフ + ジッター
+def retry_delay(error, attempt):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), FP_RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    return min(FP_RETRY_BASE_SECONDS * 2 ** attempt, FP_RETRY_MAX_SECONDS) * (0.5 + random.random() / 2)
+
+# FPコメント生成（レート制御・再試行つき。再試行しきれない・deadline までに待ち終わらなければ例外）
+async def request_fp_comment_async(summary_json, limiter, deadline=None):
+    prompt = build_fp_prompt(summary_json)
+    # 日本語はおおよそ1文字1トークン
+    estimated = len(prompt) + FP_COMPLETION_TOKENS_ESTIMATE
+    client = get_async_openai_client()
+    for attempt in range(FP_MAX_RETRIES + 1):
+        await limiter.acquire(estimated, deadline)
+        try:
+            with timed("OpenAI", model=FP_MODEL, attempt=attempt) as m:
+                response = await client.chat.completions.create(
+                    model=FP_MODEL,
+                    messages=[{"role": "user", "content": prompt}]
+                )
+                m["PromptTokens"] = response.usage.prompt_tokens
+                m["CompletionTokens"] = response.usage.completion_tokens
+        except Exception as e:
+            if attempt == FP_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt)
+            if _status_code(e) == 429:
+                limiter.pause(delay)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise
+            print(f"[WARN] OpenAI の呼び出しに失敗しました。{delay:.1f} 秒後に再試行します ({attempt + 1}/{FP_MAX_RETRIES}): {e}")
+            await asyncio.sleep(delay)
+            continue
+        limiter.settle(estimated, response.usage.total_tokens)
+        return response.choices[0].message.content.strip()
+
+# 1件の依頼を処理する。戻り値は (LINE に送る {"userId", "message"}, json_path)（送るものがなければ None）
+# 実行中マーカーは LINE に送ってから外す（失敗したときはここで外す）
+# json_paths はバッチ内のユーザーの userId -> json_path（まとめて読んだもの）
+async def diagnose(record, bucket, limiter, semaphore, json_paths, deadline=None):
+    try:
+        request = json.loads(record["body"])
+        user_id = request["user_id"]
+    except (ValueError, KeyError, TypeError) as e:
+        # 形式の壊れた依頼。再配信しても読めないので捨てる
+        print(f"[ERROR] 家計診断の依頼を読めませんでした: messageId={record.get('messageId')}: {e!r}")
+        return None
+    # タスクごとにコンテキストが分かれるため、依頼ごとのトレースIDに切り替えられる
+    bind_trace_id(request.get("trace_id") or new_trace_id())
+    async with semaphore:
+        try:
+            summary_json, json_key = await asyncio.to_thread(load_summary_json, user_id, bucket, json_paths.get(user_id))
+        except ValueError as e:
+            # 集計がまだないユーザー。再試行しても変わらないので捨てる
+            print(f"[WARN] userId={user_id}: {e}")
+            return None
+
+        # 同じ集計の診断が実行中（同じバッチ内の重複・集計直後の先行生成を含む）なら、その診断が結果を送るので捨てる
+        if not await asyncio.to_thread(acquire_or_join_inflight, user_id, json_key):
+            print(f"[INFO] 実行中の家計診断に合流しました: {user_id}, {json_key}")
+            return None
+
+        try:
+            cache_key = fp_comment_cache_key(summary_json)
+            comment = await asyncio.to_thread(get_cached_fp_comment, bucket, cache_key)
+            if comment is None:
+                comment = await request_fp_comment_async(summary_json, limiter, deadline)
+                await asyncio.to_thread(put_cached_fp_comment, bucket, cache_key, comment)
+            else:
+                print(f"[INFO] FPコメントのキャッシュを利用: {cache_key}")
+        except Exception:
+            await asyncio.to_thread(release_inflight, user_id, json_key)
+            raise
+    return {"userId": user_id, "message": comment}, json_key
+
+# バッチ内のユーザーの json_path をまとめて読む（読めない依頼は diagnose で失敗にする）
+def load_json_paths(records):
+    user_ids = []
+    for record in records:
+        try:
+            user_ids.append(json.loads(record["body"])["user_id"])
+        except (ValueError, KeyError, TypeError):
+            pass
+    items = batch_get_users(user_ids, ["json_path"]) if user_ids else {}
+    return {user_id: item.get("json_path") for user_id, item in items.items()}
+
+# deadline（time.monotonic() の値）を過ぎて待つ依頼は失敗にする
+async def diagnose_all(records, bucket, deadline=None):
+    limiter = _get_limiter()
+    semaphore = asyncio.Semaphore(FP_MAX_CONCURRENCY)
+    json_paths = await asyncio.to_thread(load_json_paths, records)
+    return await asyncio.gather(
+        *(diagnose(record, bucket, limiter, semaphore, json_paths, deadline) for record in records),
+        return_exceptions=True
+    )
+
+# 生成したコメントをまとめてLINE通知関数に渡す
+def invoke_line_notifier_batch(deliveries):
+    with timed("LambdaInvoke", target="line_notifier") as m:
+        m["Items"] = len(deliveries)
+        get_client("lambda").invoke(
+            FunctionName="line_notifier",
+            InvocationType="Event",
+            Payload=json.dumps(traced_payload({"deliveries": deliveries}), ensure_ascii=False).encode("utf-8")
+        )
+
+# 非同期クライアントの接続を使い回すため、イベントループはウォームスタート間で共有する
+_loop = None
+# レート制御も共有し、直前の実行で使った分をウォームスタートの次の実行に持ち越す
+# （asyncio.Lock を持つため、イベントループを作り直したときは作り直す）
+_limiter = None
+
+def _get_loop():
+    global _loop, _limiter
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        _limiter = None
+    return _loop
+
+def _get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(FP_OPENAI_RPM, FP_OPENAI_TPM)
+    return _limiter
+
+# この実行で待ってよい期限（time.monotonic() の値）
+def _deadline(context):
+    budget = FP_WAIT_BUDGET_SECONDS
+    if context is not None:
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000 - FP_DEADLINE_MARGIN_SECONDS)
+    return time.monotonic() + budget
+
+@traced("fp_diagnosis_worker")
+def lambda_handler(event, context):
+    log_event(event)
+    records = event.get("Records", [])
+    bucket = os.environ["S3_BUCKET_NAME"]
+
+    results = _get_loop().run_until_complete(diagnose_all(records, bucket, _deadline(context)))
+
+    deliveries = []
+    failures = []
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            # SQS に戻して再試行させる（ユーザーにはエラーを送らない）
+            print(f"[ERROR] messageId={record['messageId']}: {result}")
+            failures.append({"itemIdentifier": record["messageId"]})
+        elif result:
+            deliveries.append(result)
+
+    try:
+        if deliveries:
+            invoke_line_notifier_batch([delivery for delivery, _ in deliveries])
+    finally:
+        for delivery, json_key in deliveries:
+            release_inflight(delivery["userId"], json_key)
+
+    print(f"[INFO] 家計診断 {len(deliveries)} 件を送信、{len(failures)} 件を再試行に回しました")
+    return {"batchItemFailures": failures}
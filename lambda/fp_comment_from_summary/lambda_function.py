@@ -1,84 +1,269 @@
 import os
 import json
-import boto3
-from openai import OpenAI
+import hashlib
+import time
 from datetime import datetime
+from clients import get_client, get_openai_client
+from metrics import log_event, timed
+from tracing import traced, traced_payload
+from user_repository import get_user, update_user
 
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+FP_MODEL = "gpt-4-turbo"
+# プロンプトを変えたら上げる（キャッシュのキーに含まれる）
+PROMPT_VERSION = "4"
 
-# FPコメント生成
-def generate_fp_comment(summary_json):
+# FPコメントのキャッシュ（集計JSONの内容ハッシュ -> コメント）
+FP_COMMENT_CACHE_PREFIX = os.environ.get("FP_COMMENT_CACHE_PREFIX", "cache/fp_comments/")
+FP_COMMENT_CACHE_TTL_SECONDS = int(os.environ.get("FP_COMMENT_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+# 診断の実行中マーカーの有効期限（秒）。この間に届いた同じ集計の依頼は実行中の診断に合流する
+FP_INFLIGHT_TTL_SECONDS = int(os.environ.get("FP_INFLIGHT_TTL_SECONDS", "300"))
+
+# プロンプトに載せるデータの上限（文字数。日本語はおおよそ1文字1トークン）
+FP_PROMPT_DATA_MAX_CHARS = int(os.environ.get("FP_PROMPT_DATA_MAX_CHARS", "6000"))
+
+# 上限に収まるまで、最も長いリストの末尾（古い月・重要度の低い行）から削る
+# 月次の推移以外のリストは、重要な行から並べておくこと
+def fit_to_budget(payload, max_chars):
+    payload = json.loads(json.dumps(payload))
+    while len(json.dumps(payload, ensure_ascii=False, separators=(",", ":"))) > max_chars:
+        lists = [(len(json.dumps(v, ensure_ascii=False)), k) for k, v in payload.items() if isinstance(v, list) and v]
+        if not lists:
+            break
+        _, longest = max(lists)
+        # 月次の推移は古い方から、それ以外は末尾から削る
+        payload[longest].pop(0 if longest == "months" else -1)
+    return payload
+
+# 集計JSONからプロンプト用のコンパクトなデータを作る
+def build_prompt_payload(summary_json, max_chars=FP_PROMPT_DATA_MAX_CHARS):
+    analytics = summary_json.get("analytics")
+    if analytics:
+        payload = {
+            "latest_month": analytics["latest_month"],
+            "previous_month": analytics["previous_month"],
+            "top_movers": analytics["top_movers"],
+            # 店ごとの分析値のない古い集計JSONもある
+            "top_merchants_by_spend": analytics.get("top_merchants_by_spend", []),
+            "top_merchants_by_count": analytics.get("top_merchants_by_count", []),
+            "category_share": analytics["category_share"],
+            # 中項目名順なので、削るときに増減の小さい中項目から落ちるよう増減額・金額の大きい順にする
+            "category_mom": sorted(analytics["category_mom"], key=lambda row: (-abs(row["delta"]), -row["amount"])),
+            "months": analytics["months"],
+            "unclassified_total": summary_json.get("unclassified_total"),
+        }
+    else:
+        # 分析値のない古い集計JSONは、週次の明細を除いて渡す
+        payload = {k: v for k, v in summary_json.items() if k not in ("weekly", "category_weekly")}
+    return fit_to_budget(payload, max_chars)
+
+def build_fp_prompt(summary_json):
+    data = json.dumps(build_prompt_payload(summary_json), ensure_ascii=False, separators=(",", ":"))
     prompt = f"""
 利用者は3人家族です。成人2名に0歳児が1名います。共働きですが、奥さんが育児休業中です。目的は月単位での家計の把握です。
 あなたはベテランFP人呼んで「藤原のパー子」40歳。
-以下の家計データ（収支の週次、月次、カテゴリ別の集計の月次、週次）をもとに、利用者に向けたFPコメントを
-日本語で出力してください。
+以下の家計データをもとに、利用者に向けたFPコメントを日本語で出力してください。
+データの金額は円で、前月比・割合は計算済みです（再計算せずにそのまま使ってください）。
+・months: 月ごとの収入・支出・収支（balance）と黒字/赤字
+・category_share: 最新月（latest_month）の支出に占める中項目ごとの割合
+・category_mom / top_movers: 中項目ごとの支出の前月比（delta: 増減額, ratio: 前月に対する倍率）
+・top_merchants_by_spend / top_merchants_by_count: 最新月に支出額・利用回数の多い店（店名は表記揺れをそろえたもの）
+
+コメントに含める内容：
 ・収支バランス（黒字/赤字）
 ・支出傾向（カテゴリ別の比率など）
 ・改善ポイント（節約・見直しの提案など）
 ・先月と比較し特に大きな動きのあるカテゴリ
 ・カテゴリ毎の金額の前月比
+・支出額・利用回数の多い店についての具体的な見直しポイント
 
 データ：
-{json.dumps(summary_json, ensure_ascii=False)}
+{data}
 
 出力形式：
 FPコメント: <コメント本文>
 """
-    try:
-        response = client.chat.completions.create(
+    return prompt
+
+# FPコメント生成（失敗時は例外）
+def request_fp_comment(summary_json):
+    with timed("OpenAI", model=FP_MODEL) as m:
+        response = get_openai_client().chat.completions.create(
             #model="gpt-3.5-turbo",
-            model="gpt-4-turbo",
-            messages=[{"role": "user", "content": prompt}]
+            model=FP_MODEL,
+            messages=[{"role": "user", "content": build_fp_prompt(summary_json)}]
         )
-        return response.choices[0].message.content.strip()
+        m["PromptTokens"] = response.usage.prompt_tokens
+        m["CompletionTokens"] = response.usage.completion_tokens
+    return response.choices[0].message.content.strip()
+
+# FPコメント生成
+def generate_fp_comment(summary_json):
+    try:
+        return request_fp_comment(summary_json)
+    except Exception as e:
+        return f"コメント生成エラー: {e}"
+
+# 集計JSONを正規化した内容 + モデル + プロンプトのバージョンのハッシュ
+def fp_comment_cache_key(summary_json):
+    canonical = json.dumps(summary_json, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(f"{FP_MODEL}\n{PROMPT_VERSION}\n{canonical}".encode("utf-8")).hexdigest()
+    return f"{FP_COMMENT_CACHE_PREFIX}{digest}.json"
+
+# 期限内のキャッシュがあればコメントを返す
+def get_cached_fp_comment(bucket, cache_key):
+    s3 = get_client("s3")
+    try:
+        with timed("S3GetCache"):
+            obj = s3.get_object(Bucket=bucket, Key=cache_key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    cached = json.loads(obj["Body"].read().decode("utf-8"))
+    if time.time() - cached["created_at"] > FP_COMMENT_CACHE_TTL_SECONDS:
+        return None
+    return cached["comment"]
+
+def put_cached_fp_comment(bucket, cache_key, comment):
+    cached = {
+        "comment": comment,
+        "model": FP_MODEL,
+        "prompt_version": PROMPT_VERSION,
+        "created_at": time.time()
+    }
+    get_client("s3").put_object(
+        Bucket=bucket,
+        Key=cache_key,
+        Body=json.dumps(cached, ensure_ascii=False).encode("utf-8")
+    )
+
+# 集計内容が前回と同じならキャッシュから返し、なければ生成してキャッシュする
+def get_or_generate_fp_comment(summary_json, bucket):
+    cache_key = fp_comment_cache_key(summary_json)
+    comment = get_cached_fp_comment(bucket, cache_key)
+    if comment is not None:
+        print(f"[INFO] FPコメントのキャッシュを利用: {cache_key}")
+        return comment
+
+    try:
+        comment = request_fp_comment(summary_json)
     except Exception as e:
+        # エラーはキャッシュしない
         return f"コメント生成エラー: {e}"
+    put_cached_fp_comment(bucket, cache_key, comment)
+    return comment
+
+# DynamoDBのjson_pathから、ユーザーの最新の集計JSONを読み込む（見つからなければ ValueError）
+# 戻り値は (集計JSON, json_path)
+def load_summary(user_id, bucket):
+    item = get_user(user_id, ["json_path"])
+    return load_summary_json(user_id, bucket, (item or {}).get("json_path"))
+
+# json_path（DynamoDBから読んだもの。なければ None）の集計JSONを読み込む
+def load_summary_json(user_id, bucket, json_key):
+    if not json_key:
+        raise ValueError("対象の JSON パスが見つかりません。")
+
+    print(f"[INFO] ユーザー: {user_id}, JSONキー: {json_key}")
+
+    # S3からJSONファイル取得
+    s3 = get_client("s3")
+    with timed("S3Get") as m:
+        obj = s3.get_object(Bucket=bucket, Key=json_key)
+        content = obj["Body"].read().decode("utf-8")
+        m["Bytes"] = len(content.encode("utf-8"))
+    return json.loads(content), json_key
+
+# ユーザーの項目に実行中マーカー（集計のパス + 期限）を条件付きで書く
+# 同じ集計の診断が期限内に実行中なら False（重複した依頼は新しく生成せず、最初の依頼が結果を送る）
+def acquire_inflight(user_id, json_key):
+    now = int(time.time())
+    return update_user(
+        user_id,
+        {"fp_inflight_path": json_key, "fp_inflight_until": now + FP_INFLIGHT_TTL_SECONDS},
+        condition="attribute_not_exists(fp_inflight_until) OR fp_inflight_until < :now OR fp_inflight_path <> :path",
+        condition_values={":path": json_key, ":now": now}
+    ) is not None
+
+# 実行中の診断に、終わったら結果をLINEに送るよう頼む（マーカーがもうなければ False）
+def join_inflight(user_id, json_key):
+    return update_user(
+        user_id,
+        {"fp_inflight_notify": True},
+        condition="fp_inflight_path = :path AND fp_inflight_until >= :now",
+        condition_values={":path": json_key, ":now": int(time.time())}
+    ) is not None
+
+# 実行中マーカーを取る。取れなければ（join なら）実行中の診断に合流する
+# 戻り値は自分で生成するなら True、実行中の診断に任せるなら False
+def acquire_or_join_inflight(user_id, json_key, join=True):
+    for _ in range(3):
+        if acquire_inflight(user_id, json_key):
+            return True
+        if not join or join_inflight(user_id, json_key):
+            return False
+        # 合流する前に実行中の診断が終わった。もう一度マーカーを取る
+    return True
+
+# 実行中マーカーを外す（別の集計の診断に置き換わっていればそのまま）
+# 戻り値は、実行中に合流した依頼があり結果をLINEに送る必要があるか
+def release_inflight(user_id, json_key):
+    old = update_user(
+        user_id,
+        remove=("fp_inflight_path", "fp_inflight_until", "fp_inflight_notify"),
+        condition="fp_inflight_path = :path",
+        condition_values={":path": json_key},
+        return_values="ALL_OLD"
+    )
+    return bool((old or {}).get("fp_inflight_notify"))
 
 # LINE通知関数をInvoke
 def invoke_line_notifier(user_id, message):
-    lambda_client = boto3.client("lambda")
+    lambda_client = get_client("lambda")
     payload = {
         "userId": user_id,
         "message": message
     }
-    lambda_client.invoke(
-        FunctionName="line_notifier",
-        InvocationType="Event",
-        Payload=json.dumps(payload).encode("utf-8")
-    )
+    with timed("LambdaInvoke", target="line_notifier"):
+        lambda_client.invoke(
+            FunctionName="line_notifier",
+            InvocationType="Event",
+            Payload=json.dumps(traced_payload(payload)).encode("utf-8")
+        )
 
+@traced("fp_comment_from_summary")
 def lambda_handler(event, context):
     try:
-        print("[DEBUG] event:", event)
+        log_event(event)
         user_id = event.get("user_id")
         if not user_id:
             raise ValueError("user_id が渡されていません。")
+        # 集計直後の先行生成（キャッシュに保存するだけで、LINEには送らない）
+        precompute = event.get("precompute") is True
 
-        # DynamoDBからjson_pathを取得
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(os.environ["DYNAMODB_TABLE_NAME"])
-        response = table.get_item(Key={"userId": user_id})
-
-        if "Item" not in response or "json_path" not in response["Item"]:
-            raise ValueError("対象の JSON パスが見つかりません。")
-
-        json_key = response["Item"]["json_path"]
         bucket = os.environ["S3_BUCKET_NAME"]
+        summary_json, json_key = load_summary(user_id, bucket)
 
-        print(f"[INFO] ユーザー: {user_id}, JSONキー: {json_key}")
-
-        # S3からJSONファイル取得
-        s3 = boto3.client("s3")
-        obj = s3.get_object(Bucket=bucket, Key=json_key)
-        content = obj["Body"].read().decode("utf-8")
-        summary_json = json.loads(content)
+        # 同じ集計の診断が実行中なら、その診断が結果を送るので何もしない
+        if not acquire_or_join_inflight(user_id, json_key, join=not precompute):
+            print(f"[INFO] 実行中の家計診断に合流しました: {user_id}, {json_key}")
+            return {
+                "statusCode": 202,
+                "body": json.dumps({"message": "実行中の家計診断があります"}, ensure_ascii=False)
+            }
 
-        # FPコメント生成
-        comment = generate_fp_comment(summary_json)
+        comment = None
+        try:
+            # FPコメント生成（同じ集計内容ならキャッシュから返す）
+            comment = get_or_generate_fp_comment(summary_json, bucket)
+        finally:
+            notify_requested = release_inflight(user_id, json_key)
+            # 生成に失敗しても、結果を待っている依頼（合流した依頼を含む）には失敗を知らせる
+            if comment is None and (notify_requested or not precompute):
+                invoke_line_notifier(user_id, "コメント生成エラー: 家計診断を作成できませんでした。もう一度お試しください。")
 
-        # LINE通知
-        invoke_line_notifier(user_id, comment)
+        # LINE通知（先行生成の途中に依頼が来ていれば、ここで結果を送る）
+        if not precompute or notify_requested:
+            invoke_line_notifier(user_id, comment)
 
         print("📝 FPコメント生成:", comment)
 
@@ -1,46 +1,84 @@
+import html
 import json
-import boto3
 import os
+import re
 import uuid
 from datetime import datetime
+from clients import get_client
+from metrics import log_event, timed
+from tracing import current_trace_id, traced, traced_payload
+from user_repository import update_user
+
+# S3オブジェクトに userId を持たせるメタデータ項目
+USER_ID_METADATA_FIELD = "x-amz-meta-user-id"
+# アップロードから集計までを追跡するトレースID
+TRACE_ID_METADATA_FIELD = "x-amz-meta-trace-id"
+# アップロードできるファイルサイズの上限（バイト）
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# ブラウザで gzip 圧縮したCSVは、キーの末尾に .gz を付けてアップロードする
+GZIP_SUFFIX = ".gz"
+# LINE の userId（"U" + 16進数32桁）。クエリ文字列から受け取るので、この形以外は署名もページ表示もしない
+LINE_USER_ID_PATTERN = re.compile(r"U[0-9a-f]{32}")
+
+def is_line_user_id(user_id):
+    return isinstance(user_id, str) and LINE_USER_ID_PATTERN.fullmatch(user_id) is not None
 
 def notify_user_upload_url(user_id):
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_client('lambda')
     upload_page_url = f"https://{os.environ['API_GATEWAY_DOMAIN']}/prod/upload?user_id={user_id}"
     payload = {
         "userId": user_id,
         "message": f"🧾 CSVファイルはこちらからアップロードしてください！\n\n{upload_page_url}"
     }
-    lambda_client.invoke(
-        FunctionName="line_notifier",
-        InvocationType="Event",  # 非同期
-        Payload=json.dumps(payload).encode("utf-8")
-    )
+    with timed("LambdaInvoke", target="line_notifier"):
+        lambda_client.invoke(
+            FunctionName="line_notifier",
+            InvocationType="Event",  # 非同期
+            Payload=json.dumps(traced_payload(payload)).encode("utf-8")
+        )
 
 
+# userId をオブジェクトのメタデータに埋め込み、集計側でテーブルを探さずに済むようにする
+def presign_upload(s3, bucket_name, object_key, content_type, user_id, trace_id):
+    return s3.generate_presigned_post(
+        Bucket=bucket_name,
+        Key=object_key,
+        Fields={"Content-Type": content_type, USER_ID_METADATA_FIELD: user_id, TRACE_ID_METADATA_FIELD: trace_id},
+        Conditions=[
+            {"Content-Type": content_type},
+            {USER_ID_METADATA_FIELD: user_id},
+            {TRACE_ID_METADATA_FIELD: trace_id},
+            ["content-length-range", 1, MAX_UPLOAD_BYTES]
+        ],
+        ExpiresIn=3600
+    )
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
+# <script> に埋め込むJSON。</script> や <!-- で抜け出せないよう < > & をエスケープする
+def script_json(value):
+    return json.dumps(value).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
 
+# csv_path だけを書き換える（前回の集計の json_path は新しい集計ができるまで残す）
 def save_user_csv_path(user_id, csv_key):
-    table.put_item(
-        Item={
-            'userId': user_id,
-            'csv_path': csv_key,
-            'created_at': datetime.utcnow().isoformat() + "Z"
-        }
-    )
+    update_user(user_id, {
+        'csv_path': csv_key,
+        'created_at': datetime.utcnow().isoformat() + "Z"
+    })
 
+@traced("generatePresignedUrl")
 def lambda_handler(event, context):
     try:
-        print("[DEBUG] event:", json.dumps(event))
+        log_event(event)
 
         # LINE Webhook形式の判定
         #is_line_webhook = "body" in event and event["body"] and "events" in json.loads(event["body"])
-        user_id = event.get("queryStringParameters", {}).get("user_id")
+        user_id = (event.get("queryStringParameters") or {}).get("user_id")
+        if not is_line_user_id(user_id):
+            print(f"[WARN] 不正な user_id: {user_id!r}")
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": "user_idが不正です"}, ensure_ascii=False)
+            }
         is_from_line_webhook = event.get("is_from_webhook", False) is True
-        print(is_from_line_webhook)
-        print(user_id)
         if is_from_line_webhook:
             # LINEのWebhookイベントからuserIdを取得
             #body = json.loads(event["body"])
@@ -56,25 +94,27 @@ def lambda_handler(event, context):
             }
 
         # Webhookでなければブラウザアクセス（署名付きURL & HTMLフォームを返す）
-        s3 = boto3.client('s3')
+        s3 = get_client('s3')
         bucket_name = os.environ['BUCKET_NAME']
         unique_id = str(uuid.uuid4())[:8]
         object_key = f"uploads/moneyforward_{unique_id}.csv"
+        trace_id = current_trace_id()
 
-        presigned_url = s3.generate_presigned_post(
-            Bucket=bucket_name,
-            Key=object_key,
-            Fields={"Content-Type": "text/csv"},
-            Conditions=[{"Content-Type": "text/csv"}],
-            ExpiresIn=3600
-        )
+        # 非圧縮のCSVと、ブラウザで gzip 圧縮したCSVの2通りの署名付きPOSTを発行する
+        with timed("S3Presign"):
+            presigned_url = presign_upload(s3, bucket_name, object_key, "text/csv", user_id, trace_id)
+            presigned_gzip = presign_upload(s3, bucket_name, object_key + GZIP_SUFFIX, "application/gzip", user_id, trace_id)
 
         # LINEユーザIDとCSVファイルパスをDynamoDBに登録
         save_user_csv_path(user_id, object_key)
 
         html_fields = "\n".join(
-            [f'<input type="hidden" name="{k}" value="{v}">' for k, v in presigned_url['fields'].items()]
+            [f'<input type="hidden" name="{html.escape(k, quote=True)}" value="{html.escape(v, quote=True)}">'
+             for k, v in presigned_url['fields'].items()]
         )
+        form_action = html.escape(presigned_url['url'], quote=True)
+        # 圧縮してアップロードする場合に差し替えるフィールド
+        gzip_fields_json = script_json(presigned_gzip['fields'])
         
         html_body = f"""
         <!DOCTYPE html>
@@ -136,7 +176,7 @@ def lambda_handler(event, context):
         <body>
             <div class="container">
                 <h2>📄 CSVファイルをアップロードしてください</h2>
-                <form id="upload-form" action="{presigned_url['url']}" method="post" enctype="multipart/form-data" target="hidden-frame" onsubmit="handleSubmit()">
+                <form id="upload-form" action="{form_action}" method="post" enctype="multipart/form-data" target="hidden-frame" onsubmit="return handleSubmit(event)">
                     {html_fields}
                     <input type="file" name="file" accept=".csv" required />
                     <br><br>
@@ -150,9 +190,42 @@ def lambda_handler(event, context):
         
             <script>
                 let isSubmitting = false;
+                const gzipFields = {gzip_fields_json};
+        
+                // 対応ブラウザでは CompressionStream で gzip 圧縮してから送信する
+                async function compressFile(file) {{
+                    const stream = file.stream().pipeThrough(new CompressionStream('gzip'));
+                    const blob = await new Response(stream).blob();
+                    return new File([blob], file.name + '.gz', {{ type: 'application/gzip' }});
+                }}
         
-                function handleSubmit() {{
+                async function submitCompressed(form) {{
+                    const input = form.querySelector('input[type="file"]');
+                    try {{
+                        const compressed = await compressFile(input.files[0]);
+                        const files = new DataTransfer();
+                        files.items.add(compressed);
+                        input.files = files.files;
+                        for (const [name, value] of Object.entries(gzipFields)) {{
+                            form.querySelector(`input[name="${{name}}"]`).value = value;
+                        }}
+                    }} catch (e) {{
+                        // 圧縮できなければそのままアップロードする
+                        console.warn('gzip圧縮に失敗しました', e);
+                    }}
                     isSubmitting = true;
+                    form.submit();
+                }}
+        
+                function handleSubmit(event) {{
+                    const form = event.target;
+                    if (typeof CompressionStream === 'undefined' || typeof DataTransfer === 'undefined') {{
+                        isSubmitting = true;
+                        return true;
+                    }}
+                    event.preventDefault();
+                    submitCompressed(form);
+                    return false;
                 }}
         
                 function handleUploadComplete() {{
@@ -1,46 +1,159 @@
 import os
 import json
+import random
+import time
+import uuid
 import requests
+from clients import get_http_session
+from metrics import timed
+from tracing import traced
 
 # LINEチャネルアクセストークン（環境変数で管理）
 LINE_CHANNEL_TOKEN = os.environ.get("LINE_CHANNEL_TOKEN")
 LINE_API_URL = "https://api.line.me/v2/bot/message/push"
+LINE_MULTICAST_API_URL = "https://api.line.me/v2/bot/message/multicast"
+LINE_API_TIMEOUT = 10
 
-def lambda_handler(event, context):
-    # イベントから userId と message を受け取る
-    user_id = event.get("userId")
-    message = event.get("message")
+# LINE Messaging API の上限
+MULTICAST_MAX_RECIPIENTS = 500
+MAX_MESSAGES_PER_REQUEST = 5
+MAX_TEXT_LENGTH = 5000
 
-    if not user_id or not message:
-        return {
-            "statusCode": 400,
-            "body": json.dumps({"error": "userIdとmessageが必要です"})
-        }
+# 429 / 5xx のリトライ設定（指数バックオフ）
+MAX_RETRIES = int(os.environ.get("LINE_MAX_RETRIES", "5"))
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# 1回の実行でリトライの待ちに使える合計秒数（超えるリトライはせず、その宛先を失敗にする）
+RETRY_BUDGET_SECONDS = float(os.environ.get("LINE_RETRY_BUDGET_SECONDS", "20"))
+
+# 長いメッセージを5000文字以内に分割（できるだけ改行位置で区切る）
+def split_text(message, limit=MAX_TEXT_LENGTH):
+    chunks = []
+    while len(message) > limit:
+        cut = message.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(message[:cut])
+        message = message[cut:].lstrip("\n")
+    if message:
+        chunks.append(message)
+    return chunks
+
+# 1リクエストあたり最大5件のメッセージオブジェクトに分ける
+def build_message_batches(message):
+    messages = [{"type": "text", "text": chunk} for chunk in split_text(message)]
+    return [messages[i:i + MAX_MESSAGES_PER_REQUEST] for i in range(0, len(messages), MAX_MESSAGES_PER_REQUEST)]
+
+# 同じメッセージの宛先をまとめる（メッセージ -> 重複なしの userId リスト）
+def group_deliveries(deliveries):
+    groups = {}
+    for delivery in deliveries:
+        # dict のキー順で宛先の順序を保ったまま重複を除く
+        groups.setdefault(delivery["message"], {})[delivery["userId"]] = None
+    return {message: list(recipients) for message, recipients in groups.items()}
+
+def retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    return min(RETRY_BASE_SECONDS * (2 ** attempt), RETRY_MAX_SECONDS) * random.uniform(0.5, 1.0)
 
+# LINE API に送信し、429 / 5xx / 通信エラーはバックオフしてリトライする
+# deadline（time.monotonic() の値）までに待ち終わらないリトライはせず、最後のエラーを送出する
+def post_with_retry(url, body, deadline=None):
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_TOKEN}"
+        "Authorization": f"Bearer {LINE_CHANNEL_TOKEN}",
+        # 同じキーでリトライすればLINE側で重複送信されない
+        "X-Line-Retry-Key": str(uuid.uuid4())
     }
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            with timed("LineApi", endpoint=url.rsplit("/", 1)[-1]) as m:
+                response = get_http_session().post(url, headers=headers, json=body, timeout=LINE_API_TIMEOUT)
+                m["Items"] = len(body["to"]) if isinstance(body["to"], list) else 1
+        except requests.exceptions.RequestException as e:
+            delay = retry_delay(None, attempt)
+            if attempt == MAX_RETRIES or (deadline is not None and time.monotonic() + delay > deadline):
+                raise
+            print(f"[WARN] LINE API 通信エラー: {e}")
+        else:
+            # 409 はリトライキーで既に受け付け済み
+            if response.status_code == 409 and response.headers.get("X-Line-Accepted-Request-Id"):
+                return response
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                response.raise_for_status()
+                return response
+            delay = retry_delay(response, attempt)
+            if attempt == MAX_RETRIES or (deadline is not None and time.monotonic() + delay > deadline):
+                response.raise_for_status()
+                return response
+            print(f"[WARN] LINE API {response.status_code}: リトライします ({attempt + 1}/{MAX_RETRIES})")
+        time.sleep(delay)
 
-    body = {
-        "to": user_id,
-        "messages": [
-            {
-                "type": "text",
-                "text": message
-            }
-        ]
-    }
+# 宛先リストにメッセージを送る（1人ならpush、複数ならmulticastで最大500人ずつ）
+# 戻り値は (送れた userId のリスト, 送れなかった {"userId", "error"} のリスト, リクエスト数)
+# 宛先のまとまりごとに送り、失敗したまとまりには残りのメッセージを送らない
+def send_message(recipients, message, deadline=None):
+    sent = []
+    failed = []
+    sent_requests = 0
+    batches = build_message_batches(message)
+    for i in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+        chunk = recipients[i:i + MULTICAST_MAX_RECIPIENTS]
+        try:
+            for messages in batches:
+                if len(chunk) == 1:
+                    post_with_retry(LINE_API_URL, {"to": chunk[0], "messages": messages}, deadline)
+                else:
+                    post_with_retry(LINE_MULTICAST_API_URL, {"to": chunk, "messages": messages}, deadline)
+                sent_requests += 1
+        except requests.exceptions.RequestException as e:
+            print(f"[ERROR] LINE送信失敗 ({len(chunk)} 人): {e}")
+            failed.extend({"userId": user_id, "error": str(e)} for user_id in chunk)
+        else:
+            sent.extend(chunk)
+    return sent, failed, sent_requests
+
+# (userId, message) の一覧をまとめて配信する
+def deliver(deliveries):
+    deadline = time.monotonic() + RETRY_BUDGET_SECONDS
+    sent = []
+    failed = []
+    requests_count = 0
+    for message, recipients in group_deliveries(deliveries).items():
+        message_sent, message_failed, message_requests = send_message(recipients, message, deadline)
+        sent.extend(message_sent)
+        failed.extend(message_failed)
+        requests_count += message_requests
+    print(f"[INFO] LINE送信: {len(sent)} 件 / {requests_count} リクエスト, 失敗 {len(failed)} 件")
+    return {"sent": len(sent), "requests": requests_count, "failed": failed}
+
+@traced("line_notifier")
+def lambda_handler(event, context):
+    # イベントから userId と message を受け取る（deliveries で複数件をまとめて受け取ることも可能）
+    deliveries = event.get("deliveries")
+    if deliveries is None:
+        deliveries = [{"userId": event.get("userId"), "message": event.get("message")}]
 
-    try:
-        response = requests.post(LINE_API_URL, headers=headers, json=body)
-        response.raise_for_status()
+    if not deliveries or any(not d.get("userId") or not d.get("message") for d in deliveries):
         return {
-            "statusCode": 200,
-            "body": json.dumps({"result": "Message sent!"})
+            "statusCode": 400,
+            "body": json.dumps({"error": "userIdとmessageが必要です"})
         }
-    except requests.exceptions.RequestException as e:
+
+    result = deliver(deliveries)
+    if result["failed"]:
         return {
             "statusCode": 500,
-            "body": json.dumps({"error": str(e)})
+            "body": json.dumps({"error": "一部のメッセージを送信できませんでした", **result}, ensure_ascii=False)
         }
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"result": "Message sent!", **result})
+    }
@@ -1,80 +1,123 @@
 import json
-import boto3
 import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from clients import get_client
+from metrics import log_event, timed
+from tracing import traced, traced_payload
+from user_repository import create_user
 
 # 定数定義（対象メッセージなど）
 UPLOAD_TRIGGER_TEXT = "家計ファイルをアップロードしたい"
 FP_REQUEST_TEXT = "家計診断をお願いします"
 LAMBDA_UPLOAD = "generatePresignedUrl"
 LAMBDA_FP_COMMENT = "fp_comment_from_summary"
-
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
+# 設定されていれば、家計診断の依頼はSQSに積み、diagnosis_worker でまとめて処理する
+FP_REQUEST_QUEUE_URL = os.environ.get("FP_REQUEST_QUEUE_URL")
+# SQS の send_message_batch で一度に送れる件数
+SQS_BATCH_SIZE = 10
+# 1回のWebhookで並列に処理する最大数
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "16"))
 
 def invoke_presign_url_function(user_id):
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_client('lambda')
     payload = {
         "is_from_webhook": True,
         "queryStringParameters": {
             "user_id": user_id
         }
     }
-    lambda_client.invoke(
-        FunctionName=LAMBDA_UPLOAD,
-        InvocationType="Event",
-        Payload=json.dumps(payload).encode("utf-8")
-    )
+    with timed("LambdaInvoke", target=LAMBDA_UPLOAD):
+        lambda_client.invoke(
+            FunctionName=LAMBDA_UPLOAD,
+            InvocationType="Event",
+            Payload=json.dumps(traced_payload(payload)).encode("utf-8")
+        )
 
 def invoke_fp_comment_function(user_id):
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_client('lambda')
     payload = {
             "user_id": user_id
     }
-    lambda_client.invoke(
-        FunctionName=LAMBDA_FP_COMMENT,
-        InvocationType="Event",
-        Payload=json.dumps(payload).encode("utf-8")
-    )
+    with timed("LambdaInvoke", target=LAMBDA_FP_COMMENT):
+        lambda_client.invoke(
+            FunctionName=LAMBDA_FP_COMMENT,
+            InvocationType="Event",
+            Payload=json.dumps(traced_payload(payload)).encode("utf-8")
+        )
 
-def lambda_handler(event, context):
-    try:
-        print("[DEBUG] event:", event)
-        body = json.loads(event.get("body", "{}"))
-        events = body.get("events", [])
+def enqueue_fp_requests(user_ids):
+    sqs = get_client('sqs')
+    for start in range(0, len(user_ids), SQS_BATCH_SIZE):
+        entries = [
+            {"Id": str(i), "MessageBody": json.dumps(traced_payload({"user_id": user_id}))}
+            for i, user_id in enumerate(user_ids[start:start + SQS_BATCH_SIZE])
+        ]
+        with timed("SQSSend") as m:
+            m["Items"] = len(entries)
+            response = sqs.send_message_batch(QueueUrl=FP_REQUEST_QUEUE_URL, Entries=entries)
+        if response.get("Failed"):
+            raise RuntimeError(f"家計診断の依頼をキューに積めませんでした: {response['Failed']}")
 
-        for e in events:
-            if e.get("type") != "message":
-                print(f"[INFO] 対応しないイベントタイプ: {e.get('type')}")
-                continue
+# 未登録なら登録する（読み込みなしの条件付き書き込み）
+def register_user(user_id):
+    if create_user(user_id):
+        print(f"[INFO] 新規登録完了: {user_id}")
+    else:
+        print(f"[INFO] すでに登録済みの userId: {user_id}")
 
-            user_id = e.get("source", {}).get("userId")
-            message_text = e.get("message", {}).get("text", "").strip()
+# Webhookのイベント一覧から、要求ごとに重複を除いた userId を集める
+def collect_requests(events):
+    upload_users = {}
+    fp_users = {}
+    for e in events:
+        if e.get("type") != "message":
+            print(f"[INFO] 対応しないイベントタイプ: {e.get('type')}")
+            continue
 
-            if not user_id:
-                print("[WARN] userId が取得できませんでした")
-                continue
+        user_id = e.get("source", {}).get("userId")
+        message_text = e.get("message", {}).get("text", "").strip()
 
-            print(f"[INFO] ユーザーIDを取得: {user_id}")
-            print(f"[INFO] 受信メッセージ: {message_text}")
+        if not user_id:
+            print("[WARN] userId が取得できませんでした")
+            continue
 
-            if message_text == UPLOAD_TRIGGER_TEXT:
-                print("[INFO] アップロード要求検出 → Presign URL 発行")
-                invoke_presign_url_function(user_id)
+        print(f"[INFO] ユーザーIDを取得: {user_id}")
+        print(f"[INFO] 受信メッセージ: {message_text}")
 
-                # DynamoDB登録（重複チェック付き）
-                response = table.get_item(Key={"userId": user_id})
-                if "Item" in response:
-                    print(f"[INFO] すでに登録済みの userId: {user_id}")
-                else:
-                    table.put_item(Item={"userId": user_id})
-                    print(f"[INFO] 新規登録完了: {user_id}")
+        if message_text == UPLOAD_TRIGGER_TEXT:
+            print("[INFO] アップロード要求検出 → Presign URL 発行")
+            upload_users[user_id] = None
+        elif message_text == FP_REQUEST_TEXT:
+            print("[INFO] 家計診断要求を検出 → FPコメント関数をInvoke")
+            fp_users[user_id] = None
+        else:
+            print(f"[INFO] 未対応のメッセージ内容: {message_text}")
+    return list(upload_users), list(fp_users)
+
+@traced("line_userid_catcher")
+def lambda_handler(event, context):
+    try:
+        log_event(event)
+        body = json.loads(event.get("body", "{}"))
+        events = body.get("events", [])
 
-            elif message_text == FP_REQUEST_TEXT:
-                print("[INFO] 家計診断要求を検出 → FPコメント関数をInvoke")
-                invoke_fp_comment_function(user_id)
+        upload_users, fp_users = collect_requests(events)
 
-            else:
-                print(f"[INFO] 未対応のメッセージ内容: {message_text}")
+        # Presign URL 発行・DynamoDB登録・FPコメントのInvokeを並列に実行する
+        tasks = [(invoke_presign_url_function, user_id) for user_id in upload_users]
+        tasks += [(register_user, user_id) for user_id in upload_users]
+        if FP_REQUEST_QUEUE_URL:
+            if fp_users:
+                tasks.append((enqueue_fp_requests, fp_users))
+        else:
+            tasks += [(invoke_fp_comment_function, user_id) for user_id in fp_users]
+        if tasks:
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(tasks))) as executor:
+                # トレースIDを引き継ぐため、呼び出し元のコンテキストで実行する
+                futures = [executor.submit(contextvars.copy_context().run, func, arg) for func, arg in tasks]
+                for future in futures:
+                    future.result()
 
         return {
             "statusCode": 200,
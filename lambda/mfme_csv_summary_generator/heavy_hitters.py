@@ -0,0 +1,35 @@
+# Space-Saving による上位の項目（店名ごとの支出額・回数）の推定
+# 項目 -> [推定値, 誤差の上限] を最大 capacity 件だけ持つため、取引がいくら増えても大きさは一定
+#   推定値は実際の値以上で、差は誤差の上限以下。capacity 件に収まっている間は誤差 0（正確な値）
+# 取り込むたびに、その分の正確な合計からスケッチを作って既存のスケッチにマージする
+# （途中集計 state/ にそのまま保存できるJSONの dict）
+import os
+
+# 月ごとに持つ店の数
+TOP_MERCHANTS_CAPACITY = int(os.environ.get('TOP_MERCHANTS_CAPACITY', '50'))
+
+# 値の大きい順（同じ値なら名前順）に capacity 件だけ残す
+def _truncate(sketch, capacity):
+    if len(sketch) <= capacity:
+        return sketch
+    return dict(sorted(sketch.items(), key=lambda kv: (-kv[1][0], kv[0]))[:capacity])
+
+# 正確な合計（項目 -> 値）からスケッチを作る（上位 capacity 件。残りの項目は最小の値以下）
+def sketch_from_totals(totals, capacity=TOP_MERCHANTS_CAPACITY):
+    return _truncate({item: [value, 0] for item, value in totals.items() if value > 0}, capacity)
+
+# 2つのスケッチのマージ。満杯のスケッチにない項目は、そのスケッチの最小値を値・誤差の上限とみなす
+def sketch_merge(a, b, capacity=TOP_MERCHANTS_CAPACITY):
+    floor_a = min(value for value, _ in a.values()) if len(a) >= capacity else 0
+    floor_b = min(value for value, _ in b.values()) if len(b) >= capacity else 0
+    merged = {}
+    for item in a.keys() | b.keys():
+        value_a, error_a = a.get(item, (floor_a, floor_a))
+        value_b, error_b = b.get(item, (floor_b, floor_b))
+        merged[item] = [value_a + value_b, error_a + error_b]
+    return _truncate(merged, capacity)
+
+# 上位 count 件の (項目, 推定値, 誤差の上限)。値の大きい順、同じ値なら名前順
+def sketch_top(sketch, count):
+    ranked = sorted(sketch.items(), key=lambda kv: (-kv[1][0], kv[0]))
+    return [(item, value, error) for item, (value, error) in ranked[:count]]
@@ -1,24 +1,139 @@
 import csv
-import boto3
 import os
 import json
 import csv
 import io
+import codecs
+import contextvars
+import itertools
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from collections import defaultdict
-from openai import OpenAI
-
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+from functools import lru_cache
+from clients import get_client, get_openai_client
+from heavy_hitters import TOP_MERCHANTS_CAPACITY, sketch_from_totals, sketch_merge, sketch_top
+from merchant_index import build_merchant_index, lookup_merchant, merchant_name
+from summary_analytics import build_analytics
+import numpy_backend
+from transaction_store import collect_transactions, occurrence_key, write_transactions
+from metrics import log_event, timed
+from tracing import bind_trace_id, traced, traced_payload
+from user_repository import find_user_id_by_csv_path, update_user
+
+# アップロード時に付与される userId のS3メタデータキー（x-amz-meta-user-id）
+USER_ID_METADATA_KEY = "user-id"
+TRACE_ID_METADATA_KEY = "trace-id"
+
+# 集計JSONの形式・集計ロジックを変えたら上げる（古い出力は tools/backfill_summaries.py で作り直す）
+SUMMARY_VERSION = "3"
+SUMMARY_VERSION_METADATA_KEY = "summary-version"
+
+# ユーザーごとの途中集計の保存先
+USER_STATE_PREFIX = os.environ.get('USER_STATE_PREFIX', 'state/')
+USER_STATE_VERSION = 2
+# 取り込み済みの取引を覚えておく月数（最新の月から数える）
+# これより古い月は締めたものとし、すでに集計にある月の行は読み飛ばす（途中集計の大きさを一定に保つ）
+SEEN_IDS_MONTHS = int(os.environ.get('SEEN_IDS_MONTHS', '24'))
+USER_STATE_MAX_RETRIES = 3
+# 取り込み済みとして覚えておくCSVのETag（S3イベントの重複・同じCSVの再アップロードを飛ばす）の数
+PROCESSED_ETAGS_MAX = 100
+# userId のないアップロードの集計結果を、CSVの内容（ETag）をキーに保存する
+CONTENT_SUMMARY_PREFIX = os.environ.get('CONTENT_SUMMARY_PREFIX', 'summaries/by_content/')
+
+# 集計JSONに出す月ごとの上位の店の数
+TOP_MERCHANTS_COUNT = int(os.environ.get('TOP_MERCHANTS_COUNT', '10'))
+# 上位の店の集計中に、1か月あたり正確な合計を持っておく店の数（超えたら途中でスケッチにマージする）
+TOP_MERCHANTS_PENDING_MAX = 1000
+
+# 集計の実装（python: 1行ずつ加算 / numpy: 列の配列でまとめて計算。numpy がなければ python）
+SUMMARY_BACKEND = os.environ.get('SUMMARY_BACKEND', 'python').lower()
+if SUMMARY_BACKEND == 'numpy' and not numpy_backend.is_available():
+    print("[WARN] numpy がインストールされていないため、python の集計を使います")
+    SUMMARY_BACKEND = 'python'
+
+# 集計後に FPコメントを先行生成しておく（家計診断の依頼時はキャッシュから返せる）
+FP_PRECOMPUTE = os.environ.get('FP_PRECOMPUTE', 'true').lower() == 'true'
+LAMBDA_FP_COMMENT = "fp_comment_from_summary"
+
+# 正規化した取引を transactions/{userId}/{YYYY-MM}.bin にも保存する
+WRITE_TRANSACTION_STORE = os.environ.get('WRITE_TRANSACTION_STORE', 'true').lower() == 'true'
+
+# 1回の起動で届いた複数のCSV（S3イベント・SQSのバッチ）を並列に集計する数
+RECORD_MAX_WORKERS = int(os.environ.get('RECORD_MAX_WORKERS', '4'))
+
+# 未分類の行をGPTで補完するか
+ENRICH_UNCLASSIFIED = os.environ.get('ENRICH_UNCLASSIFIED', 'false').lower() == 'true'
 
 # マネーフォワードMEのデフォルトカテゴリ
 DEFAULT_MAIN_CATEGORIES = ["食費", "日用品", "趣味・娯楽", "交際費", "交通費", "衣服・美容", "健康・医療", "自動車", "教養・教育", "住まい", "水道・光熱費", "通信費", "保険", "税金", "現金・カード", "その他"]
 DEFAULT_SUB_CATEGORIES = ["外食", "食料品", "コンビニ", "ドラッグストア", "本", "映画・音楽", "旅行", "交際", "電車", "ガソリン", "衣服", "美容院", "病院", "歯医者", "学費", "家賃", "電気代", "水道代", "スマホ", "インターネット", "生命保険", "住民税", "現金引き出し", "クレジットカード", "未分類"]
 
-def classify_with_gpt(text):
+# GPT分類の設定
+CLASSIFY_MODEL = "gpt-3.5-turbo"
+CLASSIFY_BATCH_SIZE = int(os.environ.get('CLASSIFY_BATCH_SIZE', '50'))
+CLASSIFY_MAX_WORKERS = int(os.environ.get('CLASSIFY_MAX_WORKERS', '4'))
+# 内容 -> (大項目, 中項目) の分類キャッシュ（S3に永続化）
+CLASSIFICATION_CACHE_KEY = os.environ.get('CLASSIFICATION_CACHE_KEY', 'cache/classification_cache.json')
+CLASSIFICATION_CACHE_MAX_ENTRIES = int(os.environ.get('CLASSIFICATION_CACHE_MAX_ENTRIES', '20000'))
+
+# 最近使った順に並べたキャッシュ。上限を超えたら古いものから捨てる
+_classification_cache = OrderedDict()
+_classification_cache_loaded = False
+_classification_cache_dirty = False
+_classification_cache_lock = threading.Lock()
+
+def get_cached_classification(memo):
+    with _classification_cache_lock:
+        categories = _classification_cache.get(memo)
+        if categories is not None:
+            _classification_cache.move_to_end(memo)
+        return categories
+
+def put_cached_classification(memo, categories):
+    global _classification_cache_dirty
+    with _classification_cache_lock:
+        _classification_cache[memo] = tuple(categories)
+        _classification_cache.move_to_end(memo)
+        while len(_classification_cache) > CLASSIFICATION_CACHE_MAX_ENTRIES:
+            _classification_cache.popitem(last=False)
+        _classification_cache_dirty = True
+
+def load_classification_cache(bucket):
+    global _classification_cache_loaded
+    # ウォームスタート時はメモリ上のキャッシュをそのまま使う
+    if _classification_cache_loaded:
+        return
+    s3 = get_client('s3')
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=CLASSIFICATION_CACHE_KEY)
+        entries = json.loads(obj['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        entries = []
+    with _classification_cache_lock:
+        for memo, main, sub in entries:
+            _classification_cache.setdefault(memo, (main, sub))
+    _classification_cache_loaded = True
+    print(f"[分類キャッシュ] {len(entries)} 件を読み込みました")
+
+def save_classification_cache(bucket):
+    global _classification_cache_dirty
+    if not _classification_cache_dirty:
+        return
+    with _classification_cache_lock:
+        entries = [[memo, main, sub] for memo, (main, sub) in _classification_cache.items()]
+        _classification_cache_dirty = False
+    write_json_to_s3(entries, bucket, CLASSIFICATION_CACHE_KEY)
+
+# 複数の内容をまとめて1リクエストで分類する。戻り値は 内容 -> (大項目, 中項目)
+def classify_batch_with_gpt(memos):
+    items = "\n".join(f"{i}: {memo}" for i, memo in enumerate(memos))
     prompt = f"""
-以下の内容に対して、もっとも適切な「大項目」と「中項目」をマネーフォワードMEのカテゴリから選んでください。
+以下の各内容に対して、もっとも適切な「大項目」と「中項目」をマネーフォワードMEのカテゴリから選んでください。
 
-内容: {text}
+内容（番号: 内容）:
+{items}
 
 【大項目候補】:
 {", ".join(DEFAULT_MAIN_CATEGORIES)}
@@ -26,129 +141,398 @@ def classify_with_gpt(text):
 【中項目候補】:
 {", ".join(DEFAULT_SUB_CATEGORIES)}
 
-フォーマット:
-大項目: <カテゴリ名>
-中項目: <カテゴリ名>
+フォーマット（JSONのみ）:
+{{"results": [{{"id": <番号>, "大項目": "<カテゴリ名>", "中項目": "<カテゴリ名>"}}]}}
 """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+    with timed("OpenAI", model=CLASSIFY_MODEL) as m:
+        response = get_openai_client().chat.completions.create(
+            model=CLASSIFY_MODEL,
+            response_format={"type": "json_object"},
             messages=[
                 {"role": "user", "content": prompt}
             ]
         )
-        content = response.choices[0].message.content.strip()
-
-        main = sub = "未分類"
-        for line in content.splitlines():
-            if line.startswith("大項目:"):
-                main = line.split(":", 1)[1].strip()
-            elif line.startswith("中項目:"):
-                sub = line.split(":", 1)[1].strip()
-        return main, sub
-    except Exception as e:
-        print(f"分類エラー: {str(e)}")
-        return "未分類", "未分類"
+        m["Items"] = len(memos)
+        m["PromptTokens"] = response.usage.prompt_tokens
+        m["CompletionTokens"] = response.usage.completion_tokens
+    content = json.loads(response.choices[0].message.content)
+
+    # 候補にあるカテゴリの回答だけを返す（欠けた・候補外の回答は含めない）
+    classified = {}
+    for result in content.get("results", []):
+        try:
+            memo = memos[int(result["id"])]
+        except (KeyError, TypeError, ValueError, IndexError):
+            continue
+        main, sub = result.get("大項目"), result.get("中項目")
+        if main in DEFAULT_MAIN_CATEGORIES and sub in DEFAULT_SUB_CATEGORIES:
+            classified[memo] = (main, sub)
+        else:
+            print(f"[WARN] 候補にないカテゴリの回答を無視しました: {memo} -> {main}/{sub}")
+    return classified
+
+# 内容を重複排除し、キャッシュにないものだけをバッチ並列でGPTに分類させる
+def classify_memos(memos):
+    results = {}
+    misses = []
+    for memo in dict.fromkeys(memos):
+        categories = get_cached_classification(memo)
+        if categories is not None:
+            results[memo] = categories
+        else:
+            misses.append(memo)
+
+    batches = [misses[i:i + CLASSIFY_BATCH_SIZE] for i in range(0, len(misses), CLASSIFY_BATCH_SIZE)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=CLASSIFY_MAX_WORKERS) as executor:
+            futures = {executor.submit(classify_batch_with_gpt, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    classified = future.result()
+                except Exception as e:
+                    print(f"分類エラー: {str(e)}")
+                    classified = {}
+                # GPTが有効なカテゴリを答えた内容だけをキャッシュする
+                for memo, categories in classified.items():
+                    put_cached_classification(memo, categories)
+                # 失敗・回答の欠けた内容は未分類とし、キャッシュせず次回に再分類する
+                for memo in futures[future]:
+                    results[memo] = classified.get(memo, ("未分類", "未分類"))
+
+    print(f"[分類] 内容 {len(results)} 件（キャッシュ {len(results) - len(misses)} 件, GPT {len(misses)} 件 / {len(batches)} リクエスト）")
+    return results
+
+def classify_with_gpt(text):
+    return classify_memos([text])[text]
+
+# S3ボディを少しずつ読むためのチャンクサイズ
+CSV_READ_CHUNK_SIZE = 64 * 1024
+# 文字コード判定に使う先頭バイト数
+CSV_ENCODING_SNIFF_SIZE = 4 * 1024
+
+# ブラウザで gzip 圧縮してアップロードされたCSV（キーの末尾が .csv.gz）
+GZIP_SUFFIX = '.gz'
+GZIP_MAGIC = b'\x1f\x8b'
+# 展開後のサイズ上限（圧縮爆弾対策）
+CSV_MAX_DECOMPRESSED_BYTES = int(os.environ.get('CSV_MAX_DECOMPRESSED_BYTES', str(200 * 1024 * 1024)))
+
+# gzip のチャンク列を逐次展開する（展開後も CSV_READ_CHUNK_SIZE ずつ返す）
+def iter_gunzipped(chunks):
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    total = 0
+    for chunk in chunks:
+        data = chunk
+        while data:
+            out = decompressor.decompress(data, CSV_READ_CHUNK_SIZE)
+            total += len(out)
+            if total > CSV_MAX_DECOMPRESSED_BYTES:
+                raise ValueError(f"展開後のCSVが上限({CSV_MAX_DECOMPRESSED_BYTES}バイト)を超えました")
+            if out:
+                yield out
+            if decompressor.eof:
+                # 複数メンバーの gzip は続きを新しい展開器で読む
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            else:
+                data = decompressor.unconsumed_tail
+    tail = decompressor.flush()
+    if len(tail) + total > CSV_MAX_DECOMPRESSED_BYTES:
+        raise ValueError(f"展開後のCSVが上限({CSV_MAX_DECOMPRESSED_BYTES}バイト)を超えました")
+    if tail:
+        yield tail
+
+# 先頭のマジックバイトで gzip かを判定し、gzip なら展開しながら返す
+def iter_plain_chunks(chunks):
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    chunks = itertools.chain([first], chunks)
+    if first.startswith(GZIP_MAGIC):
+        return iter_gunzipped(chunks)
+    return chunks
+
+# アップロード時に DynamoDB に登録した csv_path（圧縮版は .gz を除いたキー）
+def csv_path_for_key(key):
+    return key[:-len(GZIP_SUFFIX)] if key.endswith(GZIP_SUFFIX) else key
+
+# アップロードされたCSVのキー -> 集計JSONのキー
+def summary_output_key(key):
+    return f"outputs/summary_{os.path.basename(csv_path_for_key(key)).replace('.csv', '.json')}"
+
+# 先頭バイトから文字コードを判定（マネーフォワードMEのCSVはShift_JIS(CP932)）
+def detect_csv_encoding(head):
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 末尾で途切れたマルチバイト文字はエラーにしない
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp932'
+
+# バイトのチャンク列を文字コードを判定しながら逐次デコードし、1行ずつ返す
+def iter_decoded_lines(chunks):
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= CSV_ENCODING_SNIFF_SIZE:
+            break
+    encoding = detect_csv_encoding(head)
+    pending = ''
+    for text in codecs.iterdecode(itertools.chain([head], chunks), encoding):
+        pending += text
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def get_csv_object(bucket, key):
+    s3 = get_client('s3')
+    with timed("S3Get") as m:
+        response = s3.get_object(Bucket=bucket, Key=key)
+        m["Bytes"] = response.get('ContentLength', 0)
+    return response
+
+# get_object のレスポンスから全体を読み込まずに1行ずつ辞書で返す
+def iter_csv_rows(response):
+    chunks = iter_plain_chunks(response['Body'].iter_chunks(chunk_size=CSV_READ_CHUNK_SIZE))
+    yield from csv.DictReader(iter_decoded_lines(chunks))
+
+# S3上のCSVを全体を読み込まずに1行ずつ辞書で返す
+def iter_csv_rows_from_s3(bucket, key):
+    yield from iter_csv_rows(get_csv_object(bucket, key))
 
 def parse_csv_from_s3(bucket, key):
-    s3 = boto3.client('s3')
-    response = s3.get_object(Bucket=bucket, Key=key)
-    content = response['Body'].read().decode('utf-8').splitlines()
-    return list(csv.DictReader(content))
+    return list(iter_csv_rows_from_s3(bucket, key))
 
 def enrich_rows(rows):
-    enriched = []
+    targets = [
+        row for row in rows
+        if row.get("大項目", "未分類") == "未分類" or row.get("中項目", "未分類") == "未分類"
+    ]
+
+    # 同じCSV内の分類済みの行から店名索引を作り、まずはローカルで分類する
+    index = build_merchant_index(rows)
+    local = {}
+    for memo in dict.fromkeys(row.get("内容", "") for row in targets):
+        categories = lookup_merchant(index, memo)
+        if categories:
+            local[memo] = categories
+    local_hits = sum(1 for row in targets if row.get("内容", "") in local)
+    if targets:
+        print(f"[分類] ローカル索引ヒット率: {local_hits}/{len(targets)} 行 ({local_hits / len(targets):.1%})")
+
+    # 索引で見つからなかった内容だけGPTに回す
+    classified = classify_memos([row.get("内容", "") for row in targets if row.get("内容", "") not in local])
+    classified.update(local)
+
+    for row in targets:
+        guessed_main, guessed_sub = classified[row.get("内容", "")]
+        if row.get("大項目", "未分類") == "未分類":
+            row["大項目"] = guessed_main
+        if row.get("中項目", "未分類") == "未分類":
+            row["中項目"] = guessed_sub
+    return rows
+
+# 日付文字列 -> (週キー, 月キー)。同じ日付の行は多いので一度だけパースする
+@lru_cache(maxsize=8192)
+def parse_date_keys(date_str):
+    date = datetime.strptime(date_str, '%Y/%m/%d')
+    return date.strftime('%Y-W%U'), date.strftime('%Y-%m')
+
+# 内容 -> 表記揺れ・支店名をそろえた店名（同じ店の行は多いので一度だけ正規化する）
+merchant_key = lru_cache(maxsize=8192)(merchant_name)
+
+# 1行を集計用のレコードに正規化（日付キー・金額のパースは行ごとに1回だけ）
+def normalize_row(row):
+    week_key, month_key = parse_date_keys(row['日付'])
+    return {
+        "week": week_key,
+        "month": month_key,
+        "amount": float(row['金額（円）']),
+        "main_category": row['大項目'],
+        "category": row['中項目'],
+        "memo": row.get('内容', ''),
+    }
+
+# 集計値の定義: 初期値の生成と1レコード分の加算
+def _init_income_expense():
+    return {'income': 0, 'expense': 0}
+
+def _add_income_expense(acc, record):
+    if record["main_category"] == '収入':
+        acc['income'] += record["amount"]
+    else:
+        acc['expense'] += record["amount"]
+    return acc
+
+def _init_total():
+    return 0.0
+
+def _add_total(acc, record):
+    return acc + record["amount"]
+
+# 店ごとの支出額・回数のスケッチ（支出の行だけ。支出額は正の値で持つ）
+# 取り込み中は店ごとの正確な合計（pending）に加え、最後にまとめてスケッチにマージする
+def _init_merchants():
+    return {"spend": {}, "count": {}}
+
+def _add_merchants(acc, record):
+    amount = record["amount"]
+    if amount >= 0 or record["main_category"] == '収入':
+        return acc
+    merchant = merchant_key(record["memo"])
+    if not merchant:
+        return acc
+    pending = acc.setdefault("pending", {})
+    totals = pending.get(merchant)
+    if totals is None:
+        # 店の種類が多すぎるときは途中でマージしてメモリを抑える
+        if len(pending) >= TOP_MERCHANTS_PENDING_MAX:
+            _flush_merchants(acc)
+            pending = acc["pending"] = {}
+        totals = pending[merchant] = [0, 0]
+    totals[0] -= amount
+    totals[1] += 1
+    return acc
+
+def _flush_merchants(acc):
+    pending = acc.pop("pending", None)
+    if pending:
+        spend = sketch_from_totals({merchant: totals[0] for merchant, totals in pending.items()}, TOP_MERCHANTS_CAPACITY)
+        count = sketch_from_totals({merchant: totals[1] for merchant, totals in pending.items()}, TOP_MERCHANTS_CAPACITY)
+        acc["spend"] = sketch_merge(acc["spend"], spend, TOP_MERCHANTS_CAPACITY)
+        acc["count"] = sketch_merge(acc["count"], count, TOP_MERCHANTS_CAPACITY)
+    return acc
+
+MEASURES = {
+    "income_expense": (_init_income_expense, _add_income_expense),
+    "total": (_init_total, _add_total),
+    "merchants": (_init_merchants, _add_merchants),
+}
+# 全ての行を加えた後の仕上げ
+MEASURE_FINISHERS = {
+    "merchants": _flush_merchants,
+}
+
+# 集計結果の出力形式
+def _format_period(spec, groups):
+    return format_summary({key[0]: acc for key, acc in groups.items()}, spec["keys"][0])
+
+def _format_category(spec, groups):
+    return [{"category": key[0], "total": acc} for key, acc in sorted(groups.items())]
+
+def _format_category_period(spec, groups):
+    period_key_name = spec["keys"][0]
+    return [
+        {period_key_name: key[0], "category": key[1], "amount": acc}
+        for key, acc in sorted(groups.items())
+    ]
+
+def _format_unclassified(spec, groups):
+    return {"category": "未分類", "total": groups.get((), 0)}
+
+# 月ごとの支出額・回数の上位の店（error は推定値の誤差の上限。0 なら正確な値）
+def _format_top_merchants(spec, groups):
+    return [
+        {
+            "month": key[0],
+            "by_spend": [
+                {"merchant": merchant, "spend": round(value), "error": round(error)}
+                for merchant, value, error in sketch_top(acc["spend"], TOP_MERCHANTS_COUNT)
+            ],
+            "by_count": [
+                {"merchant": merchant, "count": int(value), "error": int(error)}
+                for merchant, value, error in sketch_top(acc["count"], TOP_MERCHANTS_COUNT)
+            ]
+        }
+        for key, acc in sorted(groups.items()) if acc["spend"]
+    ]
+
+# 集計の定義（グループキー + 集計値 + 出力形式）。出力JSONはこの順で並ぶ
+SUMMARY_SPECS = [
+    {"name": "weekly", "keys": ("week",), "measure": "income_expense", "format": _format_period},
+    {"name": "monthly", "keys": ("month",), "measure": "income_expense", "format": _format_period},
+    {"name": "category", "keys": ("category",), "measure": "total", "format": _format_category},
+    # 週 × 中項目ごとの合計
+    {"name": "category_weekly", "keys": ("week", "category"), "measure": "total", "format": _format_category_period},
+    # 月 × 中項目ごとの合計
+    {"name": "category_monthly", "keys": ("month", "category"), "measure": "total", "format": _format_category_period},
+    {"name": "unclassified_total", "keys": (), "measure": "total", "format": _format_unclassified,
+     "where": {"category": "未分類"}},
+    # 月ごとの上位の店
+    {"name": "top_merchants", "keys": ("month",), "measure": "merchants", "format": _format_top_merchants},
+]
+
+SPECS_BY_NAME = {spec["name"]: spec for spec in SUMMARY_SPECS}
+
+# 集計の対象とする条件（"where" の列名 -> 値 がすべて一致するレコード）
+def _record_filter(where):
+    if not where:
+        return None
+    return lambda record: all(record[k] == v for k, v in where.items())
+
+# 全ての集計を1パスで途中集計（集計名 -> {グループキー: 集計値}）に加算する
+def accumulate_rows(rows, specs=SUMMARY_SPECS, groups=None):
+    if groups is None:
+        groups = {}
+    if SUMMARY_BACKEND == 'numpy':
+        initializers = {name: init for name, (init, _) in MEASURES.items()}
+        return numpy_backend.accumulate_rows(rows, specs, groups, parse_date_keys, initializers, merchant_key)
+    plans = [
+        (spec["keys"], MEASURES[spec["measure"]], _record_filter(spec.get("where")), groups.setdefault(spec["name"], {}))
+        for spec in specs
+    ]
     for row in rows:
-        main_cat = row.get("大項目", "未分類")
-        sub_cat = row.get("中項目", "未分類")
-        memo = row.get("内容", "")
-
-        if main_cat == "未分類" or sub_cat == "未分類":
-            guessed_main, guessed_sub = classify_with_gpt(memo)
-            if main_cat == "未分類":
-                row["大項目"] = guessed_main
-            if sub_cat == "未分類":
-                row["中項目"] = guessed_sub
-        enriched.append(row)
-    return enriched
+        record = normalize_row(row)
+        for keys, (init, add), record_filter, group in plans:
+            if record_filter is not None and not record_filter(record):
+                continue
+            key = tuple(record[k] for k in keys)
+            acc = group.get(key)
+            if acc is None:
+                acc = init()
+            group[key] = add(acc, record)
+    for spec in specs:
+        finish = MEASURE_FINISHERS.get(spec["measure"])
+        if finish is not None:
+            for acc in groups[spec["name"]].values():
+                finish(acc)
+    return groups
+
+def format_groups(groups, specs=SUMMARY_SPECS):
+    return {spec["name"]: spec["format"](spec, groups.get(spec["name"], {})) for spec in specs}
+
+# 全ての集計を1パスで計算する
+def aggregate_rows(rows, specs=SUMMARY_SPECS):
+    return format_groups(accumulate_rows(rows, specs), specs)
+
+def summarize_all(rows):
+    return aggregate_rows(rows, SUMMARY_SPECS)
 
 def summarize_weekly(rows):
-    summary = defaultdict(lambda: {'income': 0, 'expense': 0})
-    for row in rows:
-        date = datetime.strptime(row['日付'], '%Y/%m/%d')
-        week_key = date.strftime('%Y-W%U')
-        amount = float(row['金額（円）'])
-        category = row['大項目']
-        if category == '収入':
-            summary[week_key]['income'] += amount
-        else:
-            summary[week_key]['expense'] += amount
-    return format_summary(summary, 'week')
+    return aggregate_rows(rows, [SPECS_BY_NAME["weekly"]])["weekly"]
 
 def summarize_monthly(rows):
-    summary = defaultdict(lambda: {'income': 0, 'expense': 0})
-    for row in rows:
-        date = datetime.strptime(row['日付'], '%Y/%m/%d')
-        month_key = date.strftime('%Y-%m')
-        amount = float(row['金額（円）'])
-        category = row['大項目']
-        if category == '収入':
-            summary[month_key]['income'] += amount
-        else:
-            summary[month_key]['expense'] += amount
-    return format_summary(summary, 'month')
+    return aggregate_rows(rows, [SPECS_BY_NAME["monthly"]])["monthly"]
 
 def summarize_by_category(rows):
-    summary = defaultdict(float)
-    for row in rows:
-        category = row['中項目']
-        amount = float(row['金額（円）'])
-        summary[category] += amount
-    return [{"category": cat, "total": amt} for cat, amt in sorted(summary.items())]
+    return aggregate_rows(rows, [SPECS_BY_NAME["category"]])["category"]
 
 # 追加: 週 × 中項目ごとの合計
 def summarize_category_weekly(rows):
-    summary = defaultdict(lambda: defaultdict(float))  # week -> category -> amount
-    for row in rows:
-        date = datetime.strptime(row['日付'], '%Y/%m/%d')
-        week_key = date.strftime('%Y-W%U')
-        category = row['中項目']
-        amount = float(row['金額（円）'])
-        summary[week_key][category] += amount
-
-    result = []
-    for week, categories in sorted(summary.items()):
-        for cat, amt in sorted(categories.items()):
-            result.append({
-                "week": week,
-                "category": cat,
-                "amount": amt
-            })
-    return result
+    return aggregate_rows(rows, [SPECS_BY_NAME["category_weekly"]])["category_weekly"]
 
 # 追加: 月 × 中項目ごとの合計
 def summarize_category_monthly(rows):
-    summary = defaultdict(lambda: defaultdict(float))  # month -> category -> amount
-    for row in rows:
-        date = datetime.strptime(row['日付'], '%Y/%m/%d')
-        month_key = date.strftime('%Y-%m')
-        category = row['中項目']
-        amount = float(row['金額（円）'])
-        summary[month_key][category] += amount
-
-    result = []
-    for month, categories in sorted(summary.items()):
-        for cat, amt in sorted(categories.items()):
-            result.append({
-                "month": month,
-                "category": cat,
-                "amount": amt
-            })
-    return result
+    return aggregate_rows(rows, [SPECS_BY_NAME["category_monthly"]])["category_monthly"]
 
 def summarize_unclassified_total(rows):
-    total = sum(float(row['金額（円）']) for row in rows if row['中項目'] == "未分類")
-    return {"category": "未分類", "total": total}
+    return aggregate_rows(rows, [SPECS_BY_NAME["unclassified_total"]])["unclassified_total"]
+
+def summarize_top_merchants(rows):
+    return aggregate_rows(rows, [SPECS_BY_NAME["top_merchants"]])["top_merchants"]
 
 def format_summary(summary_dict, period_key_name):
     result = []
@@ -162,8 +546,11 @@ def format_summary(summary_dict, period_key_name):
     return result
 
 def write_json_to_s3(data, bucket, key):
-    s3 = boto3.client('s3')
-    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    s3 = get_client('s3')
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    with timed("S3Put") as m:
+        s3.put_object(Bucket=bucket, Key=key, Body=body, Metadata={SUMMARY_VERSION_METADATA_KEY: SUMMARY_VERSION})
+        m["Bytes"] = len(body)
     print(f"[S3出力] JSONを保存しました → s3://{bucket}/{key}")
 
 # TEST-CODE
@@ -172,79 +559,302 @@ def write_csv_to_s3(rows, bucket, key):
     writer = csv.DictWriter(output, fieldnames=rows[0].keys())
     writer.writeheader()
     writer.writerows(rows)
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     s3.put_object(Bucket=bucket, Key=key, Body=output.getvalue().encode('utf-8'))
     print(f"[S3出力] 補完済CSVを保存しました → s3://{bucket}/{key}")
 
+# ユーザーの csv_path がこのCSVのままなら json_path を更新する
+# 後から別のCSVがアップロードされていれば更新せずに False（そのCSVの集計が json_path を更新する）
 def update_dynamodb_with_json_path(user_id, csv_path, json_path):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
-
     now = datetime.utcnow().isoformat() + 'Z'
-
+    updated = update_user(
+        user_id,
+        {"json_path": json_path, "created_at": now},
+        condition="csv_path = :csv_path",
+        condition_values={":csv_path": csv_path},
+        return_values="UPDATED_NEW"
+    )
+    if updated is None:
+        print(f"[WARN] 新しいCSVがアップロードされているため、JSONパスを更新しませんでした: userId={user_id}, csv_path={csv_path}")
+        return False
+    print(f"[DynamoDB] JSONパスを更新: {updated}")
+    return True
+
+# ユーザーごとの途中集計（期間・カテゴリ別の部分和と取り込み済みの取引ID）
+def user_state_key(user_id):
+    return f"{USER_STATE_PREFIX}{user_id}/aggregate.json"
+
+# 途中集計を読み込む。戻り値は (state, ETag)。未作成なら ETag は None
+def load_user_state(bucket, user_id):
+    s3 = get_client('s3')
     try:
-        response = table.update_item(
-            Key={'userId': user_id},
-            ConditionExpression="csv_path = :csv_path_val",
-            UpdateExpression="SET json_path = :json_path_val, created_at = :created_at_val",
-            ExpressionAttributeValues={
-                ":csv_path_val": csv_path,
-                ":json_path_val": json_path,
-                ":created_at_val": now
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-        print(f"[DynamoDB] JSONパスを更新: {response}")
-    except Exception as e:
-        print(f"[DynamoDBエラー] 更新失敗: {str(e)}")
+        with timed("S3GetState") as m:
+            obj = s3.get_object(Bucket=bucket, Key=user_state_key(user_id))
+            body = obj['Body'].read()
+            m["Bytes"] = len(body)
+    except s3.exceptions.NoSuchKey:
+        return {"version": USER_STATE_VERSION, "seen_ids": {}, "groups": {}}, None
+    return json.loads(body.decode('utf-8')), obj['ETag']
+
+# 楽観ロックで途中集計を保存する。他の実行に先を越されていれば False
+def save_user_state(bucket, user_id, state, etag):
+    s3 = get_client('s3')
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    body = json.dumps(state, ensure_ascii=False).encode('utf-8')
+    try:
+        with timed("S3PutState") as m:
+            m["Bytes"] = len(body)
+            s3.put_object(
+                Bucket=bucket,
+                Key=user_state_key(user_id),
+                Body=body,
+                **condition
+            )
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+    return True
+
+def groups_from_state(state):
+    return {
+        name: {tuple(key): acc for key, acc in entries}
+        for name, entries in state.get("groups", {}).items()
+    }
 
-def lambda_handler(event, context):
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
+def groups_to_state(groups):
+    return {
+        name: [[list(key), acc] for key, acc in sorted(group.items())]
+        for name, group in groups.items()
+    }
 
-    rows = parse_csv_from_s3(bucket, key)
-#    enriched_rows = enrich_rows(rows)
+# "YYYY-MM" の months か月後（負なら前）の月
+def shift_month(month, months):
+    year, mon = map(int, month.split('-'))
+    index = year * 12 + mon - 1 + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+# 途中集計の取り込み済みの取引（月 -> 取引キーの set）
+# version 1 の途中集計は月の分からない取引IDの一覧なので、当時あった月が締まるまで legacy として残す
+def seen_ids_from_state(state):
+    if state.get("version", 1) < 2:
+        months = [key[0] for key, _ in state.get("groups", {}).get("monthly", [])]
+        return {}, {"ids": state.get("seen_ids", []), "until": max(months, default=None)}
+    return {month: set(ids) for month, ids in state.get("seen_ids", {}).items()}, state.get("legacy_seen_ids")
+
+# 最新の月から SEEN_IDS_MONTHS か月分だけを保存する（それより前の月は締めたものとして忘れる）
+def seen_ids_to_state(seen_ids, legacy):
+    if not seen_ids:
+        return {"seen_ids": {}}
+    cutoff = shift_month(max(seen_ids), 1 - SEEN_IDS_MONTHS)
+    state = {"seen_ids": {month: sorted(ids) for month, ids in sorted(seen_ids.items()) if month >= cutoff}}
+    if legacy and legacy["until"] is not None and legacy["until"] >= cutoff:
+        state["legacy_seen_ids"] = legacy
+    return state
+
+# 取り込み済みの取引の行を除き、新しい取引を seen_ids に加える
+#   取引キーは「ID」列（空なら行の内容のハッシュ。同じ内容の行が複数あれば2件目から #2, #3, ... を付ける）
+#   imported_months: 取り込み前の途中集計にある月。締めた月（最新の月から SEEN_IDS_MONTHS か月より前）のうち、
+#   すでに取り込んだ月の行は重複を判定できないため読み飛ばす
+def skip_seen_rows(rows, seen_ids, imported_months=frozenset(), legacy=None):
+    newest = max(seen_ids, default=None)
+    cutoff = shift_month(newest, 1 - SEEN_IDS_MONTHS) if newest else None
+    legacy_ids = frozenset(legacy["ids"]) if legacy else frozenset()
+    occurrences = {}
+    for row in rows:
+        month = parse_date_keys(row['日付'])[1]
+        if cutoff and month < cutoff and month in imported_months:
+            continue
+        key = occurrence_key(row, occurrences)
+        month_ids = seen_ids.setdefault(month, set())
+        if key in month_ids or key in legacy_ids:
+            continue
+        month_ids.add(key)
+        yield row
+
+# 同じ内容のCSVを取り込み済みで、最新の集計JSONが現在の形式か
+def is_processed(state, csv_etag):
+    return (
+        csv_etag in state.get("processed_etags", [])
+        and state.get("latest_json_key") is not None
+        and state.get("summary_version") == SUMMARY_VERSION
+    )
+
+# 新しい取引だけを途中集計にマージし、ユーザーの全期間の集計を返す
+# 戻り値は (集計, 最新の集計JSONのキー)。同じ内容のCSV（csv_etag）を取り込み済みなら集計せず (None, 最新のキー)
+def summarize_into_user_state(bucket, user_id, open_rows, csv_etag=None, json_key=None):
+    for attempt in range(USER_STATE_MAX_RETRIES):
+        state, etag = load_user_state(bucket, user_id)
+        if csv_etag and is_processed(state, csv_etag):
+            return None, state["latest_json_key"]
+        if etag and state.get("groups_version") != SUMMARY_VERSION:
+            print(f"[WARN] 途中集計は古い形式の集計を含みます（新しい形式の集計は以後の取引だけ）。"
+                  f"tools/backfill_summaries.py で作り直してください: userId={user_id}")
+        seen_ids, legacy = seen_ids_from_state(state)
+        groups = groups_from_state(state)
+        imported_months = frozenset(key[0] for key in groups.get("monthly", {}))
+        known = sum(map(len, seen_ids.values()))
+        groups = accumulate_rows(skip_seen_rows(open_rows(), seen_ids, imported_months, legacy), groups=groups)
+        merged = sum(map(len, seen_ids.values())) - known
+
+        processed = [e for e in state.get("processed_etags", []) if e != csv_etag]
+        if csv_etag:
+            processed.append(csv_etag)
+        state = {
+            "version": USER_STATE_VERSION,
+            **seen_ids_to_state(seen_ids, legacy),
+            "groups": groups_to_state(groups),
+            "processed_etags": processed[-PROCESSED_ETAGS_MAX:],
+            "latest_json_key": json_key,
+            "summary_version": SUMMARY_VERSION,
+            # 途中集計の全ての取引を集計した形式。新しい形式の集計は以後の取引にしか入らないため、
+            # 古い形式から始まった途中集計は tools/backfill_summaries.py で作り直す
+            "groups_version": state.get("groups_version") if etag else SUMMARY_VERSION
+        }
+        if save_user_state(bucket, user_id, state, etag):
+            print(f"[途中集計] userId={user_id} 新規取引 {merged} 件をマージしました")
+            return format_groups(groups), json_key
+        print(f"[WARN] 途中集計の更新が競合しました。再集計します ({attempt + 1}/{USER_STATE_MAX_RETRIES})")
+    raise RuntimeError(f"途中集計を更新できませんでした: userId={user_id}")
+
+# CSVの内容（ETag）ごとの集計結果（集計の形式が変わればキーも変わる）
+def content_summary_key(csv_etag):
+    return f"{CONTENT_SUMMARY_PREFIX}{SUMMARY_VERSION}/{csv_etag.strip(chr(34))}.json"
+
+def load_content_summary(bucket, csv_etag):
+    s3 = get_client('s3')
+    try:
+        with timed("S3GetContentSummary"):
+            obj = s3.get_object(Bucket=bucket, Key=content_summary_key(csv_etag))
+            return json.loads(obj['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return None
+
+# 最初に書いた実行の結果だけを残す（同時に同じ内容を集計した実行は書かない）
+def save_content_summary(bucket, csv_etag, result):
+    s3 = get_client('s3')
+    try:
+        with timed("S3PutContentSummary"):
+            s3.put_object(
+                Bucket=bucket,
+                Key=content_summary_key(csv_etag),
+                Body=json.dumps(result, ensure_ascii=False).encode('utf-8'),
+                IfNoneMatch="*"
+            )
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+
+# CSVの行を読み、必要なら未分類の行を補完する
+def load_rows(bucket, response):
+    # 行はストリームで読みながらそのまま集計に流す
+    rows = iter_csv_rows(response)
+
+    if ENRICH_UNCLASSIFIED:
+        # 未分類の行をまとめて分類するため、補完時のみ行をメモリに載せる
+        load_classification_cache(bucket)
+        rows = enrich_rows(list(rows))
+        save_classification_cache(bucket)
 
     # S3に出力
 #    output_key = f"outputs/enriched_{os.path.basename(key)}"
-#    write_csv_to_s3(enriched_rows, bucket, output_key)
-
-#    result = {
-#        "weekly": summarize_weekly(enriched_rows),
-#        "monthly": summarize_monthly(enriched_rows),
-#        "category": summarize_by_category(enriched_rows),
-#        "category_weekly": summarize_category_weekly(enriched_rows),
-#        "category_monthly": summarize_category_monthly(enriched_rows)
-#    }
-
-    result = {
-        "weekly": summarize_weekly(rows),
-        "monthly": summarize_monthly(rows),
-        "category": summarize_by_category(rows),
-        "category_weekly": summarize_category_weekly(rows),
-        "category_monthly": summarize_category_monthly(rows),
-        "unclassified_total": summarize_unclassified_total(rows)
-    }
+#    write_csv_to_s3(rows, bucket, output_key)
+    return rows
+
+# FPコメントの先行生成を非同期で依頼する（失敗しても集計は成功とする）
+def invoke_fp_precompute(user_id):
+    try:
+        with timed("LambdaInvoke", target=LAMBDA_FP_COMMENT):
+            get_client('lambda').invoke(
+                FunctionName=LAMBDA_FP_COMMENT,
+                InvocationType="Event",
+                Payload=json.dumps(traced_payload({"user_id": user_id, "precompute": True})).encode("utf-8")
+            )
+    except Exception as e:
+        print(f"[WARN] FPコメントの先行生成を依頼できませんでした: {e}")
+
+# 読み込んだ行数を数えながら行を流す
+def count_rows(rows, metrics):
+    metrics["Rows"] = 0
+    for row in rows:
+        metrics["Rows"] += 1
+        yield row
+
+# アップロードされた1つのCSVを集計する
+def process_object(bucket, key):
+    csv_path = csv_path_for_key(key)
+
+    response = get_csv_object(bucket, key)
+    # 署名付きPOSTで付与した userId（x-amz-meta-user-id）
+    user_id = response.get('Metadata', {}).get(USER_ID_METADATA_KEY)
+    # アップロードページで発行したトレースIDを引き継ぐ
+    if response.get('Metadata', {}).get(TRACE_ID_METADATA_KEY):
+        bind_trace_id(response['Metadata'][TRACE_ID_METADATA_KEY])
+    # メタデータがなければ csv_path のGSIで userId を取得
+    if not user_id:
+        user_id = find_user_id_by_csv_path(csv_path)
 
     # JSON出力パスを生成
-    json_output_key = f"outputs/summary_{os.path.basename(key).replace('.csv', '.json')}"
+    json_output_key = summary_output_key(key)
+    # CSVの内容のハッシュ（署名付きPOSTは1パートのアップロードなので内容のMD5）
+    csv_etag = response.get('ETag')
+
+    # 同じ内容を集計済み（S3イベントの重複・同じCSVの再アップロード）なら、集計JSONの参照先だけを更新する
+    if not user_id and csv_etag:
+        result = load_content_summary(bucket, csv_etag)
+        if result is not None:
+            response['Body'].close()
+            print(f"[INFO] 同じ内容のCSVを集計済みです: {content_summary_key(csv_etag)}")
+            write_json_to_s3(result, bucket, json_output_key)
+            print("[WARN] 対応する userId が見つかりませんでした。")
+            return {
+                "statusCode": 200,
+                "body": json.dumps(result, ensure_ascii=False)
+            }
+
+    # CSVの読み込み・パース・集計（ストリームのため1つの段階として計測）
+    with timed("ParseAndAggregate") as m:
+        rows = count_rows(load_rows(bucket, response), m)
+        # 取引ストア用に、読み込んだ行を月ごとの列に集める（読み直した行は集めない）
+        transactions = {} if user_id and WRITE_TRANSACTION_STORE else None
+        if transactions is not None:
+            rows = collect_transactions(rows, transactions)
+
+        if user_id:
+            # 競合して再集計する場合はCSVを読み直す
+            pending = [rows]
+            def open_rows():
+                return pending.pop() if pending else load_rows(bucket, get_csv_object(bucket, key))
+            result, latest_json_key = summarize_into_user_state(bucket, user_id, open_rows, csv_etag, json_output_key)
+        else:
+            # 週次・月次・カテゴリ別などの集計を1パスで計算
+            result = summarize_all(rows)
+
+    if result is None:
+        # 取り込み済みのCSV。途中集計は変わらないので、最新の集計JSONを指すだけにする
+        response['Body'].close()
+        print(f"[INFO] 同じ内容のCSVを取り込み済みです。集計JSONの参照先: {latest_json_key}")
+        update_dynamodb_with_json_path(user_id, csv_path, latest_json_key)
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "取り込み済みのCSVです", "json_path": latest_json_key}, ensure_ascii=False)
+        }
+
+    # 前月比・支出割合などの分析値（FPコメントのプロンプト用）
+    result["analytics"] = build_analytics(result)
 
     # JSONをS3に保存
     write_json_to_s3(result, bucket, json_output_key)
+    if not user_id and csv_etag:
+        save_content_summary(bucket, csv_etag, result)
 
-    # userId を取得（ファイル名から照合）
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(os.environ['DYNAMODB_TABLE_NAME'])
-
-    response = table.scan()
-    user_id = None
-    for item in response.get('Items', []):
-        if item.get('csv_path') == key:
-            user_id = item['userId']
-            break
+    if transactions:
+        write_transactions(bucket, user_id, transactions)
 
     if user_id:
-        update_dynamodb_with_json_path(user_id, key, json_output_key)
+        # json_path がこの集計を指したときだけ先行生成する
+        if update_dynamodb_with_json_path(user_id, csv_path, json_output_key) and FP_PRECOMPUTE:
+            invoke_fp_precompute(user_id)
     else:
         print("[WARN] 対応する userId が見つかりませんでした。")
 
@@ -252,3 +862,76 @@ def lambda_handler(event, context):
         "statusCode": 200,
         "body": json.dumps(result, ensure_ascii=False)
     }
+
+# イベントに含まれるS3オブジェクト。戻り値は ([(SQSのmessageId, バケット, キー)], 読めなかったSQSメッセージのID)
+# S3から直接呼ばれた場合の messageId は None
+def s3_records(event):
+    records = []
+    failed_messages = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            records.append((None, record['s3']['bucket']['name'], record['s3']['object']['key']))
+            continue
+        try:
+            # S3のテストイベントなど、Records のないメッセージは読み飛ばす
+            for s3_record in json.loads(record['body']).get('Records', []):
+                records.append((record['messageId'], s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key']))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[ERROR] S3イベントとして読めないメッセージです: messageId={record['messageId']}: {e}")
+            failed_messages.append(record['messageId'])
+    return records, failed_messages
+
+# オブジェクトごとに集計する。戻り値は (レスポンス, 例外) のリスト（どちらかは None）
+def process_objects(records):
+    def run(bucket, key):
+        try:
+            return process_object(bucket, key), None
+        except Exception as e:
+            print(f"[ERROR] 集計に失敗しました: s3://{bucket}/{key}: {e}")
+            return None, e
+
+    if len(records) == 1:
+        _, bucket, key = records[0]
+        return [run(bucket, key)]
+    with ThreadPoolExecutor(max_workers=max(1, min(RECORD_MAX_WORKERS, len(records)))) as executor:
+        # オブジェクトごとにトレースIDを切り替えるため、それぞれコンテキストをコピーして実行する
+        futures = [executor.submit(contextvars.copy_context().run, run, bucket, key) for _, bucket, key in records]
+        return [future.result() for future in futures]
+
+@traced("mfme_csv_summary_generator")
+def lambda_handler(event, context):
+    log_event(event)
+    records, failed_messages = s3_records(event)
+    results = process_objects(records)
+
+    # SQS経由: 失敗したオブジェクトを含むメッセージだけを再試行させる
+    if any(message_id for message_id, _, _ in records) or failed_messages:
+        failed = dict.fromkeys(failed_messages)
+        direct_errors = []
+        for (message_id, _, key), (_, error) in zip(records, results):
+            if error is None:
+                continue
+            if message_id is None:
+                direct_errors.append(key)
+            else:
+                failed[message_id] = None
+        # S3から直接届いたレコードはメッセージ単位で再試行できないので、実行全体を失敗にする
+        if direct_errors:
+            raise RuntimeError(f"{len(direct_errors)} 件のCSVの集計に失敗しました: {direct_errors}")
+        print(f"[INFO] {len(records)} 件のCSVを処理し、{len(failed)} 件のメッセージを再試行に回しました")
+        return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
+
+    # S3から直接: 1件なら従来どおりのレスポンス。失敗があれば例外にして再試行させる（集計済みのCSVは再試行で飛ばされる）
+    errors = [(key, error) for (_, _, key), (_, error) in zip(records, results) if error is not None]
+    if len(records) == 1 and errors:
+        raise errors[0][1]
+    if errors:
+        raise RuntimeError(f"{len(errors)}/{len(records)} 件のCSVの集計に失敗しました: {[key for key, _ in errors]}")
+    if len(records) == 1:
+        return results[0][0]
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"results": [
+            {"key": key, "statusCode": response["statusCode"]} for (_, _, key), (response, _) in zip(records, results)
+        ]}, ensure_ascii=False)
+    }
@@ -0,0 +1,126 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict, deque
+
+# 部分一致に使う店名の最小文字数（短すぎる名前は誤爆しやすい）
+MIN_SUBSTRING_LENGTH = 3
+
+UNCLASSIFIED = "未分類"
+
+# 全角/半角・大文字小文字・記号の揺れをなくした店名キー
+def normalize_merchant(text):
+    text = unicodedata.normalize("NFKC", text or "").upper()
+    return re.sub(r"[\W_]+", "", text)
+
+# 空白で区切った末尾の支店名（「渋谷店」「新宿東口店」など）
+BRANCH_SUFFIX = re.compile(r"\s+\S+店$")
+
+# 支店名を除いた店名キー（「松屋 渋谷店」「松屋 新宿店」→「松屋」）
+# 空白で区切っていない支店名（「松屋渋谷店」）は区切りがわからないため残る
+def merchant_name(text):
+    text = unicodedata.normalize("NFKC", text or "").strip()
+    return normalize_merchant(BRANCH_SUFFIX.sub("", text))
+
+# 先頭の語（「セブン-イレブン 渋谷店」→「セブンイレブン」）
+def merchant_prefix(text):
+    tokens = unicodedata.normalize("NFKC", text or "").split()
+    return normalize_merchant(tokens[0]) if tokens else ""
+
+def is_classified(row):
+    return row.get("大項目", UNCLASSIFIED) != UNCLASSIFIED and row.get("中項目", UNCLASSIFIED) != UNCLASSIFIED
+
+# Aho-Corasick オートマトンを構築する
+def build_automaton(patterns):
+    goto = [{}]
+    fail = [0]
+    # ノードで終わる最長のパターン
+    output = [None]
+
+    for pattern in patterns:
+        node = 0
+        for ch in pattern:
+            next_node = goto[node].get(ch)
+            if next_node is None:
+                next_node = len(goto)
+                goto[node][ch] = next_node
+                goto.append({})
+                fail.append(0)
+                output.append(None)
+            node = next_node
+        output[node] = pattern
+
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for ch, child in goto[node].items():
+            queue.append(child)
+            state = fail[node]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            fail[child] = goto[state].get(ch, 0)
+            # 失敗遷移先で終わるパターンも拾えるよう、より長い方を残す
+            inherited = output[fail[child]]
+            if inherited and (output[child] is None or len(inherited) > len(output[child])):
+                output[child] = inherited
+
+    return {"goto": goto, "fail": fail, "output": output}
+
+# テキスト中に現れる最長のパターンを返す
+def find_longest_match(automaton, text):
+    goto, fail, output = automaton["goto"], automaton["fail"], automaton["output"]
+    node = 0
+    best = None
+    for ch in text:
+        while node and ch not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(ch, 0)
+        match = output[node]
+        if match and (best is None or len(match) > len(best)):
+            best = match
+    return best
+
+# 分類済みの行から 店名 -> (大項目, 中項目) の索引を作る
+def build_merchant_index(rows):
+    exact_votes = defaultdict(Counter)
+    prefix_votes = defaultdict(Counter)
+    for row in rows:
+        if not is_classified(row):
+            continue
+        categories = (row["大項目"], row["中項目"])
+        memo = row.get("内容", "")
+        name = normalize_merchant(memo)
+        if name:
+            exact_votes[name][categories] += 1
+        prefix = merchant_prefix(memo)
+        if prefix:
+            prefix_votes[prefix][categories] += 1
+
+    # 同じ店名に複数のカテゴリがついていれば多数決
+    exact = {name: votes.most_common(1)[0][0] for name, votes in exact_votes.items()}
+    prefix = {name: votes.most_common(1)[0][0] for name, votes in prefix_votes.items()}
+    substring = dict(prefix)
+    substring.update(exact)
+    patterns = [name for name in substring if len(name) >= MIN_SUBSTRING_LENGTH]
+
+    return {
+        "exact": exact,
+        "prefix": prefix,
+        "substring": substring,
+        "automaton": build_automaton(patterns),
+    }
+
+# 完全一致 → 先頭語一致 → 部分一致（最長）の順に引く。見つからなければ None
+def lookup_merchant(index, memo):
+    name = normalize_merchant(memo)
+    if not name:
+        return None
+    categories = index["exact"].get(name)
+    if categories:
+        return categories
+    categories = index["prefix"].get(merchant_prefix(memo))
+    if categories:
+        return categories
+    match = find_longest_match(index["automaton"], name)
+    if match:
+        return index["substring"][match]
+    return None
@@ -0,0 +1,175 @@
+# NumPy でベクトル化した集計（数十万行をまとめて再集計するバッチ向け）
+# 行を int64 の金額・日付コード・カテゴリコードの配列に変換し、グループごとの合計を sort + reduceat で求める
+# 金額は円の整数で正確に合計し、途中集計には float にして加える（Python版と同じJSONになる）
+from heavy_hitters import TOP_MERCHANTS_CAPACITY, sketch_from_totals, sketch_merge
+from transaction_store import parse_yen
+
+# numpy の import は100ms以上かかるため、この実装を使うときに初めて読み込む（既定の python 実装のコールドスタートを遅くしない）
+np = None
+
+def _load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+def is_available():
+    try:
+        _load_numpy()
+    except ImportError:
+        return False
+    return True
+
+# 値 -> コードの辞書符号化
+class _Codes:
+    def __init__(self):
+        self.index = {}
+        self.values = []
+        self.codes = []
+
+    def add(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+# 行 -> 列の配列。週・月は日付の種類ごとに1回だけ求める
+# merchant_key（内容 -> 店名）を渡すと店名の列も作る
+def encode_rows(rows, parse_date_keys, merchant_key=None):
+    amounts = []
+    dates = _Codes()
+    main_categories = _Codes()
+    categories = _Codes()
+    merchants = _Codes()
+    for row in rows:
+        amounts.append(parse_yen(row['金額（円）']))
+        dates.add(row['日付'])
+        main_categories.add(row['大項目'])
+        categories.add(row['中項目'])
+        if merchant_key is not None:
+            merchants.add(merchant_key(row.get('内容', '')))
+
+    date_codes = np.array(dates.codes, dtype=np.int64)
+    columns = {
+        "amount": np.array(amounts, dtype=np.int64),
+        "main_category": (np.array(main_categories.codes, dtype=np.int64), main_categories.values),
+        "category": (np.array(categories.codes, dtype=np.int64), categories.values),
+    }
+    if merchant_key is not None:
+        columns["merchant"] = (np.array(merchants.codes, dtype=np.int64), merchants.values)
+    for position, name in enumerate(("week", "month")):
+        periods = _Codes()
+        for date_str in dates.values:
+            periods.add(parse_date_keys(date_str)[position])
+        columns[name] = (np.array(periods.codes, dtype=np.int64)[date_codes], periods.values)
+    return columns
+
+# 列の値が value の行（その値がなければすべて False）
+def _equals(columns, name, value):
+    codes, values = columns[name]
+    return codes == (values.index(value) if value in values else -1)
+
+# 条件（列名 -> 値）に合う行のマスク
+def _where_mask(columns, where):
+    mask = np.ones(len(columns["amount"]), dtype=bool)
+    for name, value in (where or {}).items():
+        mask &= _equals(columns, name, value)
+    return mask
+
+# グループキーの組み合わせを1つの整数にして並べ替え、グループごとに合計する
+# 戻り値は (グループキーのリスト, 列名 -> グループごとの合計の配列)
+def _grouped_sums(columns, keys, mask, values):
+    values = {name: array[mask] for name, array in values.items()}
+    count = int(mask.sum())
+    if count == 0:
+        return [], {}
+    if not keys:
+        return [()], {name: array.sum(keepdims=True) for name, array in values.items()}
+
+    combined = np.zeros(count, dtype=np.int64)
+    for name in keys:
+        codes, labels = columns[name]
+        combined = combined * len(labels) + codes[mask]
+    order = np.argsort(combined, kind='stable')
+    combined = combined[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(combined)) + 1))
+    sums = {name: np.add.reduceat(array[order], starts) for name, array in values.items()}
+
+    group_keys = []
+    for code in combined[starts].tolist():
+        key = []
+        for name in reversed(keys):
+            labels = columns[name][1]
+            code, position = divmod(code, len(labels))
+            key.append(labels[position])
+        group_keys.append(tuple(reversed(key)))
+    return group_keys, sums
+
+def _accumulate_income_expense(columns, keys, mask, group, init):
+    is_income = _equals(columns, "main_category", '収入')
+    amount = columns["amount"]
+    group_keys, sums = _grouped_sums(columns, keys, mask, {
+        "income": np.where(is_income, amount, 0),
+        "expense": np.where(is_income, 0, amount),
+        "income_rows": is_income.astype(np.int64),
+        "rows": np.ones(len(amount), dtype=np.int64),
+    })
+    for i, key in enumerate(group_keys):
+        acc = group.get(key)
+        if acc is None:
+            acc = init()
+        # 該当する行があった側だけ加える（行がなければ初期値の 0 のまま）
+        if sums["income_rows"][i]:
+            acc['income'] += float(sums["income"][i])
+        if sums["rows"][i] - sums["income_rows"][i]:
+            acc['expense'] += float(sums["expense"][i])
+        group[key] = acc
+
+def _accumulate_total(columns, keys, mask, group, init):
+    group_keys, sums = _grouped_sums(columns, keys, mask, {"amount": columns["amount"]})
+    for i, key in enumerate(group_keys):
+        acc = group.get(key)
+        if acc is None:
+            acc = init()
+        group[key] = acc + float(sums["amount"][i])
+
+# 店ごとの支出額・回数を正確に合計してスケッチにし、途中集計のスケッチにマージする
+# （Python版も取り込み分の正確な合計をマージするため、1か月の店が極端に多い場合を除き同じ結果になる）
+def _accumulate_merchants(columns, keys, mask, group, init):
+    amount = columns["amount"]
+    mask = mask & (amount < 0) & ~_equals(columns, "main_category", '収入') & ~_equals(columns, "merchant", '')
+    group_keys, sums = _grouped_sums(columns, (*keys, "merchant"), mask, {
+        "spend": -amount,
+        "count": np.ones(len(amount), dtype=np.int64),
+    })
+    totals = {}
+    for i, key in enumerate(group_keys):
+        spend, count = totals.setdefault(key[:-1], ({}, {}))
+        spend[key[-1]] = float(sums["spend"][i])
+        count[key[-1]] = int(sums["count"][i])
+    for key, (spend, count) in totals.items():
+        acc = group.get(key)
+        if acc is None:
+            acc = init()
+        acc["spend"] = sketch_merge(acc["spend"], sketch_from_totals(spend, TOP_MERCHANTS_CAPACITY), TOP_MERCHANTS_CAPACITY)
+        acc["count"] = sketch_merge(acc["count"], sketch_from_totals(count, TOP_MERCHANTS_CAPACITY), TOP_MERCHANTS_CAPACITY)
+        group[key] = acc
+
+MEASURES = {
+    "income_expense": _accumulate_income_expense,
+    "total": _accumulate_total,
+    "merchants": _accumulate_merchants,
+}
+
+# lambda_function.accumulate_rows と同じ途中集計（集計名 -> {グループキー: 集計値}）に加算する
+def accumulate_rows(rows, specs, groups, parse_date_keys, initializers, merchant_key=None):
+    _load_numpy()
+    needs_merchant = any(spec["measure"] == "merchants" for spec in specs)
+    columns = encode_rows(rows, parse_date_keys, merchant_key if needs_merchant else None)
+    for spec in specs:
+        group = groups.setdefault(spec["name"], {})
+        mask = _where_mask(columns, spec.get("where"))
+        MEASURES[spec["measure"]](columns, spec["keys"], mask, group, initializers[spec["measure"]])
+    return groups
@@ -0,0 +1,85 @@
+# 集計結果から前月比などの分析値を計算する（FPコメントのプロンプトにそのまま渡せる形）
+
+# 前月比の大きいカテゴリとして出す件数
+TOP_MOVERS_COUNT = 5
+# 支出額・回数の多い店として出す件数
+TOP_MERCHANTS_COUNT = 5
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 3) if denominator else None
+
+# 月ごとの収支（金額は支出がマイナスなので収入 + 支出が収支）
+def monthly_balance(monthly):
+    months = []
+    for entry in monthly:
+        balance = entry["income"] + entry["expense"]
+        months.append({
+            "month": entry["month"],
+            "income": round(entry["income"]),
+            "expense": round(entry["expense"]),
+            "balance": round(balance),
+            "status": "黒字" if balance >= 0 else "赤字",
+        })
+    return months
+
+# 月 -> 中項目 -> 支出額（正の値）。合計がマイナスの中項目を支出とみなす
+def monthly_spending(category_monthly):
+    spending = {}
+    for entry in category_monthly:
+        if entry["amount"] < 0:
+            spending.setdefault(entry["month"], {})[entry["category"]] = -entry["amount"]
+    return spending
+
+# 中項目ごとの前月比
+def category_month_over_month(current, previous):
+    rows = []
+    for category in sorted(set(current) | set(previous)):
+        amount = current.get(category, 0)
+        prev = previous.get(category, 0)
+        rows.append({
+            "category": category,
+            "amount": round(amount),
+            "previous": round(prev),
+            "delta": round(amount - prev),
+            "ratio": _ratio(amount, prev),
+        })
+    return rows
+
+# 支出に占める中項目ごとの割合（大きい順）
+def category_share(spending):
+    total = sum(spending.values())
+    return [
+        {"category": category, "amount": round(amount), "share": _ratio(amount, total)}
+        for category, amount in sorted(spending.items(), key=lambda item: -item[1])
+    ]
+
+# 指定した月の支出額・回数の上位の店（推定値の誤差は省く）。戻り値は (支出額順, 回数順)
+def month_top_merchants(top_merchants, month):
+    for entry in top_merchants:
+        if entry["month"] == month:
+            return (
+                [{"merchant": row["merchant"], "spend": row["spend"]} for row in entry["by_spend"][:TOP_MERCHANTS_COUNT]],
+                [{"merchant": row["merchant"], "count": row["count"]} for row in entry["by_count"][:TOP_MERCHANTS_COUNT]],
+            )
+    return [], []
+
+def build_analytics(summary):
+    months = monthly_balance(summary.get("monthly", []))
+    spending = monthly_spending(summary.get("category_monthly", []))
+    latest = months[-1]["month"] if months else None
+    previous = months[-2]["month"] if len(months) >= 2 else None
+
+    mom = category_month_over_month(spending.get(latest, {}), spending.get(previous, {})) if latest else []
+    movers = sorted((row for row in mom if row["delta"]), key=lambda row: -abs(row["delta"]))
+    by_spend, by_count = month_top_merchants(summary.get("top_merchants", []), latest)
+
+    return {
+        "latest_month": latest,
+        "previous_month": previous,
+        "months": months,
+        "category_mom": mom,
+        "category_share": category_share(spending.get(latest, {})),
+        "top_movers": movers[:TOP_MOVERS_COUNT],
+        "top_merchants_by_spend": by_spend,
+        "top_merchants_by_count": by_count,
+    }
@@ -0,0 +1,339 @@
+# 正規化した取引をユーザー・月ごとに列指向のバイナリで保存する
+#   transactions/{userId}/{YYYY-MM}.bin
+#   = b"MFTX" + ヘッダー長(uint32 LE) + ヘッダー(JSON) + 列データ
+# ヘッダーに列ごとの型・データ部での位置を持ち、読み出し時は必要な列だけ Range で取得する
+import array
+import contextvars
+import hashlib
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
+from clients import get_client
+from metrics import timed
+
+TRANSACTION_STORE_PREFIX = os.environ.get('TRANSACTION_STORE_PREFIX', 'transactions/')
+STORE_MAGIC = b'MFTX'
+STORE_VERSION = 1
+# 最初の Range で読む先頭バイト数（ヘッダーが収まらなければ続きを読む）
+HEADER_PROBE_BYTES = 16 * 1024
+PARTITION_MAX_RETRIES = 3
+# 月ごとの読み書きの並列数
+STORE_MAX_WORKERS = int(os.environ.get('TRANSACTION_STORE_MAX_WORKERS', '4'))
+
+# 列名 -> 型
+#   array の型コード: 整数の列（金額は円の int64、日付は date.toordinal() の int32）
+#   dict: 辞書符号化した文字列（符号は uint32、辞書はヘッダー）
+#   str: 可変長の文字列（uint32 の終端オフセット + UTF-8）
+COLUMN_TYPES = {
+    "id": "str",
+    "date": "i",
+    "amount": "q",
+    "is_target": "b",
+    "is_transfer": "b",
+    "content": "dict",
+    "institution": "dict",
+    "main_category": "dict",
+    "category": "dict",
+    "memo": "str",
+}
+
+def partition_key(user_id, month):
+    return f"{TRANSACTION_STORE_PREFIX}{user_id}/{month}.bin"
+
+@lru_cache(maxsize=8192)
+def parse_day(date_str):
+    return datetime.strptime(date_str, '%Y/%m/%d').toordinal()
+
+def day_to_date(day):
+    return date.fromordinal(day)
+
+@lru_cache(maxsize=1024)
+def day_to_month(day):
+    return date.fromordinal(day).strftime('%Y-%m')
+
+# 金額は円の整数で持つ（小数の入ったCSVは四捨五入）
+def parse_yen(value):
+    try:
+        return int(value)
+    except ValueError:
+        return round(float(value))
+
+# 取引の識別子。「ID」列が空の行は行の内容のハッシュ
+def transaction_key(row):
+    return row.get('ID') or hashlib.sha1(
+        '\x1f'.join(str(v) for v in row.values()).encode('utf-8')
+    ).hexdigest()
+
+# 1回の取り込みの中での取引の識別子
+# 「ID」列が空で内容も同じ行は別の取引として、2件目から #2, #3 ... を付ける（occurrences は取り込みごとの出現回数）
+def occurrence_key(row, occurrences):
+    key = transaction_key(row)
+    if not row.get('ID'):
+        count = occurrences.get(key, 0) + 1
+        occurrences[key] = count
+        if count > 1:
+            key = f"{key}#{count}"
+    return key
+
+# 1パーティション分の空の列
+def new_columns():
+    return {name: array.array(kind) if len(kind) == 1 else [] for name, kind in COLUMN_TYPES.items()}
+
+# CSVの1行を月ごとの列に追加する
+def append_transaction(columns, key, day, row):
+    columns["id"].append(key)
+    columns["date"].append(day)
+    columns["amount"].append(parse_yen(row['金額（円）']))
+    columns["is_target"].append(int(row.get('計算対象') or 0))
+    columns["is_transfer"].append(int(row.get('振替') or 0))
+    # 辞書符号化する列は同じ文字列を共有させる
+    columns["content"].append(sys.intern(row.get('内容', '')))
+    columns["institution"].append(sys.intern(row.get('保有金融機関', '')))
+    columns["main_category"].append(sys.intern(row.get('大項目', '')))
+    columns["category"].append(sys.intern(row.get('中項目', '')))
+    columns["memo"].append(row.get('メモ', ''))
+
+# 行を流しながら、取引を月ごとの列（partitions: 月 -> 列）に追加していく
+# 行の辞書は保持しないので、メモリは列の値の分だけで済む
+def collect_transactions(rows, partitions):
+    occurrences = {}
+    for row in rows:
+        day = parse_day(row['日付'])
+        month = day_to_month(day)
+        columns = partitions.get(month)
+        if columns is None:
+            columns = partitions[month] = new_columns()
+        append_transaction(columns, occurrence_key(row, occurrences), day, row)
+        yield row
+
+# --- エンコード / デコード ---
+
+def _to_le_bytes(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _from_le_bytes(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def encode_column(kind, values):
+    if kind == "dict":
+        codes = {}
+        indexes = array.array('I', (codes.setdefault(v, len(codes)) for v in values))
+        return _to_le_bytes(indexes), {"type": kind, "dictionary": list(codes)}
+    if kind == "str":
+        encoded = [v.encode('utf-8') for v in values]
+        ends = array.array('I')
+        end = 0
+        for value in encoded:
+            end += len(value)
+            ends.append(end)
+        return _to_le_bytes(ends) + b''.join(encoded), {"type": kind}
+    return _to_le_bytes(array.array(kind, values)), {"type": kind}
+
+def decode_column(meta, data, rows):
+    kind = meta["type"]
+    if kind == "dict":
+        dictionary = meta["dictionary"]
+        return [dictionary[code] for code in _from_le_bytes('I', data)]
+    if kind == "str":
+        ends = _from_le_bytes('I', data[:4 * rows])
+        blob = data[4 * rows:]
+        start = 0
+        values = []
+        for end in ends:
+            values.append(blob[start:end].decode('utf-8'))
+            start = end
+        return values
+    return _from_le_bytes(kind, data)
+
+# 列 -> 1パーティション分のバイト列（日付・ID順）
+def encode_partition(columns):
+    days, ids = columns["date"], columns["id"]
+    order = sorted(range(len(ids)), key=lambda i: (days[i], ids[i]))
+    metas = {}
+    blocks = []
+    offset = 0
+    for name, kind in COLUMN_TYPES.items():
+        values = columns[name]
+        data, meta = encode_column(kind, [values[i] for i in order])
+        metas[name] = {**meta, "offset": offset, "length": len(data)}
+        blocks.append(data)
+        offset += len(data)
+    header = json.dumps(
+        {"version": STORE_VERSION, "rows": len(order), "columns": metas},
+        ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+    return STORE_MAGIC + struct.pack('<I', len(header)) + header + b''.join(blocks)
+
+# 先頭バイト列からヘッダーを読む。戻り値は (ヘッダー, データ部の開始位置)。足りなければヘッダーは None
+def decode_header(head):
+    magic, header_length = struct.unpack('<4sI', head[:8])
+    if magic != STORE_MAGIC:
+        raise ValueError("取引ストアの形式ではありません")
+    data_start = 8 + header_length
+    if len(head) < data_start:
+        return None, data_start
+    return json.loads(head[8:data_start].decode('utf-8')), data_start
+
+# パーティション全体 -> 列
+def decode_partition(body):
+    header, data_start = decode_header(body)
+    rows = header["rows"]
+    return {
+        name: decode_column(meta, body[data_start + meta["offset"]:data_start + meta["offset"] + meta["length"]], rows)
+        for name, meta in header["columns"].items()
+    }
+
+# new の取引を existing にマージする（同じIDは new の値で置き換える）。existing を更新して返す
+def merge_columns(existing, new):
+    positions = {key: i for i, key in enumerate(existing["id"])}
+    for j, key in enumerate(new["id"]):
+        i = positions.get(key)
+        if i is None:
+            positions[key] = len(positions)
+            for name in COLUMN_TYPES:
+                existing[name].append(new[name][j])
+        else:
+            for name in COLUMN_TYPES:
+                existing[name][i] = new[name][j]
+    return existing
+
+# --- 書き込み ---
+
+# 既存のパーティションを読む。戻り値は (列, ETag)。未作成なら ETag は None
+def load_partition(bucket, key):
+    s3 = get_client('s3')
+    try:
+        with timed("S3GetTransactions") as m:
+            obj = s3.get_object(Bucket=bucket, Key=key)
+            body = obj['Body'].read()
+            m["Bytes"] = len(body)
+    except s3.exceptions.NoSuchKey:
+        return new_columns(), None
+    return decode_partition(body), obj['ETag']
+
+# 楽観ロックで保存する。他の実行に先を越されていれば False
+def save_partition(bucket, key, body, etag):
+    s3 = get_client('s3')
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        with timed("S3PutTransactions") as m:
+            m["Bytes"] = len(body)
+            s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/octet-stream', **condition)
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+    return True
+
+# 1か月分の取引を既存のパーティションにマージする（同じIDは新しい方で置き換える）
+def write_partition(bucket, user_id, month, columns):
+    key = partition_key(user_id, month)
+    for attempt in range(PARTITION_MAX_RETRIES):
+        existing, etag = load_partition(bucket, key)
+        merged = merge_columns(existing, columns)
+        if save_partition(bucket, key, encode_partition(merged), etag):
+            return len(merged["id"])
+        print(f"[WARN] 取引ストアの更新が競合しました。再試行します ({attempt + 1}/{PARTITION_MAX_RETRIES}): {key}")
+    raise RuntimeError(f"取引ストアを更新できませんでした: {key}")
+
+def _map_months(func, months):
+    with ThreadPoolExecutor(max_workers=max(1, min(STORE_MAX_WORKERS, len(months)))) as executor:
+        # メトリクスのトレースIDを引き継ぐため、呼び出し元のコンテキストで実行する
+        futures = [executor.submit(contextvars.copy_context().run, func, month) for month in months]
+        return [future.result() for future in futures]
+
+# collect_transactions で集めた月ごとの列を、それぞれのパーティションに書き込む
+def write_transactions(bucket, user_id, partitions):
+    months = sorted(partitions)
+    if months:
+        _map_months(lambda month: write_partition(bucket, user_id, month, partitions[month]), months)
+    count = sum(len(partitions[month]["id"]) for month in months)
+    print(f"[取引ストア] userId={user_id} {count} 件を {len(months)} か月分に保存しました")
+    return months
+
+# --- 読み出し ---
+
+def _get_range(s3, bucket, key, start, end):
+    obj = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+    return obj['Body'].read()
+
+# 保存済みの月の一覧
+def list_months(bucket, user_id):
+    prefix = f"{TRANSACTION_STORE_PREFIX}{user_id}/"
+    months = []
+    for page in get_client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'][len(prefix):]
+            if name.endswith('.bin'):
+                months.append(name[:-len('.bin')])
+    return sorted(months)
+
+# 1パーティションから指定した列だけを読む（隣接する列は1回の Range にまとめる）
+def read_partition(bucket, key, columns=None):
+    s3 = get_client('s3')
+    with timed("S3RangeGetTransactions") as m:
+        try:
+            head = _get_range(s3, bucket, key, 0, HEADER_PROBE_BYTES - 1)
+        except s3.exceptions.NoSuchKey:
+            return {name: [] for name in (columns or COLUMN_TYPES)}
+        header, data_start = decode_header(head)
+        if header is None:
+            head += _get_range(s3, bucket, key, len(head), data_start - 1)
+            header, data_start = decode_header(head)
+        # 先頭の Range で読めたデータ部はそのまま使う
+        loaded = head[data_start:]
+        fetched = len(head)
+
+        names = list(columns or header["columns"])
+        unknown = [name for name in names if name not in header["columns"]]
+        if unknown:
+            raise ValueError(f"未知の列です: {unknown}")
+
+        spans = []
+        for name in sorted(names, key=lambda n: header["columns"][n]["offset"]):
+            meta = header["columns"][name]
+            start, end = meta["offset"], meta["offset"] + meta["length"]
+            if spans and spans[-1][1] == start:
+                spans[-1][1] = end
+                spans[-1][2].append(name)
+            else:
+                spans.append([start, end, [name]])
+
+        values = {}
+        for start, end, span_names in spans:
+            if end <= len(loaded):
+                data = loaded[start:end]
+            elif end > start:
+                data = _get_range(s3, bucket, key, data_start + start, data_start + end - 1)
+                fetched += len(data)
+            else:
+                data = b''
+            for name in span_names:
+                meta = header["columns"][name]
+                values[name] = decode_column(meta, data[meta["offset"] - start:meta["offset"] - start + meta["length"]], header["rows"])
+        m["Bytes"] = fetched
+        m["Rows"] = header["rows"]
+    return {name: values[name] for name in names}
+
+# 指定した月（既定は保存済みの全月）の指定した列を、月の古い順につなげて返す
+def read_transactions(bucket, user_id, months=None, columns=None):
+    months = sorted(months) if months is not None else list_months(bucket, user_id)
+    names = list(columns or COLUMN_TYPES)
+    result = {name: array.array(COLUMN_TYPES[name]) if len(COLUMN_TYPES[name]) == 1 else [] for name in names}
+    if not months:
+        return result
+    for partition in _map_months(lambda month: read_partition(bucket, partition_key(user_id, month), names), months):
+        for name in names:
+            result[name].extend(partition[name])
+    return result
@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent / "tools"
+sys.path.insert(0, str(TOOLS_DIR))
+
+from local_stubs import LocalCloud  # noqa: E402
+
+BUCKET = "test-bucket"
+TABLE = "users"
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    """clients.py をローカル代替に差し替えた S3 / DynamoDB / Lambda / OpenAI 一式"""
+    monkeypatch.setenv("DYNAMODB_TABLE_NAME", TABLE)
+    monkeypatch.setenv("S3_BUCKET_NAME", BUCKET)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    return LocalCloud(table_name=TABLE).install()
@@ -0,0 +1,88 @@
+"""tools/backfill_summaries.py（ディレクトリ上のS3代替で実行する）"""
+import json
+
+import pytest
+
+import backfill_summaries
+from conftest import BUCKET, TABLE
+from local_stubs import DirectoryS3, LocalCloud, load_lambda
+
+USER = "U1"
+
+
+def _csv(month, memo):
+    lines = ["計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID"]
+    for day in range(1, 4):
+        lines.append(f"1,2024/{month:02d}/{day:02d},{memo},-{day * 100},カード,食費,外食,,0,{memo}{month}-{day}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+@pytest.fixture
+def local_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("DYNAMODB_TABLE_NAME", TABLE)
+    monkeypatch.setenv("S3_BUCKET_NAME", BUCKET)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    return tmp_path / "s3"
+
+
+@pytest.fixture
+def uploaded(local_dir):
+    """ユーザーの2件と userId のない1件を集計し、その後に古い形式だったことにする"""
+    cloud = LocalCloud(table_name=TABLE, s3=DirectoryS3(local_dir)).install()
+    module = load_lambda("mfme_csv_summary_generator")
+    cloud.table.put_item(Item={"userId": USER, "csv_path": "uploads/u1_feb.csv"})
+    uploads = [("uploads/u1_jan.csv", 1, "松屋", USER), ("uploads/u1_feb.csv", 2, "吉野家", USER),
+               ("uploads/anon.csv", 3, "すき家", None)]
+    for key, month, memo, user_id in uploads:
+        cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=_csv(month, memo),
+                            Metadata={"user-id": user_id} if user_id else {})
+        module.process_object(BUCKET, key)
+
+    # 店ごとの集計（SUMMARY_VERSION 2）がなかった頃の途中集計・出力
+    state_key = module.user_state_key(USER)
+    state = json.loads(cloud.s3.get_object(Bucket=BUCKET, Key=state_key)["Body"].read())
+    state["groups"].pop("top_merchants")
+    state.pop("groups_version")
+    state["summary_version"] = "1"
+    cloud.s3.put_object(Bucket=BUCKET, Key=state_key, Body=json.dumps(state).encode("utf-8"))
+    for key, *_ in uploads:
+        cloud.s3.put_object(Bucket=BUCKET, Key=module.summary_output_key(key), Body=b"{}",
+                            Metadata={module.SUMMARY_VERSION_METADATA_KEY: "1"})
+    return cloud, module
+
+
+def _output(cloud, module, key):
+    return json.loads(cloud.s3.get_object(Bucket=BUCKET, Key=module.summary_output_key(key))["Body"].read())
+
+
+def _run(local_dir, checkpoint):
+    return backfill_summaries.run(BUCKET, "uploads/", workers=1, checkpoint=str(checkpoint), local_dir=str(local_dir))
+
+
+def test_rebuilds_user_state_and_rewrites_outputs(uploaded, local_dir, tmp_path):
+    cloud, module = uploaded
+
+    counts = _run(local_dir, tmp_path / "checkpoint.jsonl")
+
+    assert counts == {"written": 3, "skipped": 0, "stale": 0, "failed": 0}
+    # ユーザーの出力は、そのアップロードまでの全期間の集計
+    latest = _output(cloud, module, "uploads/u1_feb.csv")
+    assert [entry["month"] for entry in latest["monthly"]] == ["2024-01", "2024-02"]
+    assert [entry["month"] for entry in latest["top_merchants"]] == ["2024-01", "2024-02"]
+    first = _output(cloud, module, "uploads/u1_jan.csv")
+    assert [entry["month"] for entry in first["top_merchants"]] == ["2024-01"]
+    # userId のない出力は、そのCSV単体の集計
+    anonymous = _output(cloud, module, "uploads/anon.csv")
+    assert [entry["month"] for entry in anonymous["monthly"]] == ["2024-03"]
+
+    state = json.loads(cloud.s3.get_object(Bucket=BUCKET, Key=module.user_state_key(USER))["Body"].read())
+    assert state["groups_version"] == module.SUMMARY_VERSION
+    assert state["latest_json_key"] == module.summary_output_key("uploads/u1_feb.csv")
+
+
+def test_second_run_skips_everything(uploaded, local_dir, tmp_path):
+    _run(local_dir, tmp_path / "first.jsonl")
+
+    counts = _run(local_dir, tmp_path / "second.jsonl")
+
+    assert counts == {"written": 0, "skipped": 3, "stale": 0, "failed": 0}
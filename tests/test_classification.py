@@ -0,0 +1,63 @@
+"""GPTによる内容の分類と分類キャッシュ"""
+import json
+
+from local_stubs import load_lambda
+
+
+def _responder(answers):
+    """プロンプトの「番号: 内容」から answers[内容] を回答する（None の内容は回答しない）"""
+    def respond(messages, **kwargs):
+        results = []
+        for line in messages[0]["content"].splitlines():
+            index, sep, memo = line.partition(": ")
+            if sep and index.isdigit() and answers.get(memo) is not None:
+                main, sub = answers[memo]
+                results.append({"id": int(index), "大項目": main, "中項目": sub})
+        return json.dumps({"results": results}, ensure_ascii=False)
+    return respond
+
+
+def test_only_valid_answers_are_cached(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+    cloud.openai.responder = _responder({
+        "セブンイレブン": ("食費", "コンビニ"),
+        "謎の店": ("魔法", "呪文"),
+        "回答なし": None,
+    })
+
+    results = module.classify_memos(["セブンイレブン", "謎の店", "回答なし"])
+
+    assert results == {
+        "セブンイレブン": ("食費", "コンビニ"),
+        "謎の店": ("未分類", "未分類"),
+        "回答なし": ("未分類", "未分類"),
+    }
+    assert module.get_cached_classification("セブンイレブン") == ("食費", "コンビニ")
+    assert module.get_cached_classification("謎の店") is None
+    assert module.get_cached_classification("回答なし") is None
+
+
+def test_uncached_memos_are_retried(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+    cloud.openai.responder = _responder({"ローソン": ("食費", "コンビニ")})
+    module.classify_memos(["ローソン", "あとで分かる店"])
+
+    cloud.openai.requests.clear()
+    cloud.openai.responder = _responder({"あとで分かる店": ("交通費", "電車")})
+    results = module.classify_memos(["ローソン", "あとで分かる店"])
+
+    assert results["あとで分かる店"] == ("交通費", "電車")
+    # キャッシュ済みの内容は問い合わせない
+    assert len(cloud.openai.requests) == 1
+    assert "ローソン" not in cloud.openai.requests[0]["messages"][0]["content"]
+
+
+def test_failed_batch_is_not_cached(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+
+    def fail(messages, **kwargs):
+        raise RuntimeError("boom")
+    cloud.openai.responder = fail
+
+    assert module.classify_memos(["ファミマ"]) == {"ファミマ": ("未分類", "未分類")}
+    assert module.get_cached_classification("ファミマ") is None
@@ -0,0 +1,105 @@
+"""アップロードされたCSVの読み込み（文字コードの判定・逐次デコード）"""
+import codecs
+import gzip
+
+import pytest
+
+from local_stubs import load_lambda
+
+HEADER = "計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID\n"
+ROW = "1,2024/01/05,セブン－イレブン　渋谷店,-500,三井住友カード,食費,コンビニ,,0,id{}\n"
+
+
+@pytest.fixture
+def module(cloud):
+    return load_lambda("mfme_csv_summary_generator")
+
+
+def _text(rows=200):
+    return HEADER + "".join(ROW.format(i) for i in range(rows))
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("encoding, expected", [
+    ("cp932", "cp932"),
+    ("utf-8", "utf-8"),
+    ("utf-8-sig", "utf-8-sig"),
+])
+def test_detect_csv_encoding(module, encoding, expected):
+    assert module.detect_csv_encoding(_text().encode(encoding)[:module.CSV_ENCODING_SNIFF_SIZE]) == expected
+
+
+def test_utf8_cut_in_the_middle_of_a_character_is_still_utf8(module):
+    data = _text().encode("utf-8")
+    # 「計」(3バイト) の途中で切れた先頭
+    assert module.detect_csv_encoding(data[:1]) == "utf-8"
+
+
+@pytest.mark.parametrize("encoding", ["cp932", "utf-8", "utf-8-sig"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 1 << 20])
+def test_iter_decoded_lines_round_trips(module, encoding, chunk_size):
+    text = _text()
+    data = text.encode(encoding)
+
+    lines = list(module.iter_decoded_lines(_chunks(data, chunk_size)))
+
+    assert "".join(lines) == text
+    assert lines[0] == HEADER
+    assert all(line.endswith("\n") for line in lines)
+
+
+def test_bom_is_not_part_of_the_first_column(module):
+    data = codecs.BOM_UTF8 + _text(1).encode("utf-8")
+    rows = list(module.csv.DictReader(module.iter_decoded_lines(_chunks(data, 3))))
+    assert rows[0]["計算対象"] == "1"
+
+
+def test_last_line_without_newline(module):
+    data = (HEADER + ROW.format(0).rstrip("\n")).encode("cp932")
+    assert list(module.iter_decoded_lines([data]))[-1] == ROW.format(0).rstrip("\n")
+
+
+def _gzip_chunks(data, size=4096):
+    return _chunks(gzip.compress(data), size)
+
+
+def test_gzip_is_detected_and_streamed(module):
+    text = _text()
+    lines = list(module.iter_decoded_lines(module.iter_plain_chunks(_gzip_chunks(text.encode("cp932"), 50))))
+    assert "".join(lines) == text
+
+
+def test_multi_member_gzip(module):
+    first, second = _text(100).encode("utf-8"), "".join(ROW.format(i) for i in range(100, 150)).encode("utf-8")
+    data = gzip.compress(first) + gzip.compress(second)
+
+    out = b"".join(module.iter_plain_chunks(_chunks(data, 33)))
+
+    assert out == first + second
+
+
+def test_decompressed_size_is_capped(module, monkeypatch):
+    monkeypatch.setattr(module, "CSV_MAX_DECOMPRESSED_BYTES", 100_000)
+    # 圧縮爆弾（1MBのゼロが数KBに縮む）
+    bomb = _gzip_chunks(b"0" * 1_000_000)
+
+    with pytest.raises(ValueError):
+        for _ in module.iter_plain_chunks(bomb):
+            pass
+
+
+def test_decompressed_size_cap_counts_every_member(module, monkeypatch):
+    monkeypatch.setattr(module, "CSV_MAX_DECOMPRESSED_BYTES", 100_000)
+    member = gzip.compress(b"0" * 60_000)
+
+    assert sum(map(len, module.iter_plain_chunks([member]))) == 60_000
+    with pytest.raises(ValueError):
+        list(module.iter_plain_chunks([member + member]))
+
+
+def test_output_chunks_are_bounded(module):
+    out = list(module.iter_plain_chunks(_gzip_chunks(b"0" * 1_000_000, 1 << 20)))
+    assert max(map(len, out)) <= module.CSV_READ_CHUNK_SIZE
@@ -0,0 +1,78 @@
+"""家計診断ワーカー（レート制御の持ち越し・待ち時間の上限）"""
+import json
+
+import pytest
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+
+@pytest.fixture
+def worker(cloud, monkeypatch):
+    module = load_lambda("fp_comment_from_summary", filename="diagnosis_worker.py")
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+    monkeypatch.setattr(module.asyncio, "sleep", fake_sleep)
+    module.sleeps = sleeps
+    for i in range(10):
+        json_key = f"outputs/summary_{i}.json"
+        summary = {"monthly": [{"month": "2024-01", "income": 300000 + i, "expense": -250000}]}
+        cloud.s3.put_object(Bucket=BUCKET, Key=json_key, Body=json.dumps(summary).encode("utf-8"))
+        cloud.table.put_item(Item={"userId": f"U{i}", "json_path": json_key})
+    return module
+
+
+def _event(*user_ids):
+    return {"Records": [{"messageId": f"m-{user_id}", "body": json.dumps({"user_id": user_id})} for user_id in user_ids]}
+
+
+def _failed(response):
+    return [failure["itemIdentifier"] for failure in response["batchItemFailures"]]
+
+
+def test_rate_limit_carries_over_warm_invocations(cloud, worker, monkeypatch):
+    monkeypatch.setattr(worker, "FP_OPENAI_RPM", 2)
+    monkeypatch.setattr(worker, "FP_WAIT_BUDGET_SECONDS", 1.0)
+
+    # どの依頼が待たされるかは並列の順番しだい
+    assert len(_failed(worker.lambda_handler(_event("U0", "U1", "U2"), None))) == 1
+    # 次の実行でも、直前の実行で使い切った分は補充されるまで使えない
+    assert _failed(worker.lambda_handler(_event("U3"), None)) == ["m-U3"]
+    assert len(cloud.openai.requests) == 2
+    # 30秒かかる補充を実行の中では待たない
+    assert worker.sleeps == []
+
+
+def test_long_retry_after_goes_back_to_queue(cloud, worker, monkeypatch):
+    monkeypatch.setattr(worker, "FP_WAIT_BUDGET_SECONDS", 5.0)
+    cloud.async_openai.rpm_limit = 1
+
+    response = worker.lambda_handler(_event("U0", "U1"), None)
+
+    # どちらかは 429（Retry-After 約60秒）。関数の中では待たずに SQS の再配信に任せる
+    assert len(_failed(response)) == 1
+    assert cloud.async_openai.rate_limited == 1
+    assert worker.sleeps == []
+    assert all("fp_inflight_path" not in cloud.table.items[user_id] for user_id in ("U0", "U1"))
+
+
+def test_malformed_body_is_not_redelivered(cloud, worker):
+    event = _event("U0")
+    event["Records"] += [{"messageId": "m-broken", "body": "{not json"},
+                         {"messageId": "m-no-user", "body": json.dumps({"trace_id": "t"})}]
+
+    # 読めない依頼は失敗にせず捨て、同じバッチの他の依頼は処理する
+    assert _failed(worker.lambda_handler(event, None)) == []
+    assert len(cloud.openai.requests) == 1
+
+
+def test_retry_delay_is_capped():
+    module = load_lambda("fp_comment_from_summary", filename="diagnosis_worker.py")
+
+    class Error(Exception):
+        response = type("Response", (), {"headers": {"retry-after": "600"}})()
+
+    assert module.retry_delay(Error(), 0) == module.FP_RETRY_MAX_SECONDS
+    assert max(module.retry_delay(Exception(), attempt) for attempt in range(10)) <= module.FP_RETRY_MAX_SECONDS
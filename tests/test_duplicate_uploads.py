@@ -0,0 +1,57 @@
+"""同じ内容のCSVを別のキーでアップロードしたとき（集計の再利用）"""
+import json
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USER = "U1"
+CSV = ("計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID\n"
+       "1,2024/01/05,松屋,-500,カード,食費,外食,,0,a\n"
+       "1,2024/01/06,コンビニ,-300,カード,食費,コンビニ,,0,\n").encode("utf-8")
+
+
+def _upload(cloud, module, key, user_id=None):
+    if user_id:
+        # アップロードページが最新の csv_path を記録してからアップロードされる
+        cloud.table.put_item(Item={"userId": user_id, "csv_path": module.csv_path_for_key(key)})
+    cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=CSV, Metadata={"user-id": user_id} if user_id else {})
+    return module.process_object(BUCKET, key)
+
+
+def _json(cloud, key):
+    return json.loads(cloud.s3.get_object(Bucket=BUCKET, Key=key)["Body"].read())
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("同じ内容のCSVを集計し直しました")
+
+
+def test_same_bytes_without_user_reuse_stored_summary(cloud, monkeypatch):
+    module = load_lambda("mfme_csv_summary_generator")
+    _upload(cloud, module, "uploads/first.csv")
+
+    monkeypatch.setattr(module, "summarize_all", _fail)
+    _upload(cloud, module, "uploads/second.csv")
+
+    first = _json(cloud, module.summary_output_key("uploads/first.csv"))
+    assert _json(cloud, module.summary_output_key("uploads/second.csv")) == first
+
+
+def test_same_bytes_for_user_are_not_counted_twice(cloud, monkeypatch):
+    module = load_lambda("mfme_csv_summary_generator")
+    _upload(cloud, module, "uploads/first.csv", USER)
+    state_key = module.user_state_key(USER)
+    state = _json(cloud, state_key)
+    invocations = len(cloud.lambda_client.invocations)
+
+    monkeypatch.setattr(module, "skip_seen_rows", _fail)
+    response = _upload(cloud, module, "uploads/second.csv", USER)
+
+    # 途中集計は変えず、json_path は最初の集計JSONを指す
+    assert _json(cloud, state_key) == state
+    assert json.loads(response["body"])["json_path"] == module.summary_output_key("uploads/first.csv")
+    assert cloud.table.items[USER]["json_path"] == module.summary_output_key("uploads/first.csv")
+    # FPコメントも同じ集計のものなので、先行生成を依頼し直さない
+    assert len(cloud.lambda_client.invocations) == invocations
+    monthly = _json(cloud, state["latest_json_key"])["monthly"]
+    assert [(entry["month"], entry["expense"]) for entry in monthly] == [("2024-01", -800)]
@@ -0,0 +1,74 @@
+"""FPコメント（プロンプトのデータの削り方・実行中マーカー）"""
+import json
+
+import pytest
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USER = "U1"
+JSON_KEY = "outputs/summary_u1.json"
+
+
+@pytest.fixture
+def fp(cloud):
+    module = load_lambda("fp_comment_from_summary")
+    cloud.table.put_item(Item={"userId": USER, "json_path": JSON_KEY})
+    cloud.s3.put_object(Bucket=BUCKET, Key=JSON_KEY, Body=json.dumps({"monthly": []}).encode("utf-8"))
+    return module
+
+
+def _mom_row(category, delta):
+    return {"category": category, "amount": 10000 + delta, "previous": 10000, "delta": delta, "ratio": None}
+
+
+def test_budget_trims_smallest_category_changes_first(fp):
+    # 中項目名順では最後に来る大きな増減が残ること
+    mom = [_mom_row(f"中項目{i:02d}", delta) for i, delta in enumerate([10, -20, 30, 5, -40000, 15, 25000])]
+    summary = {"analytics": {
+        "latest_month": "2024-02", "previous_month": "2024-01", "top_movers": [],
+        "category_share": [], "category_mom": mom, "months": [],
+    }}
+
+    payload = fp.build_prompt_payload(summary, max_chars=400)
+
+    kept = [row["category"] for row in payload["category_mom"]]
+    assert 0 < len(kept) < len(mom)
+    assert kept[:2] == ["中項目04", "中項目06"]
+
+
+def test_precompute_failure_releases_marker_and_notifies_joined_request(cloud, fp, monkeypatch):
+    def fail_after_join(summary_json, bucket):
+        # 先行生成の途中で、利用者の依頼が合流する
+        assert fp.acquire_or_join_inflight(USER, JSON_KEY) is False
+        raise RuntimeError("S3 unavailable")
+    monkeypatch.setattr(fp, "get_or_generate_fp_comment", fail_after_join)
+
+    response = fp.lambda_handler({"user_id": USER, "precompute": True}, None)
+
+    assert response["statusCode"] == 500
+    assert "fp_inflight_path" not in cloud.table.items[USER]
+    [invocation] = cloud.lambda_client.invocations
+    assert invocation["FunctionName"] == "line_notifier"
+    assert invocation["Payload"]["message"].startswith("コメント生成エラー")
+
+
+def test_precompute_failure_without_joined_request_does_not_notify(cloud, fp, monkeypatch):
+    def fail(summary_json, bucket):
+        raise RuntimeError("S3 unavailable")
+    monkeypatch.setattr(fp, "get_or_generate_fp_comment", fail)
+
+    fp.lambda_handler({"user_id": USER, "precompute": True}, None)
+
+    assert "fp_inflight_path" not in cloud.table.items[USER]
+    assert cloud.lambda_client.invocations == []
+
+
+def test_precompute_sends_result_to_joined_request(cloud, fp, monkeypatch):
+    def generate_after_join(summary_json, bucket):
+        fp.acquire_or_join_inflight(USER, JSON_KEY)
+        return "FPコメント: 黒字です"
+    monkeypatch.setattr(fp, "get_or_generate_fp_comment", generate_after_join)
+
+    assert fp.lambda_handler({"user_id": USER, "precompute": True}, None)["statusCode"] == 200
+    assert [i["Payload"]["message"] for i in cloud.lambda_client.invocations] == ["FPコメント: 黒字です"]
@@ -0,0 +1,73 @@
+"""上位の店の推定（Space-Saving のスケッチのマージ）"""
+import random
+
+import pytest
+
+from local_stubs import load_lambda
+
+
+@pytest.fixture(scope="module")
+def hh():
+    return load_lambda("mfme_csv_summary_generator", "heavy_hitters", filename="heavy_hitters.py")
+
+
+def _uploads(seed, uploads=30, merchants=200):
+    """取り込みごとの店 -> 支出額（少数の店に偏る）"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** 1.2 for rank in range(merchants)]
+    result = []
+    for _ in range(uploads):
+        totals = {}
+        for merchant in rng.choices(range(merchants), weights, k=300):
+            totals[f"店{merchant:03d}"] = totals.get(f"店{merchant:03d}", 0) + rng.randint(100, 3000)
+        result.append(totals)
+    return result
+
+
+def _merge_all(hh, uploads, capacity):
+    sketch = {}
+    for totals in uploads:
+        sketch = hh.sketch_merge(sketch, hh.sketch_from_totals(totals, capacity), capacity)
+    return sketch
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_merged_estimates_stay_within_error_bound(hh, seed):
+    uploads = _uploads(seed)
+    exact = {}
+    for totals in uploads:
+        for merchant, value in totals.items():
+            exact[merchant] = exact.get(merchant, 0) + value
+
+    sketch = _merge_all(hh, uploads, capacity=20)
+
+    assert len(sketch) == 20
+    for merchant, (value, error) in sketch.items():
+        assert value - error <= exact[merchant] <= value
+    # スケッチにない店は、スケッチの最小値を超えない
+    floor = min(value for value, _ in sketch.values())
+    assert all(exact[merchant] <= floor for merchant in exact.keys() - sketch.keys())
+    # 上位の店は取りこぼさない
+    for merchant, _ in sorted(exact.items(), key=lambda kv: -kv[1])[:3]:
+        assert merchant in sketch
+
+
+def test_merging_partial_flushes_is_exact_within_capacity(hh):
+    uploads = [{"松屋": 500, "コンビニ": 300}, {"松屋": 700}, {"書店": 1200, "コンビニ": 200}]
+
+    sketch = _merge_all(hh, uploads, capacity=5)
+
+    assert sketch == {"松屋": [1200, 0], "コンビニ": [500, 0], "書店": [1200, 0]}
+    assert hh.sketch_top(sketch, 2) == [("書店", 1200, 0), ("松屋", 1200, 0)]
+    # マージの順番によらない
+    assert _merge_all(hh, reversed(uploads), capacity=5) == sketch
+
+
+def test_merge_of_full_sketches_carries_floor_as_error(hh):
+    a = hh.sketch_from_totals({"A": 900, "B": 500, "C": 100}, capacity=2)
+    b = hh.sketch_from_totals({"C": 800, "D": 50}, capacity=2)
+
+    merged = hh.sketch_merge(a, b, capacity=2)
+
+    # C は a で切り捨てられたので、a の最小値（500）を値と誤差の上限に加える
+    assert merged == {"C": [1300, 500], "A": [900 + 50, 50]}
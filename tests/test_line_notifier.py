@@ -0,0 +1,72 @@
+"""LINE通知の送信（宛先のまとまりごとの成否・リトライの待ち時間の上限）"""
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+from local_stubs import FakeResponse, load_lambda  # noqa: E402
+
+
+@pytest.fixture
+def notifier(cloud, monkeypatch):
+    module = load_lambda("line_nortifier")
+    sleeps = []
+    monkeypatch.setattr(module.time, "sleep", sleeps.append)
+    module.sleeps = sleeps
+    return module
+
+
+def _deliveries(count, message="月末です"):
+    return [{"userId": f"U{i:04d}", "message": message} for i in range(count)]
+
+
+def test_failed_chunk_only_fails_its_recipients(cloud, notifier):
+    def respond(method, url, **kwargs):
+        recipients = kwargs["json"]["to"]
+        # 2つ目のまとまり（U0500〜）だけ失敗させる
+        return FakeResponse(400 if "U0500" in recipients else 200)
+    cloud.http.responder = respond
+
+    response = notifier.lambda_handler({"deliveries": _deliveries(1200)}, None)
+    body = json.loads(response["body"])
+
+    assert response["statusCode"] == 500
+    assert body["sent"] == 700
+    assert body["requests"] == 2
+    assert {f["userId"] for f in body["failed"]} == {f"U{i:04d}" for i in range(500, 1000)}
+
+
+def test_failed_chunk_skips_its_remaining_messages(cloud, notifier):
+    long_message = "あ" * (notifier.MAX_TEXT_LENGTH * notifier.MAX_MESSAGES_PER_REQUEST + 1)
+    cloud.http.responder = lambda method, url, **kwargs: FakeResponse(400)
+
+    body = json.loads(notifier.lambda_handler({"deliveries": _deliveries(2, long_message)}, None)["body"])
+
+    assert body["sent"] == 0 and len(body["failed"]) == 2
+    # 1通目で失敗したので2通目は送らない
+    assert len(cloud.http.requests) == 1
+
+
+def test_retries_stop_at_the_budget(cloud, notifier, monkeypatch):
+    monkeypatch.setattr(notifier, "RETRY_BUDGET_SECONDS", 0.0)
+    cloud.http.responder = lambda method, url, **kwargs: FakeResponse(429, headers={"Retry-After": "30"})
+
+    response = notifier.lambda_handler({"userId": "U1", "message": "hi"}, None)
+
+    assert response["statusCode"] == 500
+    assert len(cloud.http.requests) == 1
+    assert notifier.sleeps == []
+
+
+def test_retries_within_the_budget(cloud, notifier):
+    statuses = iter([503, 429, 200])
+    cloud.http.responder = lambda method, url, **kwargs: FakeResponse(next(statuses), headers={"Retry-After": "1"})
+
+    response = notifier.lambda_handler({"userId": "U1", "message": "hi"}, None)
+
+    assert response["statusCode"] == 200
+    assert len(cloud.http.requests) == 3
+    assert len(notifier.sleeps) == 2
+    # 同じリトライキーで送り直す
+    assert len({r["headers"]["X-Line-Retry-Key"] for r in cloud.http.requests}) == 1
@@ -0,0 +1,72 @@
+"""店名の索引（完全一致・先頭語一致・Aho-Corasick による最長の部分一致）"""
+import pytest
+
+from local_stubs import load_lambda
+
+
+@pytest.fixture(scope="module")
+def mi():
+    return load_lambda("mfme_csv_summary_generator", "merchant_index", filename="merchant_index.py")
+
+
+def _row(memo, main, sub):
+    return {"内容": memo, "大項目": main, "中項目": sub}
+
+
+def test_normalize_merchant_folds_width_case_and_symbols(mi):
+    assert mi.normalize_merchant("ｾﾌﾞﾝ-ｲﾚﾌﾞﾝ　渋谷店") == mi.normalize_merchant("セブン－イレブン 渋谷店")
+    assert mi.normalize_merchant("Amazon.co.jp") == "AMAZONCOJP"
+    assert mi.merchant_prefix("セブン-イレブン 渋谷店") == "セブンイレブン"
+
+
+def test_longest_match_wins_for_overlapping_patterns(mi):
+    automaton = mi.build_automaton(["ABC", "BCDE", "CD", "BC"])
+
+    assert mi.find_longest_match(automaton, "XABCDEX") == "BCDE"
+    # 短いパターンが長いパターンの途中で終わる場合も、失敗遷移で拾う
+    assert mi.find_longest_match(automaton, "XXBCDX") == "BC"
+    assert mi.find_longest_match(automaton, "ZCDZ") == "CD"
+    assert mi.find_longest_match(automaton, "ZZZ") is None
+
+
+def test_pattern_inside_a_failed_longer_branch(mi):
+    # "ABCX" の途中で外れても、その中の "BC" を見落とさない
+    automaton = mi.build_automaton(["ABCX", "BC"])
+    assert mi.find_longest_match(automaton, "ABCY") == "BC"
+
+
+def test_lookup_order_exact_then_prefix_then_substring(mi):
+    index = mi.build_merchant_index([
+        _row("スターバックス 渋谷店", "食費", "外食"),
+        _row("スターバックス 渋谷店", "食費", "外食"),
+        _row("スターバックス 渋谷店", "食費", "カフェ"),
+        _row("スターバックス 新宿店", "交際費", "交際"),
+        _row("東京電力", "水道・光熱費", "電気代"),
+        _row("でんき", "その他", "その他"),
+        _row("未分類の店", "未分類", "未分類"),
+    ])
+
+    # 完全一致（同じ店名のカテゴリは多数決）
+    assert mi.lookup_merchant(index, "スターバックス　渋谷店") == ("食費", "外食")
+    # 先頭語一致
+    assert mi.lookup_merchant(index, "スターバックス 池袋店") == ("食費", "外食")
+    # 部分一致は最長の店名
+    assert mi.lookup_merchant(index, "ｶｰﾄﾞ 東京電力でんき") == ("水道・光熱費", "電気代")
+    assert mi.lookup_merchant(index, "未分類の店") is None
+    assert mi.lookup_merchant(index, "") is None
+
+
+def test_short_names_are_not_used_for_substring_match(mi):
+    index = mi.build_merchant_index([_row("AB", "食費", "外食")])
+
+    assert mi.lookup_merchant(index, "AB") == ("食費", "外食")
+    assert mi.lookup_merchant(index, "XABX") is None
+
+
+def test_merchant_name_folds_branch_suffix(mi):
+    assert mi.merchant_name("松屋 渋谷店") == mi.merchant_name("松屋　新宿東口店") == mi.merchant_name("松屋") == "松屋"
+    assert mi.merchant_name("セブン-イレブン 渋谷店") == "セブンイレブン"
+    # 空白のない支店名・支店名だけの内容はそのまま
+    assert mi.merchant_name("松屋渋谷店") == "松屋渋谷店"
+    assert mi.merchant_name("渋谷店") == "渋谷店"
+    assert mi.merchant_name("Amazon Prime") == "AMAZONPRIME"
@@ -0,0 +1,39 @@
+"""集計の実装の切り替え（numpy は選んだときだけ読み込む）"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from local_stubs import load_lambda
+
+LAMBDA_DIR = Path(__file__).resolve().parent.parent / "lambda"
+FUNCTION_DIR = LAMBDA_DIR / "mfme_csv_summary_generator"
+
+
+def test_default_backend_does_not_import_numpy():
+    # 別プロセスで import し、sys.modules に numpy がないことを確かめる
+    code = "import sys, numpy_backend; print('numpy' in sys.modules)"
+    # デプロイ時と同じく common/ のモジュールも import できるようにする
+    env = {**os.environ, "PYTHONPATH": str(LAMBDA_DIR / "common")}
+    result = subprocess.run([sys.executable, "-c", code], cwd=FUNCTION_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
+
+
+def _rows():
+    for i in range(200):
+        yield {"計算対象": "1", "日付": f"2024/{i % 3 + 1:02d}/{i % 28 + 1:02d}", "内容": f"店{i % 7}",
+               "金額（円）": str(-100 * (i % 5 + 1) if i % 10 else 300000), "保有金融機関": "カード",
+               "大項目": "収入" if i % 10 == 0 else "食費", "中項目": "未分類" if i % 4 == 0 else "外食",
+               "メモ": "", "振替": "0", "ID": f"id{i}"}
+
+
+def test_numpy_backend_matches_python(cloud, monkeypatch):
+    pytest.importorskip("numpy")
+    module = load_lambda("mfme_csv_summary_generator")
+    expected = module.summarize_all(_rows())
+
+    monkeypatch.setattr(module, "SUMMARY_BACKEND", "numpy")
+    assert module.summarize_all(_rows()) == expected
@@ -0,0 +1,77 @@
+"""集計Lambdaのハンドラー（S3イベント・SQS経由のバッチ）"""
+import json
+
+import pytest
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+CSV = ("計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID\n"
+       "1,2024/01/05,松屋,-500,カード,食費,外食,,0,a\n").encode("utf-8")
+
+
+@pytest.fixture
+def module(cloud):
+    for name in ("a", "b", "c"):
+        cloud.s3.put_object(Bucket=BUCKET, Key=f"uploads/{name}.csv", Body=CSV)
+    return load_lambda("mfme_csv_summary_generator")
+
+
+def _s3_record(key):
+    return {"eventSource": "aws:s3", "s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}
+
+
+def _sqs_record(message_id, *keys, body=None):
+    if body is None:
+        body = json.dumps({"Records": [_s3_record(key) for key in keys]})
+    return {"eventSource": "aws:sqs", "messageId": message_id, "body": body}
+
+
+def _failed(response):
+    return [failure["itemIdentifier"] for failure in response["batchItemFailures"]]
+
+
+def _summarized(cloud, module, key):
+    return (BUCKET, module.summary_output_key(key)) in cloud.s3.objects
+
+
+def test_only_messages_with_failed_objects_are_retried(cloud, module):
+    event = {"Records": [
+        _sqs_record("m1", "uploads/a.csv"),
+        _sqs_record("m2", "uploads/b.csv", "uploads/missing.csv"),
+        _sqs_record("m3", "uploads/missing.csv"),
+    ]}
+
+    assert _failed(module.lambda_handler(event, None)) == ["m2", "m3"]
+    assert _summarized(cloud, module, "uploads/a.csv")
+    assert _summarized(cloud, module, "uploads/b.csv")
+
+
+def test_malformed_message_is_reported_and_others_processed(cloud, module):
+    event = {"Records": [
+        _sqs_record("broken", body="{not json"),
+        _sqs_record("no-bucket", body=json.dumps({"Records": [{"s3": {"object": {"key": "uploads/a.csv"}}}]})),
+        # S3 のテストイベントには Records がない
+        _sqs_record("test-event", body=json.dumps({"Event": "s3:TestEvent"})),
+        _sqs_record("ok", "uploads/c.csv"),
+    ]}
+
+    assert _failed(module.lambda_handler(event, None)) == ["broken", "no-bucket"]
+    assert _summarized(cloud, module, "uploads/c.csv")
+
+
+def test_mixed_direct_and_sqs_records(cloud, module):
+    event = {"Records": [_s3_record("uploads/a.csv"), _sqs_record("m1", "uploads/b.csv")]}
+
+    assert _failed(module.lambda_handler(event, None)) == []
+    assert _summarized(cloud, module, "uploads/a.csv")
+    assert _summarized(cloud, module, "uploads/b.csv")
+
+
+def test_failed_direct_record_in_mixed_batch_fails_invocation(cloud, module):
+    event = {"Records": [_s3_record("uploads/missing.csv"), _sqs_record("m1", "uploads/b.csv")]}
+
+    # メッセージIDのないレコードは batchItemFailures で表せないので、実行全体を再試行させる
+    with pytest.raises(RuntimeError, match="uploads/missing.csv"):
+        module.lambda_handler(event, None)
+    assert _summarized(cloud, module, "uploads/b.csv")
@@ -0,0 +1,78 @@
+"""取引ストア（ユーザー・月ごとの列指向パーティション）"""
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USER = "U1"
+HEADER = "計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID"
+
+
+def _row(date, amount, memo="コンビニ", transaction_id=""):
+    return {"計算対象": "1", "日付": date, "内容": memo, "金額（円）": str(amount), "保有金融機関": "カード",
+            "大項目": "食費", "中項目": "コンビニ", "メモ": "", "振替": "0", "ID": transaction_id}
+
+
+def _store():
+    return load_lambda("mfme_csv_summary_generator", "transaction_store", filename="transaction_store.py")
+
+
+def _write(store, rows):
+    partitions = {}
+    for _ in store.collect_transactions(rows, partitions):
+        pass
+    return store.write_transactions(BUCKET, USER, partitions)
+
+
+def test_identical_rows_without_id_round_trip(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+    lines = [HEADER] + ["1,2024/01/05,コンビニ,-300,カード,食費,コンビニ,,0,"] * 2
+    cloud.s3.put_object(Bucket=BUCKET, Key="uploads/u1.csv", Body=("\n".join(lines) + "\n").encode("utf-8"),
+                        Metadata={"user-id": USER})
+    module.process_object(BUCKET, "uploads/u1.csv")
+
+    # 途中集計と同じく、同じ内容の行は別の取引として2件とも保存する
+    store = _store()
+    saved = store.read_transactions(BUCKET, USER, columns=["id", "amount"])
+    assert list(saved["amount"]) == [-300, -300]
+    assert saved["id"][1] == saved["id"][0] + "#2"
+
+
+def test_months_and_columns_are_selected(cloud):
+    store = _store()
+    rows = [_row(f"2024/{month:02d}/10", -100 * month, transaction_id=f"id{month}") for month in range(1, 5)]
+    assert _write(store, rows) == ["2024-01", "2024-02", "2024-03", "2024-04"]
+
+    assert store.list_months(BUCKET, USER) == ["2024-01", "2024-02", "2024-03", "2024-04"]
+    selected = store.read_transactions(BUCKET, USER, months=["2024-03", "2024-02"], columns=["amount", "id"])
+    assert list(selected) == ["amount", "id"]
+    assert list(selected["amount"]) == [-200, -300]
+    assert selected["id"] == ["id2", "id3"]
+
+    everything = store.read_transactions(BUCKET, USER)
+    assert list(everything) == list(store.COLUMN_TYPES)
+    assert len(everything["date"]) == 4
+
+
+def test_header_larger_than_probe_is_read(cloud):
+    store = _store()
+    # 辞書符号化した列の辞書はヘッダーに入るので、異なる値が多いとヘッダーが先頭の Range に収まらない
+    rows = [_row("2024/01/10", -i, memo=f"店舗{i:05d}", transaction_id=f"id{i:05d}") for i in range(2000)]
+    _write(store, rows)
+    obj = cloud.s3.get_object(Bucket=BUCKET, Key=store.partition_key(USER, "2024-01"))
+    header, data_start = store.decode_header(obj["Body"].read())
+    assert data_start > store.HEADER_PROBE_BYTES
+    assert len(header["columns"]["content"]["dictionary"]) == 2000
+
+    saved = store.read_transactions(BUCKET, USER, columns=["content", "amount"])
+    assert saved["content"] == [f"店舗{i:05d}" for i in range(2000)]
+    assert list(saved["amount"]) == [-i for i in range(2000)]
+
+
+def test_merge_into_existing_partition(cloud):
+    store = _store()
+    _write(store, [_row("2024/01/05", -100, transaction_id="a"), _row("2024/01/06", -200, transaction_id="b")])
+    _write(store, [_row("2024/01/06", -250, transaction_id="b"), _row("2024/01/04", -300, transaction_id="c")])
+
+    saved = store.read_transactions(BUCKET, USER, columns=["id", "amount"])
+    # 同じIDは新しい値で置き換え、日付・ID順に並べ直す
+    assert saved["id"] == ["c", "a", "b"]
+    assert list(saved["amount"]) == [-300, -100, -250]
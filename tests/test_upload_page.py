@@ -0,0 +1,69 @@
+"""アップロードページ（generate_presigned_url）"""
+import pytest
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USER = "U" + "0123456789abcdef" * 2
+
+
+@pytest.fixture
+def page(cloud, monkeypatch):
+    monkeypatch.setenv("BUCKET_NAME", BUCKET)
+    return load_lambda("generate_presigned_url")
+
+
+def test_renders_presigned_fields(cloud, page):
+    response = page.lambda_handler({"queryStringParameters": {"user_id": USER}}, None)
+
+    assert response["statusCode"] == 200
+    assert f'name="x-amz-meta-user-id" value="{USER}"' in response["body"]
+    assert cloud.table.items[USER]["csv_path"].startswith("uploads/moneyforward_")
+
+
+@pytest.mark.parametrize("query", [
+    None,
+    {},
+    {"user_id": ""},
+    {"user_id": '"><script>alert(1)</script>'},
+    {"user_id": USER + "</script>"},
+    {"user_id": USER.upper()},
+])
+def test_rejects_missing_or_malformed_user_id(cloud, page, query):
+    response = page.lambda_handler({"queryStringParameters": query}, None)
+
+    assert response["statusCode"] == 400
+    assert "<script>" not in response["body"]
+    assert cloud.table.items == {}
+
+
+def test_fields_are_escaped(cloud, page, monkeypatch):
+    def presign(s3, bucket, key, content_type, user_id, trace_id):
+        if content_type != "text/csv":
+            return {"url": "https://example.com/", "fields": {"key": key}}
+        return {"url": 'https://example.com/"><script>x</script>', "fields": {"key": key, "policy": '"><script>alert(1)</script>'}}
+    monkeypatch.setattr(page, "presign_upload", presign)
+
+    body = page.lambda_handler({"queryStringParameters": {"user_id": USER}}, None)["body"]
+
+    assert "<script>alert(1)" not in body and "<script>x" not in body
+    assert 'value="&quot;&gt;&lt;script&gt;alert(1)&lt;/script&gt;"' in body
+
+
+def test_gzip_fields_cannot_close_the_script_block(cloud, page, monkeypatch):
+    def presign(s3, bucket, key, content_type, user_id, trace_id):
+        return {"url": "https://example.com/", "fields": {"key": key, "policy": "</script><script>alert(1)</script>&"}}
+    monkeypatch.setattr(page, "presign_upload", presign)
+
+    body = page.lambda_handler({"queryStringParameters": {"user_id": USER}}, None)["body"]
+
+    script = body.split("<script>", 1)[1]
+    assert script.count("</script>") == 1
+    assert "\\u003c/script\\u003e\\u003cscript\\u003ealert(1)\\u003c/script\\u003e\\u0026" in script
+
+
+def test_script_json_round_trips():
+    import json
+    page = load_lambda("generate_presigned_url")
+    value = {"a": "</script><!-- & -->"}
+    assert json.loads(page.script_json(value)) == value
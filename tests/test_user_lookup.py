@@ -0,0 +1,77 @@
+"""アップロードしたユーザーの特定（メタデータ → csv_path のGSI）"""
+import json
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USERS = 3000
+
+
+def _seed_users(cloud, count=USERS):
+    for i in range(count):
+        cloud.table.put_item(Item={"userId": f"U{i:05d}", "csv_path": f"uploads/moneyforward_{i:05d}.csv"})
+
+
+def _csv(rows=3):
+    lines = ["計算対象,日付,内容,金額（円）,保有金融機関,大項目,中項目,メモ,振替,ID"]
+    for i in range(rows):
+        lines.append(f"1,2024/01/{i + 1:02d},コンビニ,-500,カード,食費,コンビニ,,0,id{i}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _s3_event(key):
+    return {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+
+
+def test_find_user_id_by_csv_path_queries_index(cloud):
+    _seed_users(cloud)
+    import user_repository
+
+    cloud.table.calls.clear()
+    for i in (0, 1234, USERS - 1):
+        assert user_repository.find_user_id_by_csv_path(f"uploads/moneyforward_{i:05d}.csv") == f"U{i:05d}"
+    assert user_repository.find_user_id_by_csv_path("uploads/unknown.csv") is None
+    # 1件ごとにGSIへの Query 1回。全件 Scan はしない
+    assert cloud.table.calls == ["query"] * 4
+
+
+def test_handler_uses_upload_metadata_without_table_lookup(cloud):
+    _seed_users(cloud)
+    module = load_lambda("mfme_csv_summary_generator")
+    key = "uploads/moneyforward_00042.csv"
+    cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=_csv(), Metadata={"user-id": "U00042"})
+
+    cloud.table.calls.clear()
+    response = module.lambda_handler(_s3_event(key), None)
+
+    assert response["statusCode"] == 200
+    assert "query" not in cloud.table.calls and "scan" not in cloud.table.calls
+    assert cloud.table.items["U00042"]["json_path"] == "outputs/summary_moneyforward_00042.json"
+
+
+def test_handler_falls_back_to_csv_path_index(cloud):
+    _seed_users(cloud)
+    module = load_lambda("mfme_csv_summary_generator")
+    key = "uploads/moneyforward_02999.csv"
+    cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=_csv())
+
+    cloud.table.calls.clear()
+    module.lambda_handler(_s3_event(key), None)
+
+    assert cloud.table.calls.count("query") == 1
+    assert "scan" not in cloud.table.calls
+    assert cloud.table.items["U02999"]["json_path"] == "outputs/summary_moneyforward_02999.json"
+    summary = json.loads(cloud.s3.get_object(Bucket=BUCKET, Key="outputs/summary_moneyforward_02999.json")["Body"].read())
+    assert summary["monthly"][0]["month"] == "2024-01"
+
+
+def test_batch_get_users_reads_in_batches_of_100(cloud):
+    _seed_users(cloud)
+    import user_repository
+
+    cloud.table.calls.clear()
+    items = user_repository.batch_get_users([f"U{i:05d}" for i in range(USERS)], ["csv_path"])
+
+    assert len(items) == USERS
+    assert items["U01500"] == {"userId": "U01500", "csv_path": "uploads/moneyforward_01500.csv"}
+    assert cloud.table.calls == ["batch_get_item"] * (USERS // 100)
@@ -0,0 +1,130 @@
+"""lambda/common/user_repository.py（ローカル代替の DynamoDB テーブルで実行する）"""
+import pytest
+
+from conftest import TABLE
+from local_stubs import FakeDynamoDBResource
+
+
+@pytest.fixture
+def repo(cloud):
+    import user_repository
+    return user_repository
+
+
+class FlakyDynamoDBResource(FakeDynamoDBResource):
+    """batch_get_item の最初の failures 回は、後ろ半分のキーを UnprocessedKeys として返す"""
+
+    def __init__(self, tables, failures):
+        super().__init__(tables)
+        self.failures = failures
+        self.requested = []
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        request = RequestItems[TABLE]
+        self.requested.append(len(request["Keys"]))
+        if self.failures <= 0:
+            return super().batch_get_item(RequestItems, **kwargs)
+        self.failures -= 1
+        half = len(request["Keys"]) // 2
+        response = super().batch_get_item({TABLE: {**request, "Keys": request["Keys"][:half]}}, **kwargs)
+        response["UnprocessedKeys"] = {TABLE: {**request, "Keys": request["Keys"][half:]}}
+        return response
+
+
+def _seed(cloud, count):
+    for i in range(count):
+        cloud.table.put_item(Item={"userId": f"U{i:04d}", "json_path": f"outputs/{i}.json", "csv_path": f"uploads/{i}.csv"})
+
+
+def test_get_user_reads_only_requested_attributes(cloud, repo):
+    _seed(cloud, 1)
+
+    assert repo.get_user("U0000", ["json_path"]) == {"json_path": "outputs/0.json"}
+    assert repo.get_user("U0000")["csv_path"] == "uploads/0.csv"
+    assert repo.get_user("missing", ["json_path"]) is None
+
+
+def test_batch_get_users_splits_into_100_key_requests(cloud, repo):
+    _seed(cloud, 250)
+    user_ids = [f"U{i:04d}" for i in range(250)] + ["U0000", "missing"]
+
+    items = repo.batch_get_users(user_ids, ["json_path"])
+
+    assert len(items) == 250
+    assert items["U0123"] == {"userId": "U0123", "json_path": "outputs/123.json"}
+    # 重複を除いた251件を100件ずつ
+    assert cloud.table.calls.count("batch_get_item") == 3
+
+
+def test_batch_get_users_retries_unprocessed_keys(cloud, repo, monkeypatch):
+    _seed(cloud, 150)
+    resource = FlakyDynamoDBResource(cloud.tables, failures=2)
+    sleeps = []
+    monkeypatch.setattr(repo, "get_dynamodb_resource", lambda: resource)
+    monkeypatch.setattr(repo.time, "sleep", sleeps.append)
+
+    items = repo.batch_get_users([f"U{i:04d}" for i in range(150)])
+
+    assert len(items) == 150
+    # 1つ目の100件は 100 -> 50（未処理）-> 25（未処理）と読み直し、2つ目の50件は1回で読める
+    assert resource.requested == [100, 50, 25, 50]
+    assert sleeps == [0.05, 0.1]
+
+
+def test_batch_get_users_gives_up_after_max_retries(cloud, repo, monkeypatch):
+    _seed(cloud, 10)
+    monkeypatch.setattr(repo, "get_dynamodb_resource", lambda: FlakyDynamoDBResource(cloud.tables, failures=100))
+    monkeypatch.setattr(repo.time, "sleep", lambda seconds: None)
+
+    with pytest.raises(RuntimeError):
+        repo.batch_get_users([f"U{i:04d}" for i in range(10)])
+
+
+def test_create_user_does_not_overwrite(cloud, repo):
+    assert repo.create_user("U1", {"csv_path": "uploads/a.csv"}) is True
+    assert repo.create_user("U1", {"csv_path": "uploads/b.csv"}) is False
+    assert cloud.table.items["U1"] == {"userId": "U1", "csv_path": "uploads/a.csv"}
+
+
+def test_update_user_sets_and_removes_only_given_attributes(cloud, repo):
+    _seed(cloud, 1)
+    cloud.table.items["U0000"]["fp_inflight_path"] = "outputs/0.json"
+
+    updated = repo.update_user("U0000", {"json_path": "outputs/new.json"}, remove=("fp_inflight_path",),
+                               return_values="UPDATED_NEW")
+
+    assert updated == {"json_path": "outputs/new.json"}
+    assert cloud.table.items["U0000"] == {"userId": "U0000", "json_path": "outputs/new.json", "csv_path": "uploads/0.csv"}
+
+
+def test_update_user_condition(cloud, repo):
+    _seed(cloud, 1)
+
+    assert repo.update_user("U0000", {"json_path": "x"}, condition="csv_path = :p",
+                            condition_values={":p": "uploads/other.csv"}) is None
+    assert cloud.table.items["U0000"]["json_path"] == "outputs/0.json"
+
+    old = repo.update_user("U0000", {"json_path": "x"}, condition="csv_path = :p",
+                           condition_values={":p": "uploads/0.csv"}, return_values="ALL_OLD")
+    assert old["json_path"] == "outputs/0.json"
+    assert cloud.table.items["U0000"]["json_path"] == "x"
+
+
+def test_update_user_without_attributes_is_rejected(cloud, repo):
+    _seed(cloud, 1)
+
+    with pytest.raises(ValueError):
+        repo.update_user("U0000", {}, condition="attribute_exists(userId)")
+    assert "update_item" not in cloud.table.calls
+
+    # REMOVE だけの更新はできる
+    repo.update_user("U0000", remove=("json_path",))
+    assert "json_path" not in cloud.table.items["U0000"]
+
+
+def test_find_user_id_by_csv_path(cloud, repo):
+    _seed(cloud, 5)
+    cloud.table.put_item(Item={"userId": "no-csv"})
+
+    assert repo.find_user_id_by_csv_path("uploads/3.csv") == "U0003"
+    assert repo.find_user_id_by_csv_path("uploads/unknown.csv") is None
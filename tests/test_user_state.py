@@ -0,0 +1,88 @@
+"""ユーザーごとの途中集計（取り込み済みの取引の重複排除）"""
+import json
+
+from conftest import BUCKET
+from local_stubs import load_lambda
+
+USER = "U1"
+
+
+def _row(date, amount, memo="コンビニ", transaction_id=""):
+    return {"計算対象": "1", "日付": date, "内容": memo, "金額（円）": str(amount), "保有金融機関": "カード",
+            "大項目": "食費", "中項目": "コンビニ", "メモ": "", "振替": "0", "ID": transaction_id}
+
+
+def _summarize(module, rows):
+    result, _ = module.summarize_into_user_state(BUCKET, USER, lambda: iter(rows))
+    return {entry["month"]: entry["expense"] for entry in result["monthly"]}
+
+
+def _state(module, cloud):
+    obj = cloud.s3.get_object(Bucket=BUCKET, Key=module.user_state_key(USER))
+    return json.loads(obj["Body"].read())
+
+
+def test_rows_without_id_are_deduplicated_across_uploads(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+    rows = [_row("2024/01/05", -500), _row("2024/01/05", -500), _row("2024/01/06", -300)]
+
+    assert _summarize(module, rows) == {"2024-01": -1300}
+    # 同じ内容の行は別の取引として数え、同じ行の再アップロードは数えない
+    assert _summarize(module, rows + [_row("2024/01/07", -200)]) == {"2024-01": -1500}
+
+
+def test_seen_ids_are_kept_only_for_recent_months(cloud, monkeypatch):
+    module = load_lambda("mfme_csv_summary_generator")
+    monkeypatch.setattr(module, "SEEN_IDS_MONTHS", 3)
+    rows = [_row(f"2024/{month:02d}/10", -100, transaction_id=f"id{month}") for month in range(1, 7)]
+
+    _summarize(module, rows)
+    assert sorted(_state(module, cloud)["seen_ids"]) == ["2024-04", "2024-05", "2024-06"]
+
+    # 締めた月（1〜3月）は取り込み済みなので、新しい取引があっても読み飛ばす
+    again = rows + [_row("2024/02/11", -999, transaction_id="late"), _row("2024/06/11", -50, transaction_id="new")]
+    monthly = _summarize(module, again)
+    assert monthly["2024-02"] == -100
+    assert monthly["2024-06"] == -150
+
+
+def test_closed_months_not_yet_imported_are_added(cloud, monkeypatch):
+    module = load_lambda("mfme_csv_summary_generator")
+    monkeypatch.setattr(module, "SEEN_IDS_MONTHS", 3)
+    _summarize(module, [_row("2024/06/10", -100, transaction_id="a")])
+
+    monthly = _summarize(module, [_row("2023/01/10", -700, transaction_id="old")])
+    assert monthly == {"2023-01": -700, "2024-06": -100}
+    assert sorted(_state(module, cloud)["seen_ids"]) == ["2024-06"]
+
+
+def test_version_1_state_keeps_legacy_ids(cloud):
+    module = load_lambda("mfme_csv_summary_generator")
+    _summarize(module, [_row("2024/01/05", -500, transaction_id="a")])
+    state = _state(module, cloud)
+    legacy = {"version": 1, "seen_ids": ["a"], "groups": state["groups"]}
+    cloud.s3.put_object(Bucket=BUCKET, Key=module.user_state_key(USER), Body=json.dumps(legacy).encode())
+
+    monthly = _summarize(module, [_row("2024/01/05", -500, transaction_id="a"), _row("2024/01/08", -10, transaction_id="b")])
+
+    assert monthly == {"2024-01": -510}
+    state = _state(module, cloud)
+    assert state["version"] == 2
+    assert state["legacy_seen_ids"] == {"ids": ["a"], "until": "2024-01"}
+
+
+def test_warns_when_state_predates_current_summary_version(cloud, capsys):
+    module = load_lambda("mfme_csv_summary_generator")
+    _summarize(module, [_row("2024/01/05", -500, transaction_id="a")])
+    assert _state(module, cloud)["groups_version"] == module.SUMMARY_VERSION
+
+    state = _state(module, cloud)
+    state.pop("groups_version")
+    cloud.s3.put_object(Bucket=BUCKET, Key=module.user_state_key(USER), Body=json.dumps(state).encode())
+    capsys.readouterr()
+
+    _summarize(module, [_row("2024/01/06", -100, transaction_id="b")])
+
+    assert "tools/backfill_summaries.py" in capsys.readouterr().out
+    # 新しい取引を取り込んでも、古い形式から始まった途中集計のまま
+    assert _state(module, cloud)["groups_version"] is None
@@ -0,0 +1,302 @@
+"""アップロード済みCSVの集計JSON（outputs/summary_*.json）を一括で作り直す。
+
+uploads/ 配下をページングしながら列挙し、プロセスプールで並列に再集計する。処理したキーは
+チェックポイントファイルに追記するため、中断しても同じコマンドで続きから再開できる。
+
+- userId のないアップロード: 出力が最新のもの（メタデータの summary-version が現在の SUMMARY_VERSION で、
+  CSVより後に書かれたもの）は飛ばし、残りをそのCSV単体で集計し直す
+- userId のあるアップロード（メタデータ、または csv_path のGSIで分かるもの）: 出力はそのユーザーの
+  全期間の集計なので、途中集計 state/{userId}/aggregate.json が現在の形式で作られたもの（groups_version）なら飛ばす。
+  そうでなければ途中集計を空にして、ユーザーのアップロードを古い順に取り込み直し、各出力を書き直す
+  （DynamoDB の json_path は変わらない）。作り直しの途中に届いたアップロードの出力は、次のアップロードで最新になる
+
+使い方:
+    python tools/backfill_summaries.py --bucket my-bucket --workers 8
+    python tools/backfill_summaries.py --bucket my-bucket --dry-run
+    # ディレクトリ上のS3代替に合成CSVを2000件置いて実行する
+    python tools/backfill_summaries.py --local-dir /tmp/s3 --seed 2000 --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from local_stubs import COMMON_DIR, DirectoryS3, LocalCloud, load_lambda  # noqa: E402
+
+LOCAL_BUCKET = "local-bucket"
+UPLOAD_SUFFIXES = (".csv", ".csv.gz")
+# 投入済みで未完了のタスクの上限（ワーカー数に対する倍率）
+MAX_PENDING_PER_WORKER = 4
+PROGRESS_INTERVAL_SECONDS = 2.0
+
+# --- ワーカープロセス ---
+
+_module = None
+
+
+def _install_clients(local_dir):
+    if local_dir:
+        LocalCloud(s3=DirectoryS3(local_dir)).install()
+    elif str(COMMON_DIR) not in sys.path:
+        sys.path.insert(0, str(COMMON_DIR))
+
+
+def _init_worker(local_dir, quiet):
+    global _module
+    _install_clients(local_dir)
+    _module = load_lambda("mfme_csv_summary_generator")
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+
+def _is_current(bucket, output_key, uploaded_at):
+    s3 = _module.get_client("s3")
+    try:
+        head = s3.head_object(Bucket=bucket, Key=output_key)
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    version = head.get("Metadata", {}).get(_module.SUMMARY_VERSION_METADATA_KEY)
+    return version == _module.SUMMARY_VERSION and head["LastModified"] >= uploaded_at
+
+
+def _upload_user_id(bucket, key):
+    s3 = _module.get_client("s3")
+    metadata = s3.head_object(Bucket=bucket, Key=key).get("Metadata", {})
+    return metadata.get(_module.USER_ID_METADATA_KEY) or _module.find_user_id_by_csv_path(_module.csv_path_for_key(key))
+
+
+def backfill_one(bucket, key, uploaded_at, force=False, dry_run=False):
+    """1件の再集計。戻り値は (キー, 状態, 詳細)。状態は written / skipped / stale / failed（詳細はエラー）、
+    またはユーザーのアップロードなら user（詳細は userId。rebuild_user でまとめて作り直す）"""
+    output_key = _module.summary_output_key(key)
+    try:
+        user_id = _upload_user_id(bucket, key)
+        if user_id:
+            return key, "user", user_id
+        if not force and _is_current(bucket, output_key, uploaded_at):
+            return key, "skipped", None
+        if dry_run:
+            return key, "stale", None
+        response = _module.get_csv_object(bucket, key)
+        result = _module.summarize_all(_module.load_rows(bucket, response))
+        result["analytics"] = _module.build_analytics(result)
+        _module.write_json_to_s3(result, bucket, output_key)
+    except Exception as e:
+        return key, "failed", f"{type(e).__name__}: {e}"
+    return key, "written", None
+
+
+def _reset_user_state(bucket, user_id, state, etag):
+    """途中集計を空にする（groups_version を付けないので、作り直しが終わるまでは古い形式とみなされる）"""
+    empty = {"version": _module.USER_STATE_VERSION, "seen_ids": {}, "groups": {}}
+    if not _module.save_user_state(bucket, user_id, empty, etag):
+        raise RuntimeError("途中集計が更新されたため作り直せませんでした")
+
+
+def _mark_user_state_current(bucket, user_id):
+    for _ in range(_module.USER_STATE_MAX_RETRIES):
+        state, etag = _module.load_user_state(bucket, user_id)
+        if _module.save_user_state(bucket, user_id, {**state, "groups_version": _module.SUMMARY_VERSION}, etag):
+            return
+    raise RuntimeError("途中集計を更新できませんでした")
+
+
+def _replay_upload(bucket, user_id, key):
+    """lambda_function.process_object と同じく、アップロードを途中集計に取り込んで出力を書く"""
+    response = _module.get_csv_object(bucket, key)
+    pending = [_module.load_rows(bucket, response)]
+
+    def open_rows():
+        return pending.pop() if pending else _module.load_rows(bucket, _module.get_csv_object(bucket, key))
+
+    output_key = _module.summary_output_key(key)
+    result, _ = _module.summarize_into_user_state(bucket, user_id, open_rows, response.get("ETag"), output_key)
+    if result is None:
+        # 同じ内容のCSVを先に取り込んでいる。出力はそのCSVの集計JSONが参照される
+        response["Body"].close()
+        return "skipped"
+    result["analytics"] = _module.build_analytics(result)
+    _module.write_json_to_s3(result, bucket, output_key)
+    return "written"
+
+
+def rebuild_user(bucket, user_id, keys, force=False, dry_run=False):
+    """ユーザーの途中集計と出力の作り直し。keys はアップロードの古い順。戻り値は backfill_one と同じ形のリスト"""
+    try:
+        state, etag = _module.load_user_state(bucket, user_id)
+        if not force and etag and state.get("groups_version") == _module.SUMMARY_VERSION:
+            return [(key, "skipped", None) for key in keys]
+        if dry_run:
+            return [(key, "stale", None) for key in keys]
+        _reset_user_state(bucket, user_id, state, etag)
+        statuses = [_replay_upload(bucket, user_id, key) for key in keys]
+        _mark_user_state_current(bucket, user_id)
+    except Exception as e:
+        return [(key, "failed", f"{type(e).__name__}: {e}") for key in keys]
+    return [(key, status, None) for key, status in zip(keys, statuses)]
+
+# --- 親プロセス ---
+
+
+def iter_uploads(s3, bucket, prefix):
+    """(キー, 更新日時) をページングしながら返す"""
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(UPLOAD_SUFFIXES):
+                yield obj["Key"], obj["LastModified"]
+
+
+def load_checkpoint(path):
+    """完了済み（書き込み済み・最新）のキー。失敗したキーは次回も処理する
+    ユーザーのアップロードは、途中集計を作り直すときに全件を取り込み直すため毎回列挙する（作り直し済みなら飛ばされる）"""
+    done = set()
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry["status"] in ("written", "skipped") and not entry.get("user"):
+                        done.add(entry["key"])
+    return done
+
+
+def seed_uploads(s3, bucket, count, rows):
+    from generate_mfme_csv import generate_csv_bytes
+    for i in range(count):
+        data = generate_csv_bytes(rows=rows, months=3, seed=i)
+        s3.put_object(Bucket=bucket, Key=f"uploads/moneyforward_seed{i:06d}.csv", Body=data, Metadata={"user-id": f"Useed{i % 100:04d}"})
+    print(f"合成CSVを {count} 件配置しました")
+
+
+class Progress:
+    def __init__(self):
+        self.counts = {"written": 0, "skipped": 0, "stale": 0, "failed": 0}
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def add(self, status):
+        self.counts[status] += 1
+        now = time.perf_counter()
+        if now - self.reported >= PROGRESS_INTERVAL_SECONDS:
+            self.reported = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.total / elapsed if elapsed else 0.0
+        detail = " / ".join(f"{name} {count}" for name, count in self.counts.items())
+        print(f"[進捗] {self.total} 件 ({detail}) {rate:.1f} 件/秒", file=sys.stderr, flush=True)
+
+
+def run(bucket, prefix, workers, checkpoint, local_dir=None, force=False, dry_run=False, quiet=True):
+    _install_clients(local_dir)
+    import clients
+    s3 = clients.get_client("s3")
+
+    done = set() if force else load_checkpoint(checkpoint)
+    progress = Progress()
+    failures = []
+    # userId -> [(更新日時, キー)]。全件を列挙してからユーザーごとに作り直す
+    user_uploads = {}
+    uploaded_at_by_key = {}
+    checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint and not dry_run else None
+
+    def record(key, status, error, user=False):
+        progress.add(status)
+        if status == "failed":
+            failures.append((key, error))
+        if checkpoint_file:
+            entry = {"key": key, "status": status, "error": error}
+            if user:
+                entry["user"] = True
+            checkpoint_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            checkpoint_file.flush()
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            if isinstance(result, list):
+                for entry in result:
+                    record(*entry, user=True)
+                continue
+            key, status, detail = result
+            if status == "user":
+                user_uploads.setdefault(detail, []).append((uploaded_at_by_key.pop(key), key))
+            else:
+                uploaded_at_by_key.pop(key, None)
+                record(key, status, detail)
+
+    def submit(executor, pending, fn, *args):
+        if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+        pending.add(executor.submit(fn, *args))
+        return pending
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(local_dir, quiet)) as executor:
+            pending = set()
+            for key, uploaded_at in iter_uploads(s3, bucket, prefix):
+                if key in done:
+                    continue
+                uploaded_at_by_key[key] = uploaded_at
+                pending = submit(executor, pending, backfill_one, bucket, key, uploaded_at, force, dry_run)
+            collect(wait(pending).done)
+
+            pending = set()
+            for user_id, uploads in sorted(user_uploads.items()):
+                keys = [key for _, key in sorted(uploads)]
+                pending = submit(executor, pending, rebuild_user, bucket, user_id, keys, force, dry_run)
+            collect(wait(pending).done)
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    progress.report()
+    for key, error in failures:
+        print(f"[ERROR] {key}: {error}", file=sys.stderr)
+    return progress.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=os.environ.get("S3_BUCKET_NAME"), help="対象バケット（既定は S3_BUCKET_NAME）")
+    parser.add_argument("--prefix", default="uploads/")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.jsonl", help="処理済みのキーを追記するファイル")
+    parser.add_argument("--force", action="store_true", help="最新の出力も作り直す（チェックポイントも無視する）")
+    parser.add_argument("--dry-run", action="store_true", help="作り直しが必要なキーを数えるだけ")
+    parser.add_argument("--local-dir", help="S3の代わりに使うディレクトリ（ローカル検証用）")
+    parser.add_argument("--seed", type=int, default=0, help="--local-dir に合成CSVをこの件数だけ配置してから実行する")
+    parser.add_argument("--seed-rows", type=int, default=200, help="合成CSV1件あたりの行数")
+    parser.add_argument("--verbose", action="store_true", help="ワーカーのログを表示する")
+    args = parser.parse_args()
+
+    if args.local_dir:
+        args.bucket = args.bucket or LOCAL_BUCKET
+        os.environ.setdefault("DYNAMODB_TABLE_NAME", "users")
+        os.environ.setdefault("OPENAI_API_KEY", "local")
+        if args.seed:
+            seed_uploads(DirectoryS3(args.local_dir), args.bucket, args.seed, args.seed_rows)
+    if not args.bucket:
+        parser.error("--bucket か環境変数 S3_BUCKET_NAME を指定してください")
+
+    counts = run(args.bucket, args.prefix, args.workers, args.checkpoint, local_dir=args.local_dir,
+                 force=args.force, dry_run=args.dry_run, quiet=not args.verbose)
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
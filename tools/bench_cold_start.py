@@ -0,0 +1,138 @@
+"""各Lambdaハンドラのコールドスタート計測。
+
+ハンドラごとに新しいPythonプロセスを起動し、
+  - import 時間（lambda_function と依存ライブラリの読み込み）
+  - 初回呼び出しのレイテンシ（クライアント生成などの遅延初期化を含む）
+  - 2回目呼び出しのレイテンシ（ウォーム時）
+を計測する。AWS / OpenAI / LINE への通信は tools/local_stubs.py の代替に置き換える。
+
+使い方:
+    python tools/bench_cold_start.py [--runs 5] [--output cold_start.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+
+BUCKET = "local-bucket"
+TABLE = "users"
+USER_ID = "U0000000000000000000000000000bec4"
+CSV_KEY = "uploads/moneyforward_bench.csv"
+JSON_KEY = "outputs/summary_moneyforward_bench.json"
+
+SAMPLE_CSV = (
+    '"計算対象","日付","内容","金額（円）","保有金融機関","大項目","中項目","メモ","振替","ID"\r\n'
+    + "".join(
+        f'"1","2024/{month:02d}/{day:02d}","セブン-イレブン","-{300 + day}","カード","食費","コンビニ","","0","bench{month}{day}"\r\n'
+        for month in range(1, 4) for day in range(1, 29)
+    )
+    + '"1","2024/01/25","給与","300000","銀行","収入","給与","","0","bench-salary"\r\n'
+)
+
+# ハンドラ名 -> (ディレクトリ, イベント)
+HANDLERS = {
+    "line_userid_catcher": ("line_userid_catcher", {
+        "body": json.dumps({"events": [{
+            "type": "message",
+            "source": {"userId": USER_ID},
+            "message": {"type": "text", "text": "家計ファイルをアップロードしたい"},
+        }]}, ensure_ascii=False),
+    }),
+    "generatePresignedUrl": ("generate_presigned_url", {
+        "queryStringParameters": {"user_id": USER_ID},
+    }),
+    "line_notifier": ("line_nortifier", {"userId": USER_ID, "message": "ベンチマーク"}),
+    "mfme_csv_summary_generator": ("mfme_csv_summary_generator", {
+        "Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": CSV_KEY}}}],
+    }),
+    "fp_comment_from_summary": ("fp_comment_from_summary", {"user_id": USER_ID}),
+}
+
+
+def _set_environment():
+    os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+    os.environ.setdefault("DYNAMODB_TABLE_NAME", TABLE)
+    os.environ.setdefault("BUCKET_NAME", BUCKET)
+    os.environ.setdefault("S3_BUCKET_NAME", BUCKET)
+    os.environ.setdefault("API_GATEWAY_DOMAIN", "localhost")
+    os.environ.setdefault("OPENAI_API_KEY", "local")
+    os.environ.setdefault("LINE_CHANNEL_TOKEN", "local")
+
+
+def _seed(cloud):
+    cloud.s3.put_object(Bucket=BUCKET, Key=CSV_KEY, Body=SAMPLE_CSV.encode("cp932"), Metadata={"user-id": USER_ID})
+    cloud.s3.put_object(Bucket=BUCKET, Key=JSON_KEY, Body=json.dumps({"monthly": []}).encode("utf-8"))
+    cloud.table.put_item(Item={"userId": USER_ID, "csv_path": CSV_KEY, "json_path": JSON_KEY})
+
+
+def run_child(name):
+    """1ハンドラ分を計測して JSON を1行出力する（子プロセス側）"""
+    sys.path.insert(0, str(TOOLS_DIR))
+    _set_environment()
+    from local_stubs import LocalCloud, load_lambda
+
+    cloud = LocalCloud(table_name=TABLE).install()
+    _seed(cloud)
+    directory, event = HANDLERS[name]
+
+    start = time.perf_counter()
+    module = load_lambda(directory)
+    imported = time.perf_counter()
+    module.lambda_handler(json.loads(json.dumps(event)), None)
+    first = time.perf_counter()
+    module.lambda_handler(json.loads(json.dumps(event)), None)
+    second = time.perf_counter()
+
+    print(json.dumps({
+        "handler": name,
+        "import_ms": (imported - start) * 1000,
+        "first_invoke_ms": (first - imported) * 1000,
+        "warm_invoke_ms": (second - first) * 1000,
+    }))
+
+
+def measure(name):
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, __file__, "--child", name],
+        capture_output=True, text=True, check=True,
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["process_ms"] = process_ms
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="ハンドラごとの計測回数（中央値を表示）")
+    parser.add_argument("--handler", action="append", choices=sorted(HANDLERS), help="計測するハンドラ（複数指定可）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        return
+
+    fields = ["import_ms", "first_invoke_ms", "warm_invoke_ms", "process_ms"]
+    results = {}
+    print(f"{'handler':<28}" + "".join(f"{f:>18}" for f in fields))
+    for name in args.handler or HANDLERS:
+        runs = [measure(name) for _ in range(args.runs)]
+        results[name] = {f: statistics.median(r[f] for r in runs) for f in fields}
+        print(f"{name:<28}" + "".join(f"{results[name][f]:>18.1f}" for f in fields))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": args.runs, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
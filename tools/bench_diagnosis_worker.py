@@ -0,0 +1,124 @@
+"""家計診断ワーカー（fp_comment_from_summary/diagnosis_worker.py）のスループット計測。
+
+月末の夜に多数の利用者が一斉に「家計診断をお願いします」と送った状況を模擬する。
+利用者ごとに異なる集計JSONを用意してSQS代替に依頼を積み、ワーカーをバッチごとに実行して
+全件の処理時間・429 の発生数・再試行に回った件数を表示する。
+OpenAI 代替は --openai-latency 秒かかり、直近60秒で --quota-rpm 件を超えると 429 を返す。
+--sequential を付けると、従来の fp_comment_from_summary を1件ずつ呼んだ場合と比べる。
+
+使い方:
+    python tools/bench_diagnosis_worker.py --users 200 --openai-latency 2 --quota-rpm 600 --worker-rpm 500
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from local_stubs import LocalCloud, load_lambda  # noqa: E402
+
+BUCKET = "local-bucket"
+TABLE = "users"
+QUEUE_URL = "https://sqs.local/fp-requests"
+
+
+def _setup(users, openai_latency, quota_rpm):
+    for name, value in {
+        "DYNAMODB_TABLE_NAME": TABLE,
+        "S3_BUCKET_NAME": BUCKET,
+        "OPENAI_API_KEY": "local",
+    }.items():
+        os.environ.setdefault(name, value)
+    cloud = LocalCloud(table_name=TABLE).install()
+    cloud.openai.latency = openai_latency
+    cloud.async_openai.rpm_limit = quota_rpm
+    from user_repository import batch_put_users
+    items = []
+    for i in range(users):
+        user_id = f"U{i:032x}"
+        json_key = f"outputs/summary_bench_{i}.json"
+        summary = {"monthly": [{"month": "2024-01", "income": 300000 + i, "expense": -250000, "net": 550000 + i}]}
+        cloud.s3.put_object(Bucket=BUCKET, Key=json_key, Body=json.dumps(summary).encode("utf-8"))
+        items.append({"userId": user_id, "json_path": json_key})
+    batch_put_users(items)
+    return cloud, [item["userId"] for item in items]
+
+
+def _quiet(func):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        return func()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_worker(args):
+    cloud, user_ids = _setup(args.users, args.openai_latency, args.quota_rpm)
+    os.environ["FP_REQUEST_QUEUE_URL"] = QUEUE_URL
+    os.environ["FP_OPENAI_RPM"] = str(args.worker_rpm)
+    os.environ["FP_MAX_CONCURRENCY"] = str(args.concurrency)
+    os.environ["FP_RETRY_BASE_SECONDS"] = "0.2"
+    catcher = load_lambda("line_userid_catcher")
+    worker = load_lambda("fp_comment_from_summary", filename="diagnosis_worker.py")
+
+    event = {"body": json.dumps({"events": [
+        {"type": "message", "source": {"userId": user_id}, "message": {"type": "text", "text": "家計診断をお願いします"}}
+        for user_id in user_ids
+    ]}, ensure_ascii=False)}
+    _quiet(lambda: catcher.lambda_handler(event, None))
+
+    start = time.perf_counter()
+    batches = 0
+    retried = 0
+    while cloud.sqs.messages:
+        batch = cloud.sqs.receive_event(args.batch_size)
+        result = _quiet(lambda: worker.lambda_handler(batch, None))
+        failed = {f["itemIdentifier"] for f in result["batchItemFailures"]}
+        retried += len(failed)
+        # 再試行に回った依頼はキューに戻す
+        cloud.sqs.messages.extend(r for r in batch["Records"] if r["messageId"] in failed)
+        batches += 1
+    elapsed = time.perf_counter() - start
+    delivered = sum(len(i["Payload"].get("deliveries", [])) for i in cloud.lambda_client.invocations
+                    if i["FunctionName"] == "line_notifier")
+    return {"seconds": elapsed, "batches": batches, "delivered": delivered,
+            "rate_limited": cloud.async_openai.rate_limited, "retried_messages": retried}
+
+
+def bench_sequential(args):
+    cloud, user_ids = _setup(args.users, args.openai_latency, None)
+    function = load_lambda("fp_comment_from_summary")
+    start = time.perf_counter()
+    for user_id in user_ids:
+        _quiet(lambda: function.lambda_handler({"user_id": user_id}, None))
+    return {"seconds": time.perf_counter() - start, "delivered": len(user_ids)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="同時に依頼する利用者数")
+    parser.add_argument("--batch-size", type=int, default=10, help="SQSトリガーのバッチサイズ")
+    parser.add_argument("--concurrency", type=int, default=16, help="FP_MAX_CONCURRENCY")
+    parser.add_argument("--openai-latency", type=float, default=2.0, help="OpenAI 応答の遅延（秒）")
+    parser.add_argument("--quota-rpm", type=int, default=600, help="OpenAI 代替が 429 を返し始める1分あたりの件数")
+    parser.add_argument("--worker-rpm", type=int, default=500, help="ワーカーのレート制御の RPM（FP_OPENAI_RPM）")
+    parser.add_argument("--sequential", action="store_true", help="従来の1件ずつの処理と比べる")
+    args = parser.parse_args()
+
+    result = bench_worker(args)
+    print(f"worker:     {result['seconds']:8.2f} s  {args.users / result['seconds']:7.1f} 件/秒  "
+          f"batches={result['batches']} delivered={result['delivered']} "
+          f"429={result['rate_limited']} retried={result['retried_messages']}")
+    if args.sequential:
+        baseline = bench_sequential(args)
+        print(f"sequential: {baseline['seconds']:8.2f} s  {args.users / baseline['seconds']:7.1f} 件/秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""mfme_csv_summary_generator のベンチマーク。
+
+合成CSV（tools/generate_mfme_csv.py）をローカルのS3/DynamoDB代替に置き、
+parse_csv_from_s3・各 summarize_* 関数・ハンドラ全体の実行時間とピークメモリを計測する。
+結果は bench_results/summary_<日時>.json に保存し、前回の結果との差分を表示する。
+
+使い方:
+    python tools/bench_summary.py --rows 1000 --rows 10000 --rows 100000
+    python tools/bench_summary.py --backend numpy   # NumPy の集計（SUMMARY_BACKEND=numpy 相当）
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+REPO_DIR = TOOLS_DIR.parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from generate_mfme_csv import generate_csv_bytes  # noqa: E402
+from local_stubs import LocalCloud, load_lambda  # noqa: E402
+
+BUCKET = "bench-bucket"
+TABLE = "users"
+USER_ID = "Ubench"
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+SUMMARIZE_FUNCTIONS = [
+    "summarize_weekly",
+    "summarize_monthly",
+    "summarize_by_category",
+    "summarize_category_weekly",
+    "summarize_category_monthly",
+    "summarize_unclassified_total",
+    "summarize_top_merchants",
+    "summarize_all",
+]
+
+
+def _measure(func, repeat):
+    """実行時間（最小値, 秒）とピークメモリ（bytes）を返す"""
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+
+def _setup(rows, months, unclassified_ratio, seed, backend):
+    os.environ.setdefault("DYNAMODB_TABLE_NAME", TABLE)
+    os.environ.setdefault("OPENAI_API_KEY", "local")
+    cloud = LocalCloud(table_name=TABLE).install()
+    module = load_lambda("mfme_csv_summary_generator")
+    module.SUMMARY_BACKEND = backend
+    data = generate_csv_bytes(rows=rows, months=months, unclassified_ratio=unclassified_ratio, seed=seed)
+    key = f"uploads/moneyforward_bench_{rows}.csv"
+    cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=data, Metadata={"user-id": USER_ID})
+    cloud.table.put_item(Item={"userId": USER_ID, "csv_path": key})
+    return cloud, module, key, len(data)
+
+
+def bench_size(rows, months, unclassified_ratio, repeat, seed=0, backend="python"):
+    cloud, module, key, size = _setup(rows, months, unclassified_ratio, seed, backend)
+    results = {"rows": rows, "bytes": size, "stages": {}}
+
+    def record(name, func):
+        seconds, peak = _measure(func, repeat)
+        results["stages"][name] = {"seconds": seconds, "rows_per_second": rows / seconds if seconds else None, "peak_bytes": peak}
+        print(f"  {name:<32}{seconds * 1000:>12.1f} ms{peak / 1024 / 1024:>12.1f} MiB")
+
+    record("parse_csv_from_s3", lambda: module.parse_csv_from_s3(BUCKET, key))
+    parsed = module.parse_csv_from_s3(BUCKET, key)
+    for name in SUMMARIZE_FUNCTIONS:
+        record(name, lambda name=name: getattr(module, name)(parsed))
+    del parsed
+
+    event = {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]}
+
+    def run_handler():
+        # 毎回新規ユーザーとして集計する（途中集計が溜まらないようにする）
+        cloud.s3.delete_object(Bucket=BUCKET, Key=module.user_state_key(USER_ID))
+        module.lambda_handler(event, None)
+
+    # ハンドラのログ出力は計測から除く
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        seconds, peak = _measure(run_handler, repeat)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    results["stages"]["lambda_handler"] = {"seconds": seconds, "rows_per_second": rows / seconds, "peak_bytes": peak}
+    print(f"  {'lambda_handler':<32}{seconds * 1000:>12.1f} ms{peak / 1024 / 1024:>12.1f} MiB")
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _previous_result(output_dir):
+    files = sorted(output_dir.glob("summary_*.json"))
+    if not files:
+        return None
+    with open(files[-1], encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(previous, current):
+    """前回からの実行時間の変化（%）を表示する"""
+    before = {r["rows"]: r for r in previous["results"]}
+    print(f"\n前回 ({previous.get('revision')} {previous.get('timestamp')}) との比較:")
+    for result in current["results"]:
+        old = before.get(result["rows"])
+        if not old:
+            continue
+        for stage, stats in result["stages"].items():
+            old_stats = old["stages"].get(stage)
+            if old_stats and old_stats["seconds"]:
+                change = (stats["seconds"] - old_stats["seconds"]) / old_stats["seconds"] * 100
+                flag = "  ← 悪化" if change > 10 else ""
+                print(f"  {result['rows']:>9} 行 {stage:<32}{change:>+8.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, action="append", help="行数（複数指定可）")
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--unclassified-ratio", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数（最小値を採用）")
+    parser.add_argument("--backend", choices=["python", "numpy"], default="python", help="集計の実装")
+    parser.add_argument("--output-dir", default=str(REPO_DIR / "bench_results"))
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    previous = _previous_result(output_dir)
+
+    current = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "backend": args.backend,
+        "results": [],
+    }
+    for rows in args.rows or DEFAULT_SIZES:
+        print(f"\n{rows:,} 行")
+        current["results"].append(bench_size(rows, args.months, args.unclassified_ratio, args.repeat, backend=args.backend))
+
+    path = output_dir / f"summary_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました → {path}")
+
+    if previous:
+        compare(previous, current)
+
+
+if __name__ == "__main__":
+    main()
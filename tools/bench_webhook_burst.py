@@ -0,0 +1,89 @@
+"""line_userid_catcher に多数のイベントをまとめたWebhookを送り、処理件数/秒を計測する。
+
+LINE は1回のWebhookに複数のイベントをまとめて送ってくる。同じ利用者の重複メッセージも含めた
+バーストを作り、並列数（MAX_WORKERS）ごとにハンドラの実行時間を比べる。
+Lambda invoke / DynamoDB の応答遅延は --latency で指定する（呼び出し先のLambdaは実行しない）。
+
+使い方:
+    python tools/bench_webhook_burst.py --events 200 --users 50 --latency 0.03 --workers 1 4 16
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from local_stubs import LocalCloud, load_lambda  # noqa: E402
+
+TABLE = "users"
+TEXTS = ["家計ファイルをアップロードしたい", "家計診断をお願いします", "こんにちは"]
+
+
+def build_event(events, users, seed=0):
+    rng = random.Random(seed)
+    return {"body": json.dumps({"events": [{
+        "type": "message",
+        "source": {"userId": f"U{rng.randrange(users):032x}"},
+        "message": {"type": "text", "text": rng.choice(TEXTS)},
+    } for _ in range(events)]}, ensure_ascii=False)}
+
+
+def run(module, cloud, event, workers):
+    module.MAX_WORKERS = workers
+    cloud.lambda_client.invocations.clear()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        result = module.lambda_handler(event, None)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200, help="1回のWebhookに含めるイベント数")
+    parser.add_argument("--users", type=int, default=50, help="送信元の利用者数")
+    parser.add_argument("--latency", type=float, default=0.03, help="Lambda invoke / DynamoDB 呼び出しごとの遅延（秒）")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="比較する並列数")
+    parser.add_argument("--output", help="計測結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DYNAMODB_TABLE_NAME", TABLE)
+    cloud = LocalCloud(table_name=TABLE, latency=args.latency).install()
+    module = load_lambda("line_userid_catcher")
+    event = build_event(args.events, args.users)
+
+    results = []
+    print(f"{'workers':>8}{'seconds':>10}{'events/s':>12}{'invokes':>10}{'users':>8}")
+    for workers in args.workers:
+        # 毎回未登録の状態から計測する
+        cloud.table.items.clear()
+        result, elapsed = run(module, cloud, event, workers)
+        if result["statusCode"] != 200:
+            raise SystemExit(f"ハンドラがエラーを返しました: {result}")
+        row = {
+            "workers": workers,
+            "seconds": round(elapsed, 4),
+            "events_per_second": round(args.events / elapsed, 1),
+            "invocations": len(cloud.lambda_client.invocations),
+            "registered_users": len(cloud.table.items),
+        }
+        results.append(row)
+        print(f"{workers:>8}{row['seconds']:>10.3f}{row['events_per_second']:>12.1f}{row['invocations']:>10}{row['registered_users']:>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"events": args.events, "users": args.users, "latency": args.latency, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
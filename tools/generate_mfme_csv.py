@@ -0,0 +1,132 @@
+"""マネーフォワードMEの入出金CSVを模した合成データを生成する。
+
+列は実際のエクスポートと同じ
+  計算対象, 日付, 内容, 金額（円）, 保有金融機関, 大項目, 中項目, メモ, 振替, ID
+で、文字コードは既定で CP932（Shift_JIS）。
+
+使い方:
+    python tools/generate_mfme_csv.py --rows 100000 --months 24 --unclassified-ratio 0.1 -o sample.csv
+"""
+import argparse
+import csv
+import io
+import random
+from datetime import date, timedelta
+
+COLUMNS = ["計算対象", "日付", "内容", "金額（円）", "保有金融機関", "大項目", "中項目", "メモ", "振替", "ID"]
+
+# (大項目, 中項目, 店名の候補, 金額の範囲)
+EXPENSE_CATEGORIES = [
+    ("食費", "食料品", ["イオン", "ライフ", "西友", "成城石井", "オーケーストア"], (300, 8000)),
+    ("食費", "コンビニ", ["セブン-イレブン", "ファミリーマート", "ローソン"], (100, 1500)),
+    ("食費", "外食", ["スターバックス", "マクドナルド", "サイゼリヤ", "すき家", "スシロー"], (400, 6000)),
+    ("日用品", "ドラッグストア", ["マツモトキヨシ", "ウエルシア", "スギ薬局"], (300, 5000)),
+    ("日用品", "日用品", ["AMAZON.CO.JP", "ニトリ", "無印良品"], (500, 15000)),
+    ("交通費", "電車", ["JR東日本 モバイルSUICA", "東京メトロ"], (150, 3000)),
+    ("趣味・娯楽", "映画・音楽", ["TOHOシネマズ", "SPOTIFY", "APPLE.COM/BILL"], (500, 4000)),
+    ("衣服・美容", "衣服", ["ユニクロ", "GU", "ZARA"], (1000, 15000)),
+    ("健康・医療", "病院", ["さくらクリニック", "みどり小児科"], (500, 8000)),
+    ("水道・光熱費", "電気代", ["東京電力エナジーパートナー"], (4000, 15000)),
+    ("通信費", "スマホ", ["ドコモ", "楽天モバイル"], (1000, 9000)),
+    ("住まい", "家賃", ["家賃 引落"], (80000, 150000)),
+]
+INCOME = ("収入", "給与", ["給与 株式会社サンプル"], (250000, 400000))
+INSTITUTIONS = ["三井住友カード", "楽天カード", "ゆうちょ銀行", "モバイルSuica"]
+
+
+def _zipf_weights(count, skew):
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def generate_rows(rows=10000, months=12, start=date(2023, 1, 1), skew=1.1, unclassified_ratio=0.05, seed=0):
+    """合成データの行（dict）を日付順に返す。skew が大きいほど上位カテゴリ・店舗に偏る"""
+    rng = random.Random(seed)
+    days = max(1, months * 30)
+    category_weights = _zipf_weights(len(EXPENSE_CATEGORIES), skew)
+    expense_rows = max(0, rows - months)
+
+    result = []
+    for i in range(expense_rows):
+        main, sub, merchants, (low, high) = rng.choices(EXPENSE_CATEGORIES, weights=category_weights)[0]
+        merchant = rng.choices(merchants, weights=_zipf_weights(len(merchants), skew))[0]
+        if rng.random() < 0.3:
+            merchant = f"{merchant} {rng.choice(['渋谷店', '新宿店', '池袋店', '駅前店'])}"
+        if rng.random() < unclassified_ratio:
+            main = sub = "未分類"
+        day = start + timedelta(days=rng.randrange(days))
+        result.append((day, {
+            "計算対象": "1",
+            "日付": day.strftime("%Y/%m/%d"),
+            "内容": merchant,
+            "金額（円）": str(-rng.randint(low, high)),
+            "保有金融機関": rng.choice(INSTITUTIONS),
+            "大項目": main,
+            "中項目": sub,
+            "メモ": "",
+            "振替": "0",
+            "ID": f"syn{seed:04d}{i:09d}",
+        }))
+
+    # 毎月25日の給与
+    main, sub, merchants, (low, high) = INCOME
+    for month in range(min(months, rows)):
+        year, month_index = divmod(start.month - 1 + month, 12)
+        day = date(start.year + year, month_index + 1, 25)
+        result.append((day, {
+            "計算対象": "1",
+            "日付": day.strftime("%Y/%m/%d"),
+            "内容": merchants[0],
+            "金額（円）": str(rng.randint(low, high)),
+            "保有金融機関": "ゆうちょ銀行",
+            "大項目": main,
+            "中項目": sub,
+            "メモ": "",
+            "振替": "0",
+            "ID": f"syn{seed:04d}income{month:05d}",
+        }))
+
+    # エクスポートと同じく新しい日付が先頭
+    result.sort(key=lambda item: item[0], reverse=True)
+    return [row for _, row in result]
+
+
+def to_csv_bytes(rows, encoding="cp932"):
+    output = io.StringIO(newline="")
+    writer = csv.DictWriter(output, fieldnames=COLUMNS, quoting=csv.QUOTE_ALL)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode(encoding)
+
+
+def generate_csv_bytes(encoding="cp932", **kwargs):
+    return to_csv_bytes(generate_rows(**kwargs), encoding=encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="行数（1,000〜1,000,000 程度）")
+    parser.add_argument("--months", type=int, default=12, help="期間（月数）")
+    parser.add_argument("--start", default="2023-01-01", help="開始日 (YYYY-MM-DD)")
+    parser.add_argument("--skew", type=float, default=1.1, help="カテゴリ・店舗の偏り（Zipf の指数）")
+    parser.add_argument("--unclassified-ratio", type=float, default=0.05, help="未分類の行の割合")
+    parser.add_argument("--encoding", default="cp932", help="出力の文字コード")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", required=True, help="出力先のCSVパス")
+    args = parser.parse_args()
+
+    data = generate_csv_bytes(
+        encoding=args.encoding,
+        rows=args.rows,
+        months=args.months,
+        start=date.fromisoformat(args.start),
+        skew=args.skew,
+        unclassified_ratio=args.unclassified_ratio,
+        seed=args.seed,
+    )
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print(f"{args.rows} 行 / {len(data):,} bytes → {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""LINE → アップロード → 集計 → 家計診断 の一連の流れをローカルで再現し、Lambdaごとの待ち時間・実行時間を集計する。
+
+各Lambdaの lambda_client.invoke はプロセス内のキューに積まれ、順番にローカルのハンドラで処理される。
+S3 / DynamoDB / OpenAI / LINE API は tools/local_stubs.py の代替を使い、
+それぞれの応答遅延はオプションで指定できる。トレースIDはペイロード（S3はメタデータ）で引き継がれる。
+
+使い方:
+    python tools/local_pipeline.py --rows 5000 --openai-latency 15 --line-latency 0.2
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from collections import defaultdict, deque
+from html import unescape
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(TOOLS_DIR))
+
+from generate_mfme_csv import generate_csv_bytes  # noqa: E402
+from local_stubs import LocalCloud, load_lambda  # noqa: E402
+
+BUCKET = "local-bucket"
+TABLE = "users"
+
+# Lambda関数名 -> lambda/ 配下のディレクトリ
+FUNCTIONS = {
+    "line_userid_catcher": "line_userid_catcher",
+    "generatePresignedUrl": "generate_presigned_url",
+    "line_notifier": "line_nortifier",
+    "mfme_csv_summary_generator": "mfme_csv_summary_generator",
+    "fp_comment_from_summary": "fp_comment_from_summary",
+}
+
+
+class PipelineHarness:
+    def __init__(self, aws_latency=0.0, openai_latency=0.0, line_latency=0.0, async_delay=0.0, quiet=True):
+        for name, value in {
+            "DYNAMODB_TABLE_NAME": TABLE,
+            "BUCKET_NAME": BUCKET,
+            "S3_BUCKET_NAME": BUCKET,
+            "API_GATEWAY_DOMAIN": "localhost",
+            "OPENAI_API_KEY": "local",
+            "LINE_CHANNEL_TOKEN": "local",
+        }.items():
+            os.environ.setdefault(name, value)
+
+        self.cloud = LocalCloud(table_name=TABLE, latency=aws_latency).install()
+        self.cloud.openai.latency = openai_latency
+        self.cloud.http.latency = line_latency
+        self.async_delay = async_delay
+        self.quiet = quiet
+        self.handlers = {name: load_lambda(directory).lambda_handler for name, directory in FUNCTIONS.items()}
+        for name in FUNCTIONS:
+            self.cloud.lambda_client.routes[name] = lambda payload, name=name: self.enqueue(name, payload)
+        self.queue = deque()
+        self.hops = []
+
+    def enqueue(self, function_name, event, trace_id=None):
+        self.queue.append((function_name, event, trace_id or event.get("trace_id"), time.perf_counter()))
+
+    def run(self):
+        """キューが空になるまでハンドラを実行する"""
+        while self.queue:
+            function_name, event, trace_id, queued_at = self.queue.popleft()
+            # 非同期呼び出しの起動待ちを模擬する
+            wait = queued_at + self.async_delay - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            started = time.perf_counter()
+            stdout = sys.stdout
+            if self.quiet:
+                sys.stdout = open(os.devnull, "w")
+            try:
+                result = self.handlers[function_name](event, None)
+            finally:
+                if self.quiet:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+            finished = time.perf_counter()
+            self.hops.append({
+                "trace_id": trace_id,
+                "function": function_name,
+                "queued_at": queued_at,
+                "queue_ms": (started - queued_at) * 1000,
+                "exec_ms": (finished - started) * 1000,
+                "finished_at": finished,
+                "status": result.get("statusCode") if isinstance(result, dict) else None,
+                "result": result,
+            })
+
+    # --- 利用者の操作 ---
+
+    def send_line_message(self, user_id, text):
+        trace_id = uuid.uuid4().hex
+        event = {
+            "body": json.dumps({"events": [{
+                "type": "message",
+                "source": {"userId": user_id},
+                "message": {"type": "text", "text": text},
+            }]}, ensure_ascii=False),
+            "trace_id": trace_id,
+        }
+        self.enqueue("line_userid_catcher", event, trace_id)
+        self.run()
+        return trace_id
+
+    def upload_csv(self, user_id, data):
+        """アップロードページを開き、署名付きPOSTでCSVを送ってS3イベントを発生させる"""
+        trace_id = uuid.uuid4().hex
+        self.enqueue("generatePresignedUrl", {"queryStringParameters": {"user_id": user_id}, "trace_id": trace_id}, trace_id)
+        self.run()
+        page = next(hop["result"]["body"] for hop in reversed(self.hops) if hop["function"] == "generatePresignedUrl")
+        fields = {name: unescape(value) for name, value in re.findall(r'<input type="hidden" name="([^"]+)" value="([^"]*)">', page)}
+        metadata = {k[len("x-amz-meta-"):]: v for k, v in fields.items() if k.startswith("x-amz-meta-")}
+        key = fields["key"]
+        self.cloud.s3.put_object(Bucket=BUCKET, Key=key, Body=data, Metadata=metadata)
+        self.enqueue("mfme_csv_summary_generator", {
+            "Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}],
+        }, metadata.get("trace-id", trace_id))
+        self.run()
+        return trace_id
+
+    # --- レポート ---
+
+    def report(self):
+        traces = defaultdict(list)
+        for hop in self.hops:
+            traces[hop["trace_id"]].append(hop)
+
+        print(f"{'trace':<10}{'function':<30}{'queue ms':>12}{'exec ms':>12}{'status':>8}")
+        for trace_id, hops in traces.items():
+            for hop in hops:
+                print(f"{trace_id[:8]:<10}{hop['function']:<30}{hop['queue_ms']:>12.1f}{hop['exec_ms']:>12.1f}{str(hop['status']):>8}")
+            total = (hops[-1]["finished_at"] - hops[0]["queued_at"]) * 1000
+            print(f"{'':<10}{'end-to-end':<30}{'':>12}{total:>12.1f}\n")
+
+        stages = defaultdict(lambda: {"count": 0, "queue_ms": 0.0, "exec_ms": 0.0})
+        for hop in self.hops:
+            stage = stages[hop["function"]]
+            stage["count"] += 1
+            stage["queue_ms"] += hop["queue_ms"]
+            stage["exec_ms"] += hop["exec_ms"]
+        print(f"{'stage':<30}{'count':>8}{'queue ms':>12}{'exec ms':>12}")
+        for name, stage in stages.items():
+            print(f"{name:<30}{stage['count']:>8}{stage['queue_ms']:>12.1f}{stage['exec_ms']:>12.1f}")
+        return {
+            "traces": {t: [{k: v for k, v in hop.items() if k != "result"} for hop in hops] for t, hops in traces.items()},
+            "stages": dict(stages),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="アップロードする合成CSVの行数")
+    parser.add_argument("--aws-latency", type=float, default=0.0, help="S3/DynamoDB 呼び出しごとの遅延（秒）")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="OpenAI 応答の遅延（秒）")
+    parser.add_argument("--line-latency", type=float, default=0.0, help="LINE API 応答の遅延（秒）")
+    parser.add_argument("--async-delay", type=float, default=0.0, help="非同期invokeの起動待ち（秒）")
+    parser.add_argument("--verbose", action="store_true", help="ハンドラのログを表示する")
+    parser.add_argument("--output", help="ホップごとの計測結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    harness = PipelineHarness(
+        aws_latency=args.aws_latency,
+        openai_latency=args.openai_latency,
+        line_latency=args.line_latency,
+        async_delay=args.async_delay,
+        quiet=not args.verbose,
+    )
+    user_id = "U" + uuid.uuid4().hex
+    harness.send_line_message(user_id, "家計ファイルをアップロードしたい")
+    harness.upload_csv(user_id, generate_csv_bytes(rows=args.rows, months=6))
+    harness.send_line_message(user_id, "家計診断をお願いします")
+    result = harness.report()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
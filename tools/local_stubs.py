@@ -0,0 +1,724 @@
+"""S3 / DynamoDB / Lambda / OpenAI / LINE API のローカル代替。
+
+ベンチマークやローカル実行用に、lambda/common/clients.py のクライアント取得関数を
+メモリ上の実装に差し替える。ネットワークには一切アクセスしない。
+"""
+import asyncio
+import copy
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import deque
+from collections.abc import MutableMapping
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+LAMBDA_DIR = Path(__file__).resolve().parent.parent / "lambda"
+COMMON_DIR = LAMBDA_DIR / "common"
+
+
+class ClientError(Exception):
+    def __init__(self, code, message=""):
+        super().__init__(f"{code}: {message}" if message else code)
+        self.response = {"Error": {"Code": code, "Message": message}}
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, key=""):
+        super().__init__("NoSuchKey", key)
+
+
+class ConditionalCheckFailedException(ClientError):
+    def __init__(self):
+        super().__init__("ConditionalCheckFailedException", "The conditional request failed")
+
+
+class StreamingBody:
+    """botocore の StreamingBody と同じ読み方ができるボディ"""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(-1 if amt is None else amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self._stream.close()
+
+
+class FakePaginator:
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            params = dict(kwargs)
+            if token:
+                params["ContinuationToken"] = token
+            page = self._method(**params)
+            yield page
+            token = page.get("NextContinuationToken")
+            if not token:
+                return
+
+
+class FakeS3:
+    """バケット/キー -> バイト列 の S3"""
+
+    def __init__(self, latency=0.0):
+        self.objects = {}
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.exceptions = types.SimpleNamespace(NoSuchKey=NoSuchKey, ClientError=ClientError)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body=b"", Metadata=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self._wait()
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == "*" and current is not None:
+                raise ClientError("PreconditionFailed", Key)
+            if IfMatch is not None and (current is None or current["ETag"] != IfMatch):
+                raise ClientError("PreconditionFailed", Key)
+            etag = '"%s"' % hashlib.md5(Body).hexdigest()
+            self.objects[(Bucket, Key)] = {
+                "Body": Body,
+                "ETag": etag,
+                "Metadata": dict(Metadata or {}),
+                "ContentType": kwargs.get("ContentType"),
+                "LastModified": time.time(),
+            }
+        return {"ETag": etag}
+
+    def _get(self, Bucket, Key):
+        with self._lock:
+            obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise NoSuchKey(Key)
+        return obj
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._wait()
+        obj = self._get(Bucket, Key)
+        body = obj["Body"]
+        if Range:
+            start, end = Range.replace("bytes=", "").split("-")
+            body = body[int(start):int(end) + 1 if end else None]
+        return {
+            "Body": StreamingBody(body),
+            "ETag": obj["ETag"],
+            "ContentLength": len(body),
+            "Metadata": dict(obj["Metadata"]),
+            "LastModified": obj["LastModified"],
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._wait()
+        try:
+            obj = self._get(Bucket, Key)
+        except NoSuchKey:
+            raise ClientError("404", Key)
+        return {
+            "ETag": obj["ETag"],
+            "ContentLength": len(obj["Body"]),
+            "Metadata": dict(obj["Metadata"]),
+            "LastModified": obj["LastModified"],
+        }
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, StartAfter=None, **kwargs):
+        self._wait()
+        with self._lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [k for k in keys if k > after]
+        page = keys[:MaxKeys]
+        contents = []
+        for key in page:
+            obj = self.objects[(Bucket, key)]
+            contents.append({"Key": key, "ETag": obj["ETag"], "Size": len(obj["Body"]), "LastModified": obj["LastModified"]})
+        result = {"Contents": contents, "KeyCount": len(contents), "IsTruncated": len(keys) > MaxKeys}
+        if result["IsTruncated"]:
+            result["NextContinuationToken"] = page[-1]
+        return result
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, operation_name))
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        fields = dict(Fields or {})
+        fields.update({"key": Key, "policy": "local-policy", "x-amz-signature": "local-signature"})
+        return {"url": f"http://localhost/{quote(Bucket)}", "fields": fields}
+
+
+class DirectoryObjects(MutableMapping):
+    """(バケット, キー) -> オブジェクト をディレクトリ上のファイルに保存する（複数プロセスで共有できる）"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.tmp_dir = self.root / ".tmp"
+
+    def _path(self, bucket_key):
+        bucket, key = bucket_key
+        return self.root / quote(bucket, safe="") / quote(key, safe="")
+
+    def __getitem__(self, bucket_key):
+        try:
+            with open(self._path(bucket_key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(bucket_key)
+
+    def __setitem__(self, bucket_key, obj):
+        path = self._path(bucket_key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        # 書きかけのファイルを他のプロセスに読ませない
+        tmp = self.tmp_dir / f"{os.getpid()}-{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(tmp, path)
+
+    def __delitem__(self, bucket_key):
+        try:
+            self._path(bucket_key).unlink()
+        except FileNotFoundError:
+            raise KeyError(bucket_key)
+
+    def __iter__(self):
+        if not self.root.exists():
+            return
+        for bucket_dir in self.root.iterdir():
+            if bucket_dir == self.tmp_dir or not bucket_dir.is_dir():
+                continue
+            for path in bucket_dir.iterdir():
+                yield unquote(bucket_dir.name), unquote(path.name)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class DirectoryS3(FakeS3):
+    """オブジェクトをディレクトリに保存する FakeS3（プロセスプールを使うツールの検証用）。
+    条件付き書き込みはプロセスをまたいでは排他されない。"""
+
+    def __init__(self, root, latency=0.0):
+        super().__init__(latency=latency)
+        self.objects = DirectoryObjects(root)
+
+
+# --- DynamoDB ---
+
+_TOKEN = re.compile(r"\s*(attribute_not_exists|attribute_exists|if_not_exists|AND|OR|NOT|<>|<=|>=|[=<>(),+\-]|[:#]?[A-Za-z_][\w.]*|\d+)")
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if not match:
+            raise ValueError(f"unsupported expression: {expression!r}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class _ExpressionContext:
+    def __init__(self, item, names, values):
+        self.item = item
+        self.names = names or {}
+        self.values = values or {}
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def operand(self, token):
+        if token.startswith(":"):
+            return self.values[token]
+        return self.item.get(self.name(token))
+
+
+def _evaluate_condition(expression, ctx):
+    """DynamoDB の条件式のうち、このリポジトリで使う範囲（比較・AND/OR/NOT・attribute_(not_)exists）を評価する"""
+    tokens = _tokenize(expression)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def parse_or():
+        result = parse_and()
+        while peek() == "OR":
+            take()
+            rhs = parse_and()
+            result = result or rhs
+        return result
+
+    def parse_and():
+        result = parse_not()
+        while peek() == "AND":
+            take()
+            rhs = parse_not()
+            result = result and rhs
+        return result
+
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return not parse_not()
+        return parse_primary()
+
+    def parse_primary():
+        token = take()
+        if token == "(":
+            result = parse_or()
+            take()
+            return result
+        if token in ("attribute_not_exists", "attribute_exists"):
+            take()
+            name = ctx.name(take())
+            take()
+            exists = name in ctx.item
+            return not exists if token == "attribute_not_exists" else exists
+        lhs = ctx.operand(token)
+        op = take()
+        rhs = ctx.operand(take())
+        if op == "=":
+            return lhs == rhs
+        if op == "<>":
+            return lhs != rhs
+        if lhs is None or rhs is None:
+            return False
+        return {"<": lhs < rhs, "<=": lhs <= rhs, ">": lhs > rhs, ">=": lhs >= rhs}[op]
+
+    return parse_or()
+
+
+def _condition_to_expression(condition, names, values):
+    """boto3.dynamodb.conditions のオブジェクトを文字列の式に変換する"""
+    if condition is None or isinstance(condition, str):
+        return condition
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    operands = expression["values"]
+    if operator in ("AND", "OR"):
+        return f"({_condition_to_expression(operands[0], names, values)}) {operator} ({_condition_to_expression(operands[1], names, values)})"
+    name_token = f"#n{len(names)}"
+    names[name_token] = operands[0].name
+    if operator in ("attribute_not_exists", "attribute_exists"):
+        return f"{operator}({name_token})"
+    value_token = f":v{len(values)}"
+    values[value_token] = operands[1]
+    return f"{name_token} {operator} {value_token}"
+
+
+class FakeTable:
+    def __init__(self, name, key_name="userId", indexes=None, latency=0.0):
+        self.name = name
+        self.key_name = key_name
+        # インデックス名 -> パーティションキー名
+        self.indexes = dict(indexes or {})
+        self.items = {}
+        self.latency = latency
+        self.calls = []
+        self._lock = threading.Lock()
+        self.meta = types.SimpleNamespace(client=types.SimpleNamespace(
+            exceptions=types.SimpleNamespace(ConditionalCheckFailedException=ConditionalCheckFailedException)
+        ))
+
+    def _record(self, operation):
+        self.calls.append(operation)
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _project(item, projection, names):
+        if not projection:
+            return copy.deepcopy(item)
+        attributes = [names.get(a.strip(), a.strip()) for a in projection.split(",")]
+        return {a: copy.deepcopy(item[a]) for a in attributes if a in item}
+
+    def _check(self, item, condition, names, values):
+        if condition and not _evaluate_condition(condition, _ExpressionContext(item, names, values)):
+            raise ConditionalCheckFailedException()
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self._record("get_item")
+        with self._lock:
+            item = self.items.get(Key[self.key_name])
+            if item is None:
+                return {}
+            return {"Item": self._project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self._record("put_item")
+        names = dict(ExpressionAttributeNames or {})
+        values = dict(ExpressionAttributeValues or {})
+        condition = _condition_to_expression(ConditionExpression, names, values)
+        with self._lock:
+            self._check(self.items.get(Item[self.key_name], {}), condition, names, values)
+            self.items[Item[self.key_name]] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE", **kwargs):
+        self._record("update_item")
+        names = dict(ExpressionAttributeNames or {})
+        values = dict(ExpressionAttributeValues or {})
+        condition = _condition_to_expression(ConditionExpression, names, values)
+        with self._lock:
+            key = Key[self.key_name]
+            item = copy.deepcopy(self.items.get(key, {}))
+            self._check(item, condition, names, values)
+            old = copy.deepcopy(item)
+            item.update(Key)
+            updated = {}
+            for clause in re.split(r"\s+(?=SET\s|REMOVE\s)", UpdateExpression.strip()):
+                action, _, body = clause.partition(" ")
+                if action == "SET":
+                    for assignment in body.split(","):
+                        target, _, source = assignment.partition("=")
+                        target = names.get(target.strip(), target.strip())
+                        source = source.strip()
+                        match = re.match(r"if_not_exists\(\s*(\S+)\s*,\s*(\S+)\s*\)", source)
+                        if match:
+                            existing = item.get(names.get(match.group(1), match.group(1)))
+                            value = existing if existing is not None else values[match.group(2)]
+                        else:
+                            value = values[source] if source.startswith(":") else item.get(names.get(source, source))
+                        item[target] = copy.deepcopy(value)
+                        updated[target] = value
+                elif action == "REMOVE":
+                    for target in body.split(","):
+                        item.pop(names.get(target.strip(), target.strip()), None)
+            self.items[key] = item
+        if ReturnValues == "ALL_NEW":
+            return {"Attributes": copy.deepcopy(item)}
+        if ReturnValues == "ALL_OLD":
+            return {"Attributes": old} if old else {}
+        if ReturnValues == "UPDATED_NEW":
+            return {"Attributes": copy.deepcopy(updated)}
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self._record("delete_item")
+        with self._lock:
+            self.items.pop(Key[self.key_name], None)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, ProjectionExpression=None,
+              ExpressionAttributeNames=None, ExpressionAttributeValues=None, Limit=None, **kwargs):
+        self._record("query")
+        names = dict(ExpressionAttributeNames or {})
+        values = dict(ExpressionAttributeValues or {})
+        condition = _condition_to_expression(KeyConditionExpression, names, values)
+        with self._lock:
+            # インデックスはパーティションキーを持つ項目だけを含む
+            partition_key = self.indexes.get(IndexName, self.key_name) if IndexName else self.key_name
+            matched = [
+                self._project(item, ProjectionExpression, names)
+                for item in self.items.values()
+                if partition_key in item and _evaluate_condition(condition, _ExpressionContext(item, names, values))
+            ]
+        if Limit:
+            matched = matched[:Limit]
+        return {"Items": matched, "Count": len(matched)}
+
+    def scan(self, **kwargs):
+        self._record("scan")
+        with self._lock:
+            return {"Items": [copy.deepcopy(item) for item in self.items.values()]}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+
+class FakeBatchWriter:
+    """25件ずつ BatchWriteItem を送る boto3 の batch_writer の代替"""
+
+    BATCH_SIZE = 25
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = {}
+
+    def put_item(self, Item):
+        # overwrite_by_pkeys と同じく、同じキーの項目は最後のものだけ送る
+        self.pending[Item[self.table.key_name]] = copy.deepcopy(Item)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.table._record("batch_write_item")
+        with self.table._lock:
+            self.table.items.update(self.pending)
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class FakeDynamoDBResource:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            if len(request["Keys"]) > 100:
+                raise ClientError("ValidationException", "Too many items requested for the BatchGetItem call")
+            table._record("batch_get_item")
+            names = request.get("ExpressionAttributeNames") or {}
+            with table._lock:
+                responses[name] = [
+                    table._project(table.items[key[table.key_name]], request.get("ProjectionExpression"), names)
+                    for key in request["Keys"] if key[table.key_name] in table.items
+                ]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+
+# --- Lambda ---
+
+class FakeLambda:
+    """invoke された呼び出しを記録し、routes に登録されたハンドラがあれば呼び出す"""
+
+    def __init__(self, latency=0.0):
+        self.invocations = []
+        self.routes = {}
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}", **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        payload = json.loads(Payload)
+        with self._lock:
+            self.invocations.append({"FunctionName": FunctionName, "InvocationType": InvocationType, "Payload": payload})
+        handler = self.routes.get(FunctionName)
+        result = handler(payload) if handler else None
+        status = 202 if InvocationType == "Event" else 200
+        return {"StatusCode": status, "Payload": StreamingBody(json.dumps(result).encode("utf-8"))}
+
+
+# --- OpenAI ---
+
+class FakeOpenAI:
+    """chat.completions.create を固定の応答（または responder の結果）で返す"""
+
+    def __init__(self, responder=None, latency=0.0):
+        self.responder = responder or (lambda messages, **kwargs: "FPコメント: ローカル実行のダミーコメントです。")
+        self.latency = latency
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(model, messages, **kwargs)
+
+    def respond(self, model, messages, **kwargs):
+        self.requests.append({"model": model, "messages": messages, **kwargs})
+        content = self.responder(messages, model=model, **kwargs)
+        prompt_tokens = sum(len(m["content"]) for m in messages)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content),
+                                        total_tokens=prompt_tokens + len(content)),
+        )
+
+
+class FakeAPIStatusError(Exception):
+    """openai.APIStatusError と同じく status_code と response.headers を持つエラー"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"Error code: {status_code}")
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(headers=headers or {})
+
+
+class FakeAsyncOpenAI:
+    """FakeOpenAI の非同期版。直近60秒のリクエスト数が rpm_limit を超えると 429 を返す"""
+
+    def __init__(self, sync, rpm_limit=None):
+        self.sync = sync
+        self.rpm_limit = rpm_limit
+        self.rate_limited = 0
+        self._sent = deque()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    async def _create(self, model, messages, **kwargs):
+        now = time.monotonic()
+        while self._sent and now - self._sent[0] >= 60:
+            self._sent.popleft()
+        if self.rpm_limit and len(self._sent) >= self.rpm_limit:
+            self.rate_limited += 1
+            retry_after = 60 - (now - self._sent[0])
+            raise FakeAPIStatusError(429, {"retry-after": f"{retry_after:.3f}"})
+        self._sent.append(now)
+        if self.sync.latency:
+            await asyncio.sleep(self.sync.latency)
+        return self.sync.respond(model, messages, **kwargs)
+
+
+# --- SQS ---
+
+class FakeSQS:
+    """send_message_batch されたメッセージを溜め、Lambda の SQS イベントとして取り出せる"""
+
+    def __init__(self):
+        self.messages = deque()
+        self._lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        with self._lock:
+            for entry in Entries:
+                message_id = uuid.uuid4().hex
+                self.messages.append({"messageId": message_id, "body": entry["MessageBody"], "eventSource": "aws:sqs"})
+                successful.append({"Id": entry["Id"], "MessageId": message_id})
+        return {"Successful": successful, "Failed": []}
+
+    def receive_event(self, max_messages=10):
+        """最大 max_messages 件を取り出して Lambda の SQS イベントにする"""
+        with self._lock:
+            records = [self.messages.popleft() for _ in range(min(max_messages, len(self.messages)))]
+        return {"Records": records}
+
+
+# --- LINE API (HTTP) ---
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error", response=self)
+
+
+class FakeHTTPSession:
+    """requests.Session の代わりに送信内容を記録する"""
+
+    def __init__(self, responder=None, latency=0.0):
+        self.responder = responder or (lambda method, url, **kwargs: FakeResponse(200, {}))
+        self.latency = latency
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.requests.append({"method": method, "url": url, **kwargs})
+        if self.latency:
+            time.sleep(self.latency)
+        return self.responder(method, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+
+class LocalCloud:
+    """1つのテスト/ベンチマーク実行で共有するローカルのAWS・外部API一式"""
+
+    def __init__(self, table_name="users", indexes=None, latency=0.0, s3=None):
+        self.s3 = s3 or FakeS3(latency=latency)
+        self.tables = {table_name: FakeTable(table_name, indexes=indexes or {"csv_path-index": "csv_path"}, latency=latency)}
+        self.lambda_client = FakeLambda(latency=latency)
+        self.openai = FakeOpenAI()
+        self.async_openai = FakeAsyncOpenAI(self.openai)
+        self.sqs = FakeSQS()
+        self.http = FakeHTTPSession()
+        self.clients = {"s3": self.s3, "lambda": self.lambda_client, "sqs": self.sqs}
+
+    @property
+    def table(self):
+        return next(iter(self.tables.values()))
+
+    def install(self):
+        """lambda/common/clients.py の取得関数をローカル実装に差し替える"""
+        for path in (str(COMMON_DIR),):
+            if path not in sys.path:
+                sys.path.insert(0, path)
+        import clients
+        # 差し替え前の関数を import 済みの共通モジュールは読み込み直させる
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if name != "clients" and path and Path(path).resolve().is_relative_to(LAMBDA_DIR):
+                del sys.modules[name]
+        clients.get_client = lambda service_name: self.clients[service_name]
+        clients.get_dynamodb_resource = lambda: FakeDynamoDBResource(self.tables)
+        clients.get_table = lambda name: self.tables[name]
+        clients.get_openai_client = lambda: self.openai
+        clients.get_async_openai_client = lambda: self.async_openai
+        clients.get_http_session = lambda: self.http
+        return self
+
+
+def load_lambda(function_dir, module_name=None, filename="lambda_function.py"):
+    """lambda/<function_dir>/lambda_function.py（または filename）を固有のモジュール名で読み込む"""
+    import importlib.util
+
+    directory = LAMBDA_DIR / function_dir
+    for path in (str(COMMON_DIR), str(directory)):
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+    module_name = module_name or f"{function_dir}_{Path(filename).stem}"
+    spec = importlib.util.spec_from_file_location(module_name, directory / filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module